@@ -3,34 +3,33 @@
 import argparse
 import os
 import sys
-import tempfile
 import time
-import shutil
 import datetime
 import json
 import threading
 import queue
 import textwrap
 import re
-import pathlib
 import logging
 
+import requests
+
 import drm
 from drm.data import HandbrakeConfig, RipConfig, Disc, Fix, Job
 import drm.handbrake as handbrake
 from drm.util import *
 from drm.master import master_start_server
-from drm.slave import slave_start
+from drm.store import dispatch_policies
+from drm.slave import slave_start, check_master
+from drm.rip import rip_drives, find_drives, publish_image, PART_SUFFIX
+import drm.pipeline
+import drm.mkv
 
 
 logger = logging.getLogger('drm')
 
 
-MIN_DISK_SPACE_LEFT = 15                # in gb
-
-
 # TODO: support subdirs
-# TODO: detect new files during runtime
 # TODO: maybe add prefix to tempfile
 # TODO: Check if file already fully copied (for master)
 # TODO: Implement state site via flask
@@ -99,6 +98,9 @@ def parse_cfg_slave(cfg_path):
             data = json.load(fd)
             ip = data['ip']
             port = data['port']
+            dvr_workers = data.get('dvr_workers')
+        if dvr_workers is not None and (not isinstance(dvr_workers, int) or dvr_workers < 1):
+            raise InvalidConfigException('Config is invalid')
     except (KeyError, json.decoder.JSONDecodeError):
         raise InvalidConfigException('Config is invalid')
     except FileNotFoundError:
@@ -106,10 +108,29 @@ def parse_cfg_slave(cfg_path):
     except IsADirectoryError:
         raise PathIsDirException('Config file expected, directory found')
 
-    return (ip, port)
+    return (ip, port, dvr_workers)
 
 
-def master(hb_config, rip_config, fixes, in_path, out_path):
+def parse_deadline(value):
+    """Parses a deadline given as 'YYYY-MM-DD HH:MM' or 'HH:MM'. The latter
+    is the next time of day with that time."""
+    now = datetime.datetime.now()
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M')
+    except ValueError:
+        pass
+    try:
+        time_of_day = datetime.datetime.strptime(value, '%H:%M').time()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Deadline must be given as "YYYY-MM-DD HH:MM" or "HH:MM"')
+    ret = datetime.datetime.combine(now.date(), time_of_day)
+    if ret <= now:
+        ret += datetime.timedelta(days=1)
+    return ret
+
+
+def master(hb_config, rip_config, fixes, in_path, out_path, trace_path=None, policy='lifo', deadline=None, local_workers=0,
+           cache_path=None, split_minutes=None, follow=False):
     logger.info('Starting as master...')
 
     if len(fixes) > 0:
@@ -124,6 +145,9 @@ def master(hb_config, rip_config, fixes, in_path, out_path):
             logger.error('Subdirs currently not supported!')
             break
         for f in files:
+            # Images still being ripped are published, once they are complete
+            if f.endswith(PART_SUFFIX):
+                continue
             disc = Disc(os.path.join(root, f))
             job = Job(disc, rip_config, hb_config, fixes)
             job_queue.append(job)
@@ -132,83 +156,132 @@ def master(hb_config, rip_config, fixes, in_path, out_path):
     logger.info('Created {} jobs'.format(len(job_queue)))
 
     # TODO: ip/port
-    master_start_server('0.0.0.0', 5001, job_queue, out_path)
+    logger.info('Dispatch policy: %s', policy)
+    if deadline is not None:
+        logger.info('Deadline: %s, x264 preset is selected per job', deadline)
+    if local_workers > 0:
+        if handbrake.check_env():
+            logger.info('Starting %d local workers', local_workers)
+        else:
+            logger.error('Handbrake not found! Local workers not available')
+            local_workers = 0
+    if split_minutes is not None:
+        if mkvmerge_check():
+            logger.info('Splitting titles into segments of about %d minutes', split_minutes)
+        else:
+            logger.error('mkvmerge not found! Titles are not split')
+            split_minutes = None
+    if follow:
+        logger.info('Waiting for published images, when all jobs are done (Ctrl-C to end)')
+    master_start_server('0.0.0.0', 5001, job_queue, out_path, trace_path, policy, deadline, local_workers, cache_path,
+                        split_minutes, in_path, follow, (hb_config, rip_config, fixes))
 
 
-def slave(ip, port):
+def slave(ip, port, dvr_workers=None):
     logger.info('Starting as slave...')
-    slave_start(ip, port)
+    slave_start(ip, port, dvr_workers)
 
 
-def rip(out_dir):
-    # TODO: show progress via shutil.disk_usage('/tmp/tmp.../')
-
-    if not any([dvdbackup_check(), genisoimage_check(), eject_check()]):
-        logger.error('Some necessary tool not found (dvdbackup, genisoimage, eject)')
+def rip(out_dir, drives=None, use_label=False, master=None):
+    if not eject_check():
+        logger.error('Necessary tool not found (eject)')
         return
 
-    while True:
-        # Check if there is still some disk space left
-        (_, _, free_mem) = shutil.disk_usage(out_dir)
-        free_mem_gb = free_mem / 1024 / 1024 / 1024
-        if free_mem_gb < MIN_DISK_SPACE_LEFT:
-            logger.warning('Free space in out dir might not be enough')
-
-        # Get name for image
-        try:
-            name = input('Please enter disc name (empty to end): ')
-        except KeyboardInterrupt:
-            break
-
-        # Empty name to exit
-        if name == '':
-            break
+    # Discs are copied directly, dvdbackup is only needed for discs, that
+    # can't be read that way
+    fallback = dvdbackup_check() and genisoimage_check()
+    if not fallback:
+        logger.warning('dvdbackup or genisoimage not found, discs that can\'t be read directly are skipped')
 
-        # Images are expected to use upper case (not necessary, but used here)
-        name = name.upper()
+    if drives is None:
+        drives = find_drives()
 
-        temp_dir = tempfile.TemporaryDirectory()
-        out_path = os.path.join(out_dir, name + '.iso')
+    publish = None
+    if master is not None:
+        logger.info('Publishing images to master at %s:%s', *master)
+        publish = lambda path: publish_image(master[0], master[1], path)
 
-        if pathlib.Path(out_path).is_file():
-            logger.warning('File already exists')
-            continue
-
-        time_started = datetime.datetime.now()
-
-        rip_success = True
-
-        try:
-            dvdbackup(temp_dir.name, name)
-            genisoimage(out_path, os.path.join(temp_dir.name, name))
-        except KeyboardInterrupt:
-            break
+    # One worker per drive, names are prompted one after another
+    rip_drives(out_dir, drives, use_label, fallback, publish)
 
-        time_done = datetime.datetime.now()
 
-        # delete temp_dir explicitly, so memory gets freed right now
-        del temp_dir
+def pipeline(hb_config, rip_config, fixes, in_path, out_path, workers, drives=None, use_label=False, trace_path=None,
+             policy='lifo', deadline=None, local_workers=0, cache_path=None, split_minutes=None, state_path=None):
+    """Rips, scans, encodes and tags in one run. The master runs in the
+    background and gets every image, as soon as it is ripped and scanned."""
+    logger.info('Starting pipeline...')
 
-        # Eject disk
-        eject_retval = eject()
-        if not eject_retval:
-            logger.error('Eject failed!')
-
-        try:
-            image_size = os.path.getsize(out_path)
-        except FileNotFoundError:
-            rip_success = False
-            image_size = 0
-
-        # If image is 0 byte, ripping failed, and there won't be a real image
-        if image_size == 0:
-            rip_success = False
-
-        if rip_success:
-            # TODO: limit print prec
-            logger.info('Done {} [{} GB, {}]!'.format(name, image_size / (1024 * 1024 * 1024), time_done - time_started))
-        else:
-            logger.warning('Failed {} [{}]'.format(name, time_done - time_started))
+    if not eject_check():
+        logger.error('Necessary tool not found (eject)')
+        return
+    fallback = dvdbackup_check() and genisoimage_check()
+    if not fallback:
+        logger.warning('dvdbackup or genisoimage not found, discs that can\'t be read directly are skipped')
+    scan = handbrake.check_env()
+    if not scan:
+        logger.warning('Handbrake not found! Images are not scanned before encoding')
+    if split_minutes is not None and not mkvmerge_check():
+        logger.error('mkvmerge not found! Titles are not split')
+        split_minutes = None
+    if local_workers > 0 and not scan:
+        logger.error('Handbrake not found! Local workers not available')
+        local_workers = 0
+
+    if state_path is None:
+        state_path = os.path.join(out_path, 'drm_pipeline.json')
+    progress = drm.pipeline.Progress(state_path)
+    stages = drm.pipeline.create_pipeline(workers, progress, scan)
+
+    # Jobs are added by the encode stage only
+    t = threading.Thread(target=master_start_server,
+                         args=('0.0.0.0', 5001, [], out_path, trace_path, policy, deadline, local_workers, cache_path,
+                               split_minutes, in_path, True, (hb_config, rip_config, fixes)),
+                         daemon=True)
+    t.start()
+    # The master sets up the job store and its settings on start
+    while not check_master('127.0.0.1', 5001):
+        if not t.is_alive():
+            logger.error('Master failed to start')
+            return
+        time.sleep(0.5)
+
+    stages.start()
+    # in_path is listed before ripping starts, so no image is put twice
+    drm.pipeline.resume(stages, in_path)
+    stopped = threading.Event()
+    threading.Thread(target=drm.pipeline.progress_thread, args=(stages, stopped), daemon=True).start()
+
+    if drives is None:
+        drives = find_drives()
+    # Publishing blocks, while the scan stage is full, so the drives wait
+    # with ejecting until the pipeline catches up
+    rip_drives(in_path, drives, use_label, fallback,
+               lambda path: stages.put(drm.pipeline.Item(path)))
+
+    logger.info('Ripping ended, waiting for the pipeline (Ctrl-C to end)')
+    try:
+        stages.wait()
+    except KeyboardInterrupt:
+        pass
+    stopped.set()
+    logger.info('Pipeline: %s', stages.status())
+    requests.post('http://127.0.0.1:5001/shutdown')
+    t.join()
+
+
+def parse_stage_workers(value):
+    """Parses worker counts given as 'scan=1,encode=4,tag=2'. Stages, that
+    are not given, keep their default."""
+    workers = dict(drm.pipeline.DEFAULT_WORKERS)
+    try:
+        for entry in value.split(','):
+            (stage, count) = entry.split('=')
+            if stage not in workers or int(count) < 1:
+                raise ValueError()
+            workers[stage] = int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected e.g. scan=1,encode=4,tag=2 with stages {}'.format(', '.join(drm.pipeline.STAGES)))
+    return workers
 
 
 def list_titles(target_dir, rip_config, fixes):
@@ -220,7 +293,11 @@ def list_titles(target_dir, rip_config, fixes):
 
     for root, dirs, files in os.walk(target_dir):
         for f in files:
-            track_list = handbrake.scan_disc(os.path.join(root, f), use_libdvdread)
+            try:
+                track_list = handbrake.scan_disc(os.path.join(root, f), use_libdvdread)
+            except handbrake.HandbrakeError as e:
+                logger.error('%s', e)
+                continue
             track_list = handbrake.filter_titles(track_list, *rip_config.len_range, rip_config.a_lang, rip_config.s_lang)
             logger.info(' => {} matching tracks...'.format(len(track_list)))
             for track in track_list:
@@ -231,6 +308,7 @@ def set_properties(target_dir):
     allowed_pattern = r'''[^a-zA-Z0-9\-() .',_!&äöüÄÖÜ\[\]]'''
     invalid_file_name_msg = 'File name invalid: '
 
+    tag_list = []
     for root, dirs, files in os.walk(target_dir):
         for f in files:
             if os.path.splitext(f)[1] != '.mkv':
@@ -244,10 +322,12 @@ def set_properties(target_dir):
                 logger.warning('%s%s', invalid_file_name_msg, f)
                 logger.warning('%s%s', ' '*len(invalid_file_name_msg), marker)
 
-            # Set mkv properties
-            path = os.path.join(root, f)
             title = os.path.splitext(f)[0]
-            mkvpropedit(path, title)
+            tag_list.append((os.path.join(root, f), title))
+
+    # Titles are set in place, files with the right title are skipped
+    changed = drm.mkv.tag_files(tag_list)
+    logger.info('Set title of %d of %d files', changed, len(tag_list))
 
 
 def help_build_epilog():
@@ -256,6 +336,7 @@ def help_build_epilog():
     found_geniso = genisoimage_check()
     found_eject = eject_check()
     found_mkvprop = mkvpropedit_check()
+    found_mkvmerge = mkvmerge_check()
 
     allowed_fixes = '\n'
     for fix in Fix.allowed_fixes:
@@ -268,24 +349,36 @@ def help_build_epilog():
                  genisoimage    {genisoimage}
                  eject          {eject}
                  mkvpropedit    {mkvpropedit}
+                 mkvmerge       {mkvmerge}
 
                Available fixes:{allowed_fixes}
 
                Examples:
                  $ drm --rip isos/          # Rip DVDs to dir isos/
                  $ drm --rip master.cfg     # Rip DVDs to input directory from master.cfg
+                 $ drm --rip isos/ --drives /dev/sr0,/dev/sr1 --label  # Rip from two drives, name images after volume labels
+                 $ drm --rip master.cfg --publish slave.cfg  # Rip and queue every image with the running master
                  $ drm --list isos/         # List iso titles using default config
                  $ drm --list master.cfg    # List iso titles using config from master.cfg
                  $ drm --master master.cfg  # Start master
+                 $ drm --master master.cfg --trace trace.json  # Start master and write trace of all jobs
+                 $ drm --master master.cfg --deadline 07:00    # Start master and pick presets to be done by 7am
+                 $ drm --master master.cfg --local-workers 1   # Start master, that also encodes one job at a time
+                 $ drm --master master.cfg --cache out/drm_cache.json  # Start master and skip already encoded images
+                 $ drm --master master.cfg --split 30           # Start master and encode long titles in segments of 30 minutes
+                 $ drm --master master.cfg --follow             # Start master, that keeps waiting for published images
+                 $ drm --pipeline master.cfg  # Rip, scan, encode and tag in one run, slaves connect as usual
+                 $ drm --pipeline master.cfg --stages scan=2,encode=8  # Scan two images at a time, queue up to eight with the master
                  $ drm --slave slave.cfg    # Start slave
                  $ drm --prop out/          # Set properties of mkv files in directory out/
                """
 
     help_text = help_text.format(handbrake='Found' if found_hb else 'Not found! --slave and --list not available',
-                                 dvdbackup='Found' if found_dvdbackup else 'Not found! --rip not available',
-                                 genisoimage='Found' if found_geniso else 'Not found! --rip not available',
+                                 dvdbackup='Found' if found_dvdbackup else 'Not found! --rip only for discs, that can be read directly',
+                                 genisoimage='Found' if found_geniso else 'Not found! --rip only for discs, that can be read directly',
                                  eject='Found' if found_eject else 'Not found! --rip not available',
-                                 mkvpropedit='Found' if found_mkvprop else 'Not found! --prop not available',
+                                 mkvpropedit='Found' if found_mkvprop else 'Not found! --prop only for files with space for the title',
+                                 mkvmerge='Found' if found_mkvmerge else 'Not found! --split not available',
                                  allowed_fixes=allowed_fixes)
 
     return textwrap.dedent(help_text)
@@ -298,6 +391,18 @@ def drm_main():
 
     parser.add_argument('--version', action='version', version='%(prog)s ' + drm.__version__)
     parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--trace', action='store', help='write a Chrome trace of all jobs to the given file (--master and --pipeline)')
+    parser.add_argument('--policy', action='store', default='lifo', choices=list(dispatch_policies), help='order in which jobs are dispatched (--master and --pipeline)')
+    parser.add_argument('--cache', action='store', help='skip images, whose outputs are recorded in the given cache file and still exist (--master and --pipeline)')
+    parser.add_argument('--drives', action='store', help='comma separated optical drives, default: all drives (--rip and --pipeline)')
+    parser.add_argument('--label', action='store_true', help='name images after the volume label instead of asking (--rip and --pipeline)')
+    parser.add_argument('--publish', action='store', metavar='SLAVE_CFG', help='queue every finished image with the master given in the slave config, the images have to be ripped to its input dir (--rip only)')
+    parser.add_argument('--stages', action='store', type=parse_stage_workers, default=dict(drm.pipeline.DEFAULT_WORKERS), help='worker count per stage, e.g. scan=1,encode=4,tag=2 (--pipeline only)')
+    parser.add_argument('--state', action='store', help='file to persist the progress of every image in, default: drm_pipeline.json in the output dir (--pipeline only)')
+    parser.add_argument('--follow', action='store_true', help='keep running, when all jobs are done, and wait for images published by --rip (--master only)')
+    parser.add_argument('--split', action='store', type=int, metavar='MINUTES', help='encode titles in chapter aligned segments of about MINUTES on different slaves and join them (--master and --pipeline)')
+    parser.add_argument('--local-workers', action='store', type=int, default=0, help='number of jobs encoded by the master itself (--master and --pipeline)')
+    parser.add_argument('--deadline', action='store', type=parse_deadline, help='pick the slowest x264 preset per job, that still finishes all jobs by "YYYY-MM-DD HH:MM" or "HH:MM" (--master and --pipeline)')
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--master', action='store', help='start drm as master to distribute image files to the slaves')
@@ -305,6 +410,7 @@ def drm_main():
     group.add_argument('--rip', action='store', help='rip DVD discs to image files')
     group.add_argument('--list', action='store', help='list tracks for all images in given directory that match given configuration')
     group.add_argument('--prop', action='store', help='set mkv properties for files')
+    group.add_argument('--pipeline', action='store', help='rip, scan, encode and tag in one run, with the master running in the background')
 
     args = parser.parse_args()
 
@@ -345,14 +451,27 @@ def drm_main():
         except PathIsDirException:
             parser.error('File expected, directory found')
 
-        master(hb_config, rip_config, fixes, in_path, out_path)
+        master(hb_config, rip_config, fixes, in_path, out_path, args.trace, args.policy, args.deadline, args.local_workers, args.cache, args.split, args.follow)
+
+    elif args.pipeline:
+        try:
+            (hb_config, rip_config, fixes, in_path, out_path) = parse_cfg_master(args.pipeline)
+        except InvalidConfigException:
+            parser.error(invalid_config_get_text(expected_master=True, path=args.pipeline))
+        except FileNotFoundError:
+            parser.error('Config file not found')
+        except PathIsDirException:
+            parser.error('File expected, directory found')
+
+        pipeline(hb_config, rip_config, fixes, in_path, out_path, args.stages, args.drives.split(',') if args.drives else None,
+                 args.label, args.trace, args.policy, args.deadline, args.local_workers, args.cache, args.split, args.state)
 
     elif args.slave:
         if not handbrake.check_env():
             parser.error('Handbrake not found! Please install HandBrakeCLI')
 
         try:
-            (ip, port) = parse_cfg_slave(args.slave)
+            (ip, port, dvr_workers) = parse_cfg_slave(args.slave)
         except InvalidConfigException:
             parser.error(invalid_config_get_text(expected_master=False, path=args.slave))
         except FileNotFoundError:
@@ -360,11 +479,11 @@ def drm_main():
         except PathIsDirException:
             parser.error('File expected, directory found')
 
-        slave(ip, port)
+        slave(ip, port, dvr_workers)
 
     elif args.rip:
-        if not all((dvdbackup_check(), genisoimage_check(), eject_check())):
-            parser.error('Necessary tools not found! Make sure dvdbackup, genisoimage and eject are installed')
+        if not eject_check():
+            parser.error('Necessary tools not found! Make sure eject is installed')
 
         # Try if path is config file, if so, use in_path of config
         try:
@@ -383,7 +502,19 @@ def drm_main():
         except PathIsDirException:
             rip_dir = args.rip
 
-        rip(rip_dir)
+        publish = None
+        if args.publish:
+            try:
+                (ip, port, _) = parse_cfg_slave(args.publish)
+                publish = (ip, port)
+            except InvalidConfigException:
+                parser.error(invalid_config_get_text(expected_master=False, path=args.publish))
+            except FileNotFoundError:
+                parser.error('Config file not found')
+            except PathIsDirException:
+                parser.error('File expected, directory found')
+
+        rip(rip_dir, args.drives.split(',') if args.drives else None, args.label, publish)
 
     elif args.list:
         if not handbrake.check_env():
@@ -406,9 +537,6 @@ def drm_main():
         list_titles(list_dir, list_rip_config, fixes)
 
     elif args.prop:
-        if not mkvpropedit_check():
-            parser.error('mkvpropedit not found! Please install mkvpropedit')
-
         if not os.path.isdir(args.prop):
             parser.error('Directory expected')
         set_properties(args.prop)
@@ -0,0 +1,99 @@
+import threading
+import hashlib
+import logging
+import json
+import os
+
+
+logger = logging.getLogger('drm')
+
+
+HASH_HEAD_SIZE = 1024 * 1024        # in bytes; contains the volume descriptors of the image
+HASH_SAMPLE_SIZE = 64 * 1024        # in bytes
+HASH_SAMPLES = 16
+
+
+def image_hash(path):
+    """Returns a hash of the image content. Only the head of the image and
+    HASH_SAMPLES blocks spread over the image are read, so this is cheap even
+    for big images, but still tells different discs apart."""
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as fd:
+        h.update(fd.read(HASH_HEAD_SIZE))
+        for i in range(HASH_SAMPLES):
+            fd.seek(size * i // HASH_SAMPLES)
+            h.update(fd.read(HASH_SAMPLE_SIZE))
+    return h.hexdigest()
+
+
+def settings_key(job, any_preset=False):
+    """Returns a key for all settings, that change the encoded output. With
+    any_preset, the x264 preset is left out, because it is chosen per job to
+    meet a deadline."""
+    hb_data = job.hb_config.dump_data()
+    if any_preset:
+        del hb_data['h264_preset']
+    settings = {'rip_config': job.rip_config.dump_data(), 'hb_config': hb_data,
+                'fixes': [fix.dump_data() for fix in job.fixes]}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache(object):
+    """Remembers, which output files were encoded from which image with
+    which settings, so jobs can be skipped, if their outputs still exist.
+
+    The cache is a JSON file of the form
+    {image hash: {settings key: {'handbrake': version, 'outputs': [{'title':
+    index, 'chapters': range, 'file': name, 'size': bytes}, ...]}, ...}, ...}
+
+    With any_preset (used with --deadline), entries match regardless of the
+    x264 preset."""
+
+    def __init__(self, path, any_preset=False):
+        self.path = path
+        self.any_preset = any_preset
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as fd:
+                self._data = json.load(fd)
+        except FileNotFoundError:
+            self._data = {}
+        except json.decoder.JSONDecodeError:
+            logger.error('Cache file %s is invalid, starting with an empty cache', path)
+            self._data = {}
+
+    def lookup(self, job, out_path):
+        """Returns the cached output entries of job, if all of them still
+        exist in out_path with the recorded size, otherwise None."""
+        key = settings_key(job, self.any_preset)
+        with self._lock:
+            entry = self._data.get(image_hash(job.disc.local_path), {}).get(key)
+        if entry is None:
+            return None
+
+        for output in entry['outputs']:
+            try:
+                if os.path.getsize(os.path.join(out_path, output['file'])) != output['size']:
+                    return None
+            except OSError:
+                return None
+        return entry['outputs']
+
+    def store(self, job, image, stats, out_path, handbrake_version=None):
+        """Records the outputs of job, given as encode stats, after they were
+        moved to out_path. image is the image hash of the job."""
+        outputs = []
+        for entry in stats:
+            try:
+                size = os.path.getsize(os.path.join(out_path, entry['path']))
+            except OSError:
+                continue
+            outputs.append({'title': entry['title'], 'chapters': entry['chapters'], 'file': entry['path'], 'size': size})
+
+        with self._lock:
+            self._data.setdefault(image, {})[settings_key(job, self.any_preset)] = {'handbrake': handbrake_version, 'outputs': outputs}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as fd:
+                json.dump(self._data, fd, indent=1)
+            os.replace(temp_path, self.path)
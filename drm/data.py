@@ -1,13 +1,17 @@
 import os
 import uuid
+import shutil
 import tempfile
+import datetime
 
 
 temp_dir = tempfile.TemporaryDirectory()
 
 
 class Job(object):
-    def __init__(self, disc, rip_config, hb_config, fixes):
+    __slots__ = ('disc', 'rip_config', 'hb_config', 'fixes', 'segment', 'recording', 'name', 'files', 'failures', '_temp_path')
+
+    def __init__(self, disc, rip_config, hb_config, fixes, segment=None, recording=None):
         if not isinstance(disc, Disc):
             raise ValueError()
         if not isinstance(rip_config, RipConfig):
@@ -19,13 +23,35 @@ class Job(object):
         self.rip_config = rip_config
         self.hb_config = hb_config
         self.fixes = fixes
+        # (title, (first chapter, last chapter)), if only a segment of a
+        # title is encoded, otherwise None
+        self.segment = segment
+        # EncodeConfig of a DVR recording, that is encoded with ffmpeg
+        # instead of HandBrake. disc is the recording dir then.
+        self.recording = recording
 
         self.name = str(uuid.uuid4())
-        self.temp_path = os.path.join(temp_dir.name, self.name)
-
         self.files = []
-
-        os.mkdir(self.temp_path)
+        self.failures = []
+
+        # The temp dir is only needed once output files are received, so it
+        # is created on first access instead of for every queued job.
+        self._temp_path = None
+
+    @property
+    def temp_path(self):
+        if self._temp_path is None:
+            temp_path = os.path.join(temp_dir.name, self.name)
+            os.mkdir(temp_path)
+            self._temp_path = temp_path
+        return self._temp_path
+
+    def remove_temp_path(self):
+        """Removes the temp dir with all received files, if it was created."""
+        if self._temp_path is not None:
+            shutil.rmtree(self._temp_path)
+            self._temp_path = None
+        self.files = []
 
     def __str__(self):
         return self.name
@@ -36,7 +62,8 @@ class Fix(object):
         'remove_duplicate_tracks': 'Tries to remove duplicate tracks, if there are the same length and directly after one another.',
         'reencode_audio': 'Reencode audio to mp3. Otherwise audio will be copied.',
         'split_every_chapters': 'Splits every title depending on the chapters. int for equal sized chunks, list of ints for different chunk lengths.',
-        'use_libdvdread': 'Use libdvdread instead of libdvdnav.'
+        'use_libdvdread': 'Use libdvdread instead of libdvdnav.',
+        'always_decomb': 'Always use the decomb filter, even if HandBrake detected no interlacing.'
     }
 
     def __init__(self, name, value):
@@ -65,6 +92,41 @@ class Fix(object):
         return cls(data['name'], data['value'])
 
 
+class Failure(object):
+    allowed_reasons = {
+        'scan_timeout': 'Scanning the image with HandBrake timed out.',
+        'scan_failed': 'HandBrake did not return a title set for the image.',
+        'encode_failed': 'HandBrakeCLI or ffmpeg exited with a non-zero exit code.',
+        'invalid_output': 'An output file is truncated or does not match the scanned title.',
+        'size_mismatch': 'The downloaded image size does not match the size sent by the master.',
+        'disk_full': 'No space left on the slave.',
+        'connection_failed': 'The connection to the master failed.',
+        'lease_expired': 'The slave stopped sending heartbeats.',
+        'unknown': 'The slave failed for an unknown reason.'
+    }
+
+    def __init__(self, reason, host=None, message='', timestamp=None):
+        if reason not in Failure.allowed_reasons:
+            reason = 'unknown'
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+
+        self.reason = reason
+        self.host = host
+        self.message = message
+        self.timestamp = timestamp
+
+    def __str__(self):
+        return self.reason
+
+    def dump_data(self):
+        return {'reason': self.reason, 'host': self.host, 'message': self.message}
+
+    @classmethod
+    def parse_data(cls, data):
+        return cls(data['reason'], data['host'], data['message'])
+
+
 class Chapter(object):
     def __init__(self, no, length):
         """
@@ -81,12 +143,26 @@ class Chapter(object):
             return False
         return (self.no == other.no) and (self.length == other.length)
 
+    def dump_data(self):
+        return {'no': self.no, 'length': self.length}
+
+    @classmethod
+    def parse_data(cls, data):
+        return cls(data['no'], data['length'])
+
 
 class Track(object):
     def __init__(self, index, lang):
         self.index = index
         self.lang = lang
 
+    def dump_data(self):
+        return {'index': self.index, 'lang': self.lang}
+
+    @classmethod
+    def parse_data(cls, data):
+        return cls(data['index'], data['lang'])
+
     def __eq__(self, other):
         if other is None:
             return False
@@ -106,6 +182,13 @@ class Title(object):
         self.a_tracks = []
         self.s_tracks = []
         self.chapters = []
+        self.width = None
+        self.height = None
+        self.crop = None                # (top, bottom, left, right) in pixels
+        self.interlaced = None          # None, if unknown
+        self.vts = None                 # title set and sector range of the title, if reported by HandBrake
+        self.blocks = None
+        self.fingerprint = None
 
     def __eq__(self, other):
         if other is None:
@@ -117,11 +200,44 @@ class Title(object):
         return ret.format(num=self.index, duration=self.duration, a_tracks=self.a_tracks,
                           s_tracks=self.s_tracks, chapter=len(self.chapters))
 
+    def dump_data(self):
+        return {'index': self.index, 'duration': self.duration.total_seconds(),
+                'a_tracks': [t.dump_data() for t in self.a_tracks],
+                's_tracks': [t.dump_data() for t in self.s_tracks],
+                'chapters': [c.dump_data() for c in self.chapters],
+                'width': self.width, 'height': self.height, 'crop': self.crop, 'interlaced': self.interlaced,
+                'fingerprint': self.fingerprint}
+
+    @classmethod
+    def parse_data(cls, data):
+        title = cls(data['index'])
+        title.duration = datetime.timedelta(seconds=data['duration'])
+        title.a_tracks = [Track.parse_data(t) for t in data['a_tracks']]
+        title.s_tracks = [Track.parse_data(t) for t in data['s_tracks']]
+        title.chapters = [Chapter.parse_data(c) for c in data['chapters']]
+        title.width = data['width']
+        title.height = data['height']
+        title.crop = tuple(data['crop']) if data['crop'] is not None else None
+        title.interlaced = data['interlaced']
+        title.fingerprint = data['fingerprint']
+        return title
+
 
 class Disc(object):
-    def __init__(self, local_path):
+    __slots__ = ('titles', 'local_path', '_size')
+
+    def __init__(self, local_path, size=None):
         self.titles = []
         self.local_path = local_path
+        self._size = size
+
+    @property
+    def size(self):
+        """Size of the image in bytes. Read from the file on first access,
+        unless given explicitly."""
+        if self._size is None:
+            self._size = os.path.getsize(self.local_path)
+        return self._size
 
     def __str__(self):
         ret = self. local_path
@@ -0,0 +1,364 @@
+import concurrent.futures
+import http.server
+import threading
+import tempfile
+import logging
+import json
+import math
+import os
+
+import requests
+
+from drm.util import popen_wrapper
+
+
+logger = logging.getLogger('drm')
+
+
+FFMPEG_BIN = 'ffmpeg'
+FFPROBE_BIN = 'ffprobe'
+
+concat_file_name = 'concat.mp4'
+segment_list_file_name = 'segments.txt'
+cfg_file_name = 'drm_dvr.cfg'
+output_file_name = 'out.mkv'
+
+CHUNK_SECONDS = 600                 # in seconds; longer cuts are split into chunks, that are encoded in parallel
+AUDIO_CODEC = 'copy'                # default of the audio_codec of drm_dvr.cfg
+AUDIO_BITRATE = '256k'              # used, if the audio is reencoded
+DEFAULT_WORKERS = 2
+CORES_PER_WORKER = 4                # cores of a slave per parallel ffmpeg process
+PUBLISH_TIMEOUT = 10                # in seconds
+
+
+class DvrError(Exception):
+    pass
+
+
+class EncodeConfig(object):
+    def __init__(self, path=None):
+        if path is None:
+            self.cutlist = []
+            self.crop = None
+            self.delogo = None
+            self.segments = []
+            self.audio_codec = AUDIO_CODEC
+        else:
+            with open(path, 'r') as fd:
+                data = json.load(fd)
+            self._load(data)
+            # Older versions of the cutlist editor drop the segments when
+            # saving the config, segments.txt still has them
+            list_path = os.path.join(os.path.dirname(path), segment_list_file_name)
+            if not self.segments and os.path.isfile(list_path):
+                self.segments = read_segment_list(list_path)
+
+    def _load(self, data):
+        self.cutlist = data['cutlist']
+        self.crop = data['crop']
+        self.delogo = data['delogo']
+        # Recordings initialized before segments were recorded use concat.mp4
+        self.segments = data.get('segments', [])
+        self.audio_codec = data.get('audio_codec', AUDIO_CODEC)
+
+    def dump_data(self):
+        return {'cutlist': self.cutlist, 'crop': self.crop, 'delogo': self.delogo, 'segments': self.segments,
+                'audio_codec': self.audio_codec}
+
+    @classmethod
+    def parse_data(cls, data):
+        cfg = cls()
+        cfg._load(data)
+        return cfg
+
+    def dumps(self):
+        return json.dumps(self.dump_data(), indent=2)
+
+
+def probe_duration(path):
+    """Returns the duration of a media file in seconds or None."""
+    cmd = [FFPROBE_BIN, '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', path]
+    (retval, stdout, stderr) = popen_wrapper(cmd)
+    if retval:
+        return None
+    try:
+        return float(stdout.strip())
+    except ValueError:
+        return None
+
+
+def parse_time(value):
+    """Returns the seconds of a cutlist time given as seconds or as
+    '[HH:]MM:SS[.ms]'."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_segments(cfg):
+    """Returns [(file name, duration), ...] of the recording. The duration of
+    concat.mp4 of old recordings is unknown, but it is the only file."""
+    if cfg.segments:
+        return [(name, duration) for (name, duration) in cfg.segments]
+    return [(concat_file_name, float('inf'))]
+
+
+def map_cutlist(cfg):
+    """Maps the cuts, which are times of the whole recording, to
+    [(file name, inpoint, outpoint), ...] of the segment files. Cuts across
+    segment boundaries are split."""
+    ret = []
+    segments = get_segments(cfg)
+    for cut in cfg.cutlist:
+        (start, end) = (parse_time(cut[0]), parse_time(cut[1]))
+        offset = 0.0
+        for (name, duration) in segments:
+            inpoint = max(start - offset, 0.0)
+            outpoint = min(end - offset, duration)
+            if outpoint > inpoint:
+                ret.append((name, inpoint, outpoint))
+            offset += duration
+    return ret
+
+
+def recording_files(cfg):
+    """Returns the names of the stream files, that contain cuts. Files with
+    only ads are not needed for encoding."""
+    names = []
+    for (name, _, _) in map_cutlist(cfg):
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def cut_seconds(cfg):
+    """Returns the length of the encoded recording in seconds."""
+    return sum(outpoint - inpoint for (_, inpoint, outpoint) in map_cutlist(cfg))
+
+
+def write_concat_list(list_path, entries):
+    """Writes a list for the ffmpeg concat demuxer. entries are (file name,
+    inpoint or None, outpoint or None, duration or None)."""
+    with open(list_path, 'w') as fd:
+        for (name, inpoint, outpoint, duration) in entries:
+            fd.write('file \'{}\'\n'.format(name))
+            if duration is not None:
+                fd.write('duration {}\n'.format(duration))
+            if inpoint:
+                fd.write('inpoint {}\n'.format(inpoint))
+            if outpoint is not None:
+                fd.write('outpoint {}\n'.format(outpoint))
+
+
+def read_segment_list(list_path):
+    """Returns [[file name, duration], ...] from a list written by
+    write_concat_list() with the durations of all files. Returns an empty
+    list, if a duration is missing."""
+    segments = []
+    with open(list_path, 'r') as fd:
+        for line in fd:
+            (key, _, value) = line.strip().partition(' ')
+            if key == 'file':
+                segments.append([value.strip('\''), None])
+            elif key == 'duration' and segments:
+                segments[-1][1] = float(value)
+    if any(duration is None for (_, duration) in segments):
+        logger.warning('Durations missing in %s', list_path)
+        return []
+    return segments
+
+
+def build_ffmpeg_filter(cfg, verbose):
+    filter_cmd = []
+
+    if cfg.delogo:
+        if verbose:
+            filter_cmd.append('delogo=show=1:x={}:y={}:w={}:h={}'.format(cfg.delogo[0], cfg.delogo[1], cfg.delogo[2], cfg.delogo[3]))
+        else:
+            filter_cmd.append('delogo=show=0:x={}:y={}:w={}:h={}'.format(cfg.delogo[0], cfg.delogo[1], cfg.delogo[2], cfg.delogo[3]))
+
+    if cfg.crop:
+        filter_cmd.append('crop=in_w-{}:in_h-{}'.format(cfg.crop[0], cfg.crop[1]))
+
+    if filter_cmd:
+        return ['-vf', '{}'.format(', '.join(filter_cmd))]
+    else:
+        return []
+
+
+def split_chunks(pieces):
+    """Splits the pieces (file name, inpoint, outpoint) into chunks of at
+    most CHUNK_SECONDS."""
+    ret = []
+    for (name, inpoint, outpoint) in pieces:
+        count = math.ceil((outpoint - inpoint) / CHUNK_SECONDS)
+        length = (outpoint - inpoint) / count
+        for i in range(count):
+            ret.append((name, inpoint + i * length, length))
+    return ret
+
+
+def encode_chunk(cfg, path, chunk, out_path, threads):
+    """Encodes the video of one chunk (file name, start, length) of a stream
+    file. Seeking before the input decodes from the previous key frame, so
+    the chunk starts exactly at start."""
+    (name, start, length) = chunk
+    cmd = [FFMPEG_BIN, '-nostdin', '-ss', str(start), '-i', os.path.join(path, name), '-t', str(length)]
+    cmd += build_ffmpeg_filter(cfg, False)
+    cmd += ['-c:v', 'libx264', '-preset', 'slow', '-crf', '22', '-threads', str(threads), '-an', out_path]
+    (retval, stdout, stderr) = popen_wrapper(cmd)
+    return retval == 0
+
+
+def encode_audio(cfg, path, pieces, out_path):
+    """Cuts all audio streams of the pieces (file name, inpoint, outpoint)
+    in one pass, so the audio is continuous across the video chunks. The
+    audio is copied, unless another audio_codec is configured. Every audio
+    packet is a key frame, so copied audio is cut at the packet closest to
+    every cut."""
+    list_path = out_path + '.txt'
+    write_concat_list(list_path, [(os.path.join(path, name), inpoint, outpoint, None) for (name, inpoint, outpoint) in pieces])
+    cmd = [FFMPEG_BIN, '-nostdin', '-f', 'concat', '-safe', '0', '-i', list_path, '-map', '0:a', '-c:a', cfg.audio_codec]
+    if cfg.audio_codec != 'copy':
+        cmd += ['-b:a', AUDIO_BITRATE]
+    cmd.append(out_path)
+    (retval, stdout, stderr) = popen_wrapper(cmd)
+    return retval == 0
+
+
+def default_workers():
+    """Returns the number of chunks encoded in parallel on this machine."""
+    return max((os.cpu_count() or 1) // CORES_PER_WORKER, DEFAULT_WORKERS)
+
+
+def encode_recording(cfg, path, out_path, workers=DEFAULT_WORKERS):
+    """Encodes the cuts of the stream files in path to out_path. Raises
+    DvrError, if ffmpeg fails."""
+    # The cuts are read directly from the segment files and the video is
+    # encoded in chunks by parallel ffmpeg processes, that share the cores.
+    # The audio of all cuts is cut in one pass next to them.
+    pieces = map_cutlist(cfg)
+    chunks = split_chunks(pieces)
+    if not chunks:
+        raise DvrError('Cutlist of {} is empty'.format(path))
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(out_path)) as temp_dir:
+        part_paths = [os.path.join(temp_dir, 'part{:04}.mkv'.format(i)) for i in range(len(chunks))]
+        audio_path = os.path.join(temp_dir, 'audio.mka')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            audio = executor.submit(encode_audio, cfg, path, pieces, audio_path)
+            results = list(executor.map(lambda args: encode_chunk(cfg, path, *args, threads), zip(chunks, part_paths)))
+        if not all(results):
+            raise DvrError('ffmpeg failed for {} of {} chunks of {}'.format(results.count(False), len(results), path))
+        if not audio.result():
+            raise DvrError('ffmpeg failed to cut the audio of {}'.format(path))
+
+        # Every chunk starts with a key frame, so the parts are joined
+        # without reencoding and muxed with the audio
+        part_list_path = os.path.join(temp_dir, 'parts.txt')
+        write_concat_list(part_list_path, [(part_path, None, None, None) for part_path in part_paths])
+        cmd = [FFMPEG_BIN, '-nostdin', '-f', 'concat', '-safe', '0', '-i', part_list_path, '-i', audio_path,
+               '-map', '0:v', '-map', '1:a', '-c', 'copy', out_path]
+        (retval, stdout, stderr) = popen_wrapper(cmd)
+
+    if retval:
+        raise DvrError('ffmpeg failed to join the chunks to {}'.format(out_path))
+
+
+class SegmentServer(object):
+    """Serves the stream files of a recording over HTTP as one file, so the
+    cutlist editor can play the whole recording without a concatenated copy.
+    The stream files are MPEG transport streams, which can be joined by
+    appending them. Range requests are supported, so the player can seek."""
+
+    def __init__(self, path, segments):
+        self.files = [(os.path.join(path, name), os.path.getsize(os.path.join(path, name))) for (name, _) in segments]
+        self.size = sum(size for (_, size) in self.files)
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_range(False)
+
+            def do_GET(self):
+                self.send_range(True)
+
+            def send_range(self, send_body):
+                (start, end) = (0, server.size - 1)
+                requested = self.headers.get('Range', '')
+                if requested.startswith('bytes='):
+                    (first, _, last) = requested[len('bytes='):].split(',')[0].partition('-')
+                    if first:
+                        start = int(first)
+                        end = min(int(last), end) if last else end
+                    elif last:
+                        start = max(server.size - int(last), 0)
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */{}'.format(server.size))
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, server.size))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'video/mp2t')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                if send_body:
+                    try:
+                        server.copy(self.wfile, start, end + 1)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # The player seeks by dropping the connection
+                        pass
+
+            def log_message(self, format, *args):
+                logger.debug('Segment server: ' + format, *args)
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/recording.ts'.format(self._httpd.server_address[1])
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def copy(self, out, start, end):
+        """Writes the bytes start to end of the joined stream files to out."""
+        offset = 0
+        for (file_path, size) in self.files:
+            if start < offset + size and end > offset:
+                with open(file_path, 'rb') as fd:
+                    fd.seek(max(start - offset, 0))
+                    left = min(end, offset + size) - max(start, offset)
+                    while left > 0:
+                        data = fd.read(min(left, 1024 * 1024))
+                        if not data:
+                            break
+                        out.write(data)
+                        left -= len(data)
+            offset += size
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def publish_recording(ip, port, path):
+    """Queues the recording in path with a running master, so it is encoded
+    by a slave. Returns True, if the master accepted the recording."""
+    url = 'http://{ip}:{port}/recordings/'.format(ip=ip, port=port)
+    try:
+        r = requests.post(url, data={'path': os.path.abspath(path)}, timeout=PUBLISH_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logger.warning('Publishing %s to master at %s:%s failed (%s)', path, ip, port, e)
+        return False
+    if r.status_code != 200:
+        logger.warning('Master at %s:%s rejected %s (%s)', ip, port, path, r.text.strip())
+        return False
+    logger.info('Published %s to master at %s:%s', path, ip, port)
+    return True
@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import struct
+
+
+logger = logging.getLogger('drm')
+
+
+SECTOR_SIZE = 2048                  # in bytes
+FINGERPRINT_SAMPLES = 8             # sampled sectors per title
+MAX_SAMPLE_SKIP = 4                 # sectors tried after a sample position to find a non navigation pack
+MAX_DIR_SIZE = 1024 * 1024          # in bytes; upper bound for directories read from the image
+
+
+class ImageError(Exception):
+    pass
+
+
+def _read_sectors(fd, sector, count=1):
+    fd.seek(sector * SECTOR_SIZE)
+    return fd.read(count * SECTOR_SIZE)
+
+
+def _iter_dir(fd, extent, size):
+    """Yields (name, extent, size) for all entries of an ISO 9660 directory."""
+    data = _read_sectors(fd, extent, (min(size, MAX_DIR_SIZE) + SECTOR_SIZE - 1) // SECTOR_SIZE)
+    pos = 0
+    while pos < len(data):
+        length = data[pos]
+        if length == 0:
+            # Records don't cross sector boundaries, the rest is padding
+            pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+            continue
+        (entry_extent,) = struct.unpack_from('<I', data, pos + 2)
+        (entry_size,) = struct.unpack_from('<I', data, pos + 10)
+        name_len = data[pos + 32]
+        name = data[pos + 33:pos + 33 + name_len].decode('ascii', 'replace').split(';')[0]
+        yield (name, entry_extent, entry_size)
+        pos += length
+
+
+def find_file(fd, path):
+    """Returns the first sector of a file in an ISO 9660 image, e.g.
+    'VIDEO_TS/VTS_01_1.VOB'. DVD images contain an ISO 9660 file system next
+    to UDF."""
+    pvd = _read_sectors(fd, 16)
+    if pvd[1:6] != b'CD001':
+        raise ImageError('No ISO 9660 file system found')
+    (extent,) = struct.unpack_from('<I', pvd, 156 + 2)
+    (size,) = struct.unpack_from('<I', pvd, 156 + 10)
+
+    for part in path.split('/'):
+        for (name, entry_extent, entry_size) in _iter_dir(fd, extent, size):
+            if name.upper() == part.upper():
+                (extent, size) = (entry_extent, entry_size)
+                break
+        else:
+            raise ImageError('{} not found in image'.format(path))
+    return extent
+
+
+def _sample(fd, sector):
+    """Returns the payload of the first sector at or after sector, that is no
+    navigation pack. Navigation packs contain sector addresses, which differ
+    for the same content on different discs. The pack header is skipped for
+    the same reason."""
+    for i in range(MAX_SAMPLE_SKIP):
+        data = _read_sectors(fd, sector + i)
+        if data[14:18] != b'\x00\x00\x01\xbb':
+            return data[14:]
+    return data[14:]
+
+
+def title_fingerprint(fd, title, vob_start):
+    """Returns a fingerprint of the title from its duration, its chapter
+    structure and samples of its video content."""
+    h = hashlib.sha256()
+    h.update(str(int(title.duration.total_seconds())).encode())
+    h.update(','.join(str(c.length) for c in title.chapters).encode())
+
+    (start, end) = title.blocks
+    for i in range(FINGERPRINT_SAMPLES):
+        h.update(_sample(fd, vob_start + start + (end - start) * i // FINGERPRINT_SAMPLES))
+    return h.hexdigest()
+
+
+def fingerprint_titles(in_path, titles):
+    """Sets the fingerprint of all titles, for which HandBrake reported the
+    title set and sector range. Titles without one are never treated as
+    duplicates."""
+    vob_starts = {}
+    try:
+        with open(in_path, 'rb') as fd:
+            for title in titles:
+                if title.vts is None or title.blocks is None:
+                    continue
+                if title.vts not in vob_starts:
+                    vob_starts[title.vts] = find_file(fd, 'VIDEO_TS/VTS_{:02}_1.VOB'.format(title.vts))
+                title.fingerprint = title_fingerprint(fd, title, vob_starts[title.vts])
+    except (OSError, ImageError) as e:
+        logger.warning('Could not fingerprint titles of %s (%s)', in_path, e)
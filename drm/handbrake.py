@@ -1,9 +1,12 @@
 import os
+import re
 import sys
 import json
+import subprocess
 import time
 import datetime
 import logging
+import functools
 
 from drm.data import Title, Track, Chapter
 from drm.util import popen_wrapper
@@ -13,6 +16,14 @@ logger = logging.getLogger('drm')
 
 
 HANDBRAKE_CLI_BIN = 'HandBrakeCLI'
+SCAN_TIMEOUT = 60                   # in seconds
+
+
+class HandbrakeError(Exception):
+    """Raised if HandBrake fails. reason is one of Failure.allowed_reasons."""
+    def __init__(self, reason, msg):
+        super().__init__(msg)
+        self.reason = reason
 
 
 def check_env():
@@ -24,6 +35,17 @@ def check_env():
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def get_version():
+    """Returns the version string of HandBrakeCLI, e.g. '1.3.1', or None."""
+    try:
+        (retval, stdout, stderr) = popen_wrapper([HANDBRAKE_CLI_BIN, '--version'])
+    except FileNotFoundError:
+        return None
+    match = re.search(r'HandBrake (\S+)', stdout)
+    return match.group(1) if match else None
+
+
 def scan_disc(disc_path, use_libdvdread=False):
     # TODO: detect if disc_path does not exist
     # TODO: accept disc as argument
@@ -38,21 +60,28 @@ def scan_disc(disc_path, use_libdvdread=False):
         cmd.extend(['--no-dvdnav'])
 
     try:
-        (retval, stdout, stderr) = popen_wrapper(cmd, timeout=60)
-    except TimeoutExpired:
-        logger.error('Scanning failed (timeout)')
-        return []
+        (retval, stdout, stderr) = popen_wrapper(cmd, timeout=SCAN_TIMEOUT)
+    except subprocess.TimeoutExpired as e:
+        raise HandbrakeError('scan_timeout', 'Scanning failed (timeout)') from e
 
     if stdout.find(title_list_key) == -1:
-        logger.error('Scanning failed (no title set output)')
-        return []
+        raise HandbrakeError('scan_failed', 'Scanning failed (no title set output)')
 
     stdout = stdout[stdout.find(title_list_key) + len(title_list_key):]
     data = json.loads(stdout)
+    blocks = _parse_title_blocks(stderr)
     titles = []
     for title in data['TitleList']:
         title_temp = Title(int(title['Index']))
         title_temp.duration = datetime.timedelta(hours=title['Duration']['Hours'], minutes=title['Duration']['Minutes'], seconds=title['Duration']['Seconds'])
+        if 'Geometry' in title:
+            title_temp.width = title['Geometry']['Width']
+            title_temp.height = title['Geometry']['Height']
+        # HandBrake analyses preview frames of every title while scanning
+        if 'Crop' in title:
+            title_temp.crop = tuple(title['Crop'])
+        if 'InterlaceDetected' in title:
+            title_temp.interlaced = title['InterlaceDetected']
         for a_track_idx, a_track in enumerate(title['AudioList']):
             title_temp.a_tracks.append(Track(a_track_idx + 1, a_track['LanguageCode']))
         for s_track_idx, s_track in enumerate(title['SubtitleList']):
@@ -60,10 +89,29 @@ def scan_disc(disc_path, use_libdvdread=False):
         for chapter_idx, chapter in enumerate(title['ChapterList']):
             chapter_length = chapter['Duration']['Hours'] * 3600 + chapter['Duration']['Minutes'] * 60 + chapter['Duration']['Seconds']
             title_temp.chapters.append(Chapter(chapter_idx + 1, chapter_length))
+        if title_temp.index in blocks:
+            (title_temp.vts, title_temp.blocks) = blocks[title_temp.index]
         titles.append(title_temp)
     return titles
 
 
+def _parse_title_blocks(stderr):
+    """Returns {title index: (vts, (first block, last block)), ...} from the
+    scan log of HandBrake. Blocks are sectors relative to the first VOB of
+    the title set."""
+    ret = {}
+    index = None
+    for line in stderr.splitlines():
+        match = re.search(r'scan: scanning title (\d+)', line)
+        if match:
+            index = int(match.group(1))
+            continue
+        match = re.search(r'scan: vts=(\d+), ttn=\d+, cells \d+->\d+, blocks (\d+)->(\d+)', line)
+        if match and index is not None:
+            ret[index] = (int(match.group(1)), (int(match.group(2)), int(match.group(3))))
+    return ret
+
+
 def filter_titles(title_list, min_time, max_time, a_lang_list, s_lang_list):
     iso639_alt_lut = {
         'alb': 'sqi', 'arm': 'hye', 'baq': 'eus', 'bod': 'tib', 'bur': 'mya',
@@ -89,7 +137,8 @@ def filter_titles(title_list, min_time, max_time, a_lang_list, s_lang_list):
 
 
 def _build_cmd_line(input_file, output, title, a_tracks, s_tracks, preset=None, quality=20,
-                    h264_preset='medium', h264_profile='high', h264_level='4.1', chapters=None, reencode_audio=False, use_libdvdread=False):
+                    h264_preset='medium', h264_profile='high', h264_level='4.1', chapters=None, reencode_audio=False, use_libdvdread=False,
+                    crop=None, deinterlace=True):
     if h264_preset not in ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo']:
         raise Exception('Preset invalid')
     if h264_profile not in ['baseline', 'main', 'high', 'high10', 'high422', 'high444']:
@@ -119,7 +168,14 @@ def _build_cmd_line(input_file, output, title, a_tracks, s_tracks, preset=None,
     cmd.extend(['--audio-fallback', 'ffac3'])
     cmd.extend(['--loose-anamorphic'])
     cmd.extend(['--modulus', '2'])
-    cmd.extend(['--decomb'])
+    if crop is not None:
+        # Crop detected while scanning. HandBrake still scans the title before
+        # encoding, but with a fixed crop it only needs a single preview
+        # instead of decoding the default 10 for autocrop.
+        cmd.extend(['--crop', '{}:{}:{}:{}'.format(*crop)])
+        cmd.extend(['--previews', '1:0'])
+    if deinterlace:
+        cmd.extend(['--decomb'])
     cmd.extend(['--x264-preset', h264_preset])
     cmd.extend(['--x264-profile', h264_profile])
     cmd.extend(['--h264-level', h264_level])
@@ -130,7 +186,19 @@ def _build_cmd_line(input_file, output, title, a_tracks, s_tracks, preset=None,
     return cmd
 
 
-def _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=None):
+def _parse_fps(stdout, stderr):
+    """Returns the average encoding speed from the HandBrakeCLI output or
+    None."""
+    match = re.search(r'average encoding speed for job is ([0-9.]+) fps', stderr)
+    if match is None:
+        matches = re.findall(r'avg ([0-9.]+) fps', stdout)
+        if not matches:
+            return None
+        return float(matches[-1])
+    return float(match.group(1))
+
+
+def _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=None, stats=None):
     title_path = ''
     if chapters is None:
         logger.info('Encoding title {}'.format(title.index))
@@ -153,14 +221,32 @@ def _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapte
     cmd = _build_cmd_line(in_path, title_out_path, title.index, title.a_tracks, title.s_tracks,
                           quality=hb_config.quality, h264_preset=hb_config.h264_preset,
                           h264_profile=hb_config.h264_profile, h264_level=hb_config.h264_level,
-                          chapters=chapters, reencode_audio=reencode_audio, use_libdvdread=use_libdvdread)
+                          chapters=chapters, reencode_audio=reencode_audio, use_libdvdread=use_libdvdread,
+                          crop=title.crop, deinterlace=title.interlaced is not False or 'always_decomb' in fixes)
 
+    time_started = time.time()
     (retval, stdout, stderr) = popen_wrapper(cmd)
+    time_done = time.time()
+
+    if retval != 0:
+        raise HandbrakeError('encode_failed', 'Encoding title {} failed ({})'.format(title.index, retval))
+
+    if stats is not None:
+        if chapters is None:
+            duration = title.duration.total_seconds()
+        else:
+            duration = sum(c.length for c in title.chapters if chapters[0] <= c.no <= chapters[1])
+        stats.append({'title': title.index, 'chapters': chapters, 'path': title_path,
+                      'start': time_started, 'end': time_done, 'duration': duration,
+                      'fps': _parse_fps(stdout, stderr)})
 
     return title_path
 
 
-def encode_titles(hb_config, rip_config, fixes, titles, in_path, out_path):
+def encode_titles(hb_config, rip_config, fixes, titles, in_path, out_path, stats=None):
+    """Encodes all titles and returns the output file names. If stats is a
+    list, a dict with timing information is appended for every output
+    file."""
     ret = []
 
     # Special case fix 'split_every_chapters'
@@ -171,7 +257,7 @@ def encode_titles(hb_config, rip_config, fixes, titles, in_path, out_path):
                 no_chapters = len(title.chapters)
                 split_step = fixes['split_every_chapters']
                 for i in range(1, no_chapters + 1, split_step):
-                    title_path = _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=(i, i + split_step - 1))
+                    title_path = _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=(i, i + split_step - 1), stats=stats)
                     ret.append(title_path)
 
         elif isinstance(fixes['split_every_chapters'], list):
@@ -185,7 +271,7 @@ def encode_titles(hb_config, rip_config, fixes, titles, in_path, out_path):
 
             for title in titles:
                 for chunk in chunk_tuples:
-                    title_path = _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=chunk)
+                    title_path = _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=chunk, stats=stats)
                     ret.append(title_path)
 
         else:
@@ -196,12 +282,18 @@ def encode_titles(hb_config, rip_config, fixes, titles, in_path, out_path):
 
     # Normal case
     for title in titles:
-        title_path = _encode_title(hb_config, rip_config, fixes, in_path, out_path, title)
+        title_path = _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, stats=stats)
         ret.append(title_path)
 
     return ret
 
 
+def encode_segment(hb_config, rip_config, fixes, title, chapters, in_path, out_path, stats=None):
+    """Encodes the chapters (first, last) of a title and returns the output
+    file name."""
+    return _encode_title(hb_config, rip_config, fixes, in_path, out_path, title, chapters=chapters, stats=stats)
+
+
 def _tracks_to_csl(track_list):
     return ','.join([str(track.index) for track in track_list])
 
@@ -2,31 +2,180 @@ import threading
 import datetime
 import logging
 import shutil
+import queue
 import json
 import time
 import os
 
-from flask import Flask, Response, request, render_template, send_from_directory
+from flask import Flask, Response, request, render_template, send_from_directory, g
+from werkzeug.wsgi import ClosingIterator
 import requests
 
 import drm
-from drm.data import HandbrakeConfig, RipConfig
+import drm.slave as slave
+from drm.data import HandbrakeConfig, RipConfig, Title, Disc, Job
+from drm.store import JobStore, dispatch_policies
+from drm.predict import ThroughputModel
+from drm.cache import ResultCache, image_hash
+from drm.split import SplitTitle, split_chapters
+import drm.handbrake as handbrake
+import drm.dvr as dvr
+from drm.metrics import Registry
+from drm.trace import Tracer
 
 
 logger = logging.getLogger('drm')
 
-HEARTBEAT_CHECK_PERIOD = 10         # in seconds
-HEARTBEAT_TIMEOUT_PERIOD = 30       # in seconds
+HEARTBEAT_CHECK_PERIOD = 1          # in seconds; upper bound between lease expiry checks
+HEARTBEAT_TIMEOUT_PERIOD = 30       # in seconds; default lease length
+MAX_LEASE_PERIOD = 3600             # in seconds; upper bound for lease lengths requested by slaves
+RETRY_PERIOD = 30                   # in seconds; slaves ask again after this time if no job is pending
+LOCAL_RENEW_PERIOD = 10             # in seconds; lease renewal of local workers
+LOCAL_RETRY_PERIOD = 5              # in seconds; local workers ask again after this time if no job is pending
+FINALIZE_WORKERS = 2                # threads moving output files and images to out_path
 
 flask_app = Flask('drm')
 
 hb_config = HandbrakeConfig()
 rip_config = RipConfig()
 fixes = []
+in_path = None
 out_path = '.'
-job_queue = []
-working_queue = {}                  # Format: {job: (host, timestamp), ...}
-done_queue = []
+trace_path = None
+follow = False                      # keep running, when all jobs are done, to wait for published images
+published = set()                   # paths of all queued images, so an image is not queued twice
+published_lock = threading.Lock()
+scanned_titles = {}                 # Format: {job: [title, ...], ...}; titles scanned before the job was queued, guarded by published_lock
+on_disc_done = None                 # called with (job, output file names or None), once an image is done or quarantined
+deadline = None
+result_cache = None
+title_claims = {}                   # Format: {fingerprint: (job, title index), ...}
+deduplicated = {}                   # Format: {(job, title index): (original job, original title index, seconds), ...}
+title_claims_lock = threading.Lock()
+segment_seconds = None              # in seconds; titles longer than this are split, None to disable
+split_titles = {}                   # Format: {job: {title index: SplitTitle, ...}, ...}
+segments = {}                       # Format: {segment job: SplitTitle, ...}
+finished_jobs = {}                  # Format: {job: (stats, handbrake version), ...}; finished jobs with unjoined titles
+split_lock = threading.Lock()
+finalize_queue = queue.Queue()      # Format: (job, stats, handbrake version); completed jobs, whose files are not moved yet
+job_store = JobStore()
+tracer = Tracer()
+model = ThroughputModel()
+
+metrics = Registry()
+metric_jobs = metrics.gauge('drm_jobs', 'Number of jobs per state.', ('state',))
+metric_job_events = metrics.counter('drm_job_events_total', 'Number of leased, completed, requeued, failed, expired, quarantined and cancelled jobs.', ('event',))
+metric_failures = metrics.counter('drm_job_failures_total', 'Number of failures reported by slaves per reason.', ('slave', 'reason'))
+metric_bytes = metrics.counter('drm_transfer_bytes_total', 'Bytes served to (download) and received from (upload) slaves.', ('slave', 'direction'))
+metric_transfer_seconds = metrics.counter('drm_transfer_seconds_total', 'Time spent transferring files to and from slaves.', ('slave', 'direction'))
+metric_throughput = metrics.gauge('drm_transfer_throughput_bytes_per_second', 'Throughput of the last transfer to or from a slave.', ('slave', 'direction'))
+metric_request_duration = metrics.histogram('drm_request_duration_seconds', 'Latency of requests to the master.', ('endpoint', 'method'))
+metric_encode_fps = metrics.gauge('drm_slave_encode_fps', 'Average encoding speed of the last job of a slave.', ('slave',))
+metric_encoded_seconds = metrics.counter('drm_encoded_video_seconds_total', 'Seconds of video encoded per slave.', ('slave',))
+metric_encode_seconds = metrics.counter('drm_encode_seconds_total', 'Wall clock seconds spent encoding per slave.', ('slave',))
+metric_duplicate_titles = metrics.counter('drm_duplicate_titles_total', 'Number of titles skipped as duplicates of titles of other jobs.')
+metric_duplicate_seconds = metrics.counter('drm_duplicate_video_seconds_total', 'Seconds of video skipped as duplicates.')
+metric_finalize_queue = metrics.gauge('drm_finalize_queue', 'Number of completed jobs waiting for their files to be moved.')
+
+
+def collect_job_metrics():
+    for state, count in job_store.counts().items():
+        metric_jobs.set(count, state=state)
+    stats = job_store.get_stats()
+    for event in ['leased', 'completed', 'requeued', 'failed', 'expired', 'quarantined', 'cancelled']:
+        metric_job_events.set(stats.get(event, 0), event=event)
+    metric_finalize_queue.set(finalize_queue.qsize())
+
+
+metrics.add_collector(collect_job_metrics)
+
+
+def record_transfer(host_address, direction, size, duration):
+    metric_bytes.inc(size, slave=host_address, direction=direction)
+    metric_transfer_seconds.inc(duration, slave=host_address, direction=direction)
+    if duration > 0:
+        metric_throughput.set(size / duration, slave=host_address, direction=direction)
+
+
+def trace_requeued(job, reason):
+    tracer.end('leased', job, result=reason)
+    if len(job.failures) < job_store.max_job_failures:
+        tracer.begin('queued', job)
+
+
+def is_finished():
+    """Returns True, if all jobs are done and no further images are
+    expected."""
+    return not follow and job_store.is_finished()
+
+
+def notify_disc_done(job, outputs):
+    if on_disc_done is not None:
+        on_disc_done(job, outputs)
+
+
+def learn_encode_stats(job, host_address, stats):
+    # ffmpeg speeds of recordings say nothing about HandBrake
+    if job.recording is not None:
+        return
+    titles = [job.segment[0]] if job.segment is not None else job.disc.titles
+    heights = {t.index: t.height for t in titles}
+    for entry in stats:
+        model.observe(host_address, job.hb_config, heights.get(entry['title']), entry['duration'], entry['end'] - entry['start'])
+    # Segments only cover a part of the image
+    if stats and job.segment is None:
+        model.observe_disc(job.disc.size, sum(entry['duration'] for entry in stats))
+
+
+def predict_jobs(waiting, working):
+    """Returns ({job: predicted seconds left, ...}, predicted seconds until
+    all jobs are done)."""
+    now = datetime.datetime.now()
+    elapsed = {job: (now - timestamp).total_seconds() for job, (host, timestamp) in working.items()}
+    predictions = {}
+    for job in waiting:
+        predictions[job] = model.predict_job(job)
+    for job, (host, timestamp) in working.items():
+        predicted = model.predict_job(job, host)
+        predictions[job] = None if predicted is None else max(predicted - elapsed[job], 0.0)
+    queue_eta = model.predict_queue(waiting, {job: host for job, (host, timestamp) in working.items()}, elapsed)
+    return (predictions, queue_eta)
+
+
+def assign_preset(job):
+    """Picks the slowest x264 preset for job, with which all jobs are
+    predicted to be done by the deadline. Called for every lease, so the
+    choice follows the measured throughput of the slaves."""
+    (waiting, working, _, _) = job_store.snapshot()
+    now = datetime.datetime.now()
+    busy = {}
+    for other, (host, timestamp) in working.items():
+        predicted = model.predict_job(other, host)
+        if other is job or predicted is None:
+            continue
+        busy[host] = busy.get(host, 0.0) + max(predicted - (now - timestamp).total_seconds(), 0.0)
+
+    preset = model.select_preset(hb_config, [job] + waiting, busy, (deadline - now).total_seconds())
+    if preset != job.hb_config.h264_preset:
+        data = hb_config.dump_data()
+        data['h264_preset'] = preset
+        job.hb_config = HandbrakeConfig.parse_data(data)
+    logger.info('Using x264 preset %s for job %s', preset, job)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def record_encode_stats(host_address, stats):
+    fps = [s['fps'] for s in stats if s.get('fps')]
+    if fps:
+        metric_encode_fps.set(sum(fps) / len(fps), slave=host_address)
+    metric_encoded_seconds.inc(sum(s['duration'] for s in stats), slave=host_address)
+    metric_encode_seconds.inc(sum(s['end'] - s['start'] for s in stats), slave=host_address)
 
 
 def format_len_range_config(value):
@@ -42,19 +191,29 @@ def format_len_range_config(value):
 
 
 flask_app.jinja_env.filters['format_len_range_config'] = format_len_range_config
+flask_app.jinja_env.filters['format_duration'] = format_duration
 
 
-def get_working_job_by_id(job_id):
-    for job in working_queue:
-        if (job.name == str(job_id)):
-            return job
-    return None
+@flask_app.before_request
+def request_started():
+    g.request_started = time.perf_counter()
+
+
+@flask_app.after_request
+def request_done(response):
+    if request.url_rule is not None:
+        duration = time.perf_counter() - g.request_started
+        metric_request_duration.observe(duration, endpoint=request.url_rule.rule, method=request.method)
+    return response
 
 
 @flask_app.route('/', methods=['GET'])
 def status():
     generated_time = datetime.datetime.now().isoformat()
-    return render_template('status.html', waiting=job_queue, working=working_queue, done=done_queue, generated_time=generated_time, hb_config=hb_config, rip_config=rip_config, fixes=fixes)
+    (waiting, working, done, quarantined) = job_store.snapshot()
+    (predictions, queue_eta) = predict_jobs(waiting, working)
+    return render_template('status.html', waiting=waiting, working=working, done=done, quarantined=quarantined,
+                           predictions=predictions, queue_eta=queue_eta, deadline=deadline, deduplicated=get_deduplicated(), generated_time=generated_time, hb_config=hb_config, rip_config=rip_config, fixes=fixes)
 
 
 @flask_app.route('/shutdown', methods=['POST'])
@@ -66,113 +225,716 @@ def shutdown():
     return ''
 
 
+@flask_app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@flask_app.route('/trace', methods=['GET'])
+def get_trace():
+    return Response(json.dumps(tracer.export_chrome()), mimetype='application/json')
+
+
 @flask_app.route('/version', methods=['GET'])
 def version():
     return Response(json.dumps(drm.__version__), mimetype='application/json')
 
 
+def get_deduplicated():
+    """Returns a copy of deduplicated, that is safe to iterate."""
+    with title_claims_lock:
+        return dict(deduplicated)
+
+
+def claim_titles(job, titles):
+    """Registers the fingerprints of the titles of job and returns the
+    indices of titles, that are duplicates of titles of other jobs or of
+    other titles of the same job. Those are skipped by the slave."""
+    skip = []
+    with title_claims_lock:
+        for title in titles:
+            if title.fingerprint is None:
+                continue
+            claim = title_claims.get(title.fingerprint)
+            # Retried jobs claim their titles again, quarantined jobs lose them
+            if claim is None or claim == (job, title.index) or len(claim[0].failures) >= job_store.max_job_failures:
+                title_claims[title.fingerprint] = (job, title.index)
+                continue
+
+            skip.append(title.index)
+            if (job, title.index) not in deduplicated:
+                seconds = title.duration.total_seconds()
+                deduplicated[(job, title.index)] = (claim[0], claim[1], seconds)
+                metric_duplicate_titles.inc()
+                metric_duplicate_seconds.inc(seconds)
+                logger.info('Title %d of %s is a duplicate of title %d of %s', title.index, job.disc.local_path,
+                            claim[1], claim[0].disc.local_path)
+    return skip
+
+
+def release_titles(job):
+    """Logs the titles of other jobs, that were skipped as duplicates of
+    titles of the quarantined job. They are never encoded."""
+    with title_claims_lock:
+        lost = [(other, index) for (other, index), (original, _, _) in deduplicated.items() if original is job]
+        for key in lost:
+            (_, original_index, _) = deduplicated.pop(key)
+            logger.error('Title %d of %s is lost, it was skipped as a duplicate of title %d of quarantined %s',
+                         key[1], key[0].disc.local_path, original_index, job.disc.local_path)
+
+
+def split_long_titles(job, titles):
+    """Splits titles longer than segment_seconds into segment jobs and
+    returns the indices of the split titles, which are skipped by job."""
+    if segment_seconds is None or 'split_every_chapters' in job.fixes:
+        return []
+
+    with split_lock:
+        # Retried jobs split the same titles again, but keep the segments
+        if job in split_titles:
+            return list(split_titles[job])
+
+        split_titles[job] = {}
+        for title in titles:
+            ranges = split_chapters(title, segment_seconds)
+            if not ranges:
+                continue
+            split = SplitTitle(job, title, ranges)
+            split_titles[job][title.index] = split
+            for segment in split.segments:
+                segments[segment] = split
+            logger.info('Splitting title %d of %s into %d segments (chapters %s)', title.index, job.disc.local_path,
+                        len(ranges), ', '.join('{}-{}'.format(*r) for r in ranges))
+        new_segments = [segment for split in split_titles[job].values() for segment in split.segments]
+        ret = list(split_titles[job])
+
+    for segment in new_segments:
+        job_store.add(segment)
+        tracer.begin('queued', segment)
+    return ret
+
+
+def accept_titles(job, titles):
+    """Handles the titles found by the scan of job and returns the indices
+    of titles, that job should not encode itself."""
+    skip = claim_titles(job, titles)
+    skip += split_long_titles(job, [t for t in titles if t.index not in skip])
+    job.disc.titles = [t for t in titles if t.index not in skip]
+    return skip
+
+
+def lease_job(host_address):
+    """Leases the next job to host_address (a slave or a local worker) or
+    returns None."""
+    job = job_store.lease(host_address, HEARTBEAT_TIMEOUT_PERIOD)
+    if job is None:
+        return None
+
+    model.seen(host_address)
+    # Segments keep the settings of the job they were split from, so they
+    # can be joined
+    if deadline is not None and job.segment is None:
+        assign_preset(job)
+    logger.info('Job %s assigned to %s', job, host_address)
+    tracer.end('queued', job)
+    tracer.begin('leased', job, slave=host_address, preset=job.hb_config.h264_preset)
+    return job
+
+
+def finish_job(job, host_address, stats, handbrake_version=None):
+    """Completes job and queues it for finalize_thread, which moves the
+    output files in job.files and the image to out_path. Returns right away,
+    so slaves don't wait for files moved across file systems."""
+    # Remove job from working jobs first, so it can't time out while the
+    # files are moved
+    if not job_store.complete(job):
+        logger.warning('Job %s already done', job)
+        return
+
+    record_encode_stats(host_address, stats)
+    learn_encode_stats(job, host_address, stats)
+    tracer.end('leased', job, result='done')
+    tracer.begin('finalize_queued', job)
+    finalize_queue.put((job, stats, handbrake_version))
+
+
+def finalize_job(job, stats, handbrake_version):
+    """Moves the output files in job.files and the image to out_path and
+    records them in the result cache."""
+    try:
+        with tracer.span('finalize', job, files=len(job.files)):
+            if job.segment is not None:
+                finish_segment(job)
+            elif job.recording is not None:
+                finish_recording(job)
+            else:
+                move_files(job.files)
+                job.remove_temp_path()
+                with split_lock:
+                    finished_jobs[job] = (stats, handbrake_version)
+                finish_disc(job)
+    finally:
+        job_store.finalized(job)
+
+
+def finalize_thread():
+    while True:
+        (job, stats, handbrake_version) = finalize_queue.get()
+        tracer.end('finalize_queued', job)
+        try:
+            finalize_job(job, stats, handbrake_version)
+        except Exception:
+            logger.exception('Finalizing job %s failed', job)
+
+
+def move_files(files):
+    for f in files:
+        try:
+            shutil.move(f, out_path)
+        except shutil.Error:
+            logger.error('Output file {filename} already exists. Skipping file...'.format(filename=f))
+
+
+def finish_recording(job):
+    """Moves out.mkv to the recording dir, where drm_dvr.py --encode would
+    have written it. The stream files stay where they are."""
+    out_file = os.path.join(job.disc.local_path, dvr.output_file_name)
+    if not job.files:
+        logger.error('No output received for recording %s', job.disc.local_path)
+    elif os.path.exists(out_file):
+        logger.error('Output file {filename} already exists. Skipping file...'.format(filename=out_file))
+    else:
+        shutil.move(job.files[0], out_file)
+        logger.info('Encoded recording %s', job.disc.local_path)
+    job.remove_temp_path()
+
+
+def fail_split(split, segment):
+    """Gives up the split title of segment. The encoded segments are
+    discarded and the image is moved, once the job, the other segments and
+    the other split titles are done."""
+    with split_lock:
+        split.failed = True
+        split.settled.add(segment)
+        encoded = list(split.files)
+        split.files.clear()
+    for s in encoded + [segment]:
+        s.remove_temp_path()
+    finish_disc(split.job)
+
+
+def finish_segment(segment):
+    """Joins the segments of a split title, once all are encoded."""
+    with split_lock:
+        split = segments.get(segment)
+    if split is None:
+        # The job, the segment was split from, was quarantined
+        segment.remove_temp_path()
+        return
+    if not segment.files:
+        logger.error('No output received for segment %s of title %d of %s', segment.segment[1], split.title.index, split.job.disc.local_path)
+        fail_split(split, segment)
+        return
+    with split_lock:
+        failed = split.failed
+        if not failed:
+            complete = split.add_file(segment, segment.files[0])
+    if failed:
+        # Another segment failed, the title is never joined
+        fail_split(split, segment)
+        return
+    if not complete:
+        return
+
+    with tracer.span('join', split.job, title=split.title.index, segments=len(split.segments)):
+        try:
+            joined = split.join(split.segments[0].temp_path)
+        except OSError as e:
+            logger.error('%s', e)
+            fail_split(split, segment)
+            return
+    logger.info('Joined %d segments of title %d of %s', len(split.segments), split.title.index, split.job.disc.local_path)
+    move_files([joined])
+    for s in split.segments:
+        s.remove_temp_path()
+    finish_disc(split.job)
+
+
+def finish_disc(job):
+    """Moves the image of job to out_path and records the outputs in the
+    result cache, once job and all segments of its split titles are done.
+    Images with a title, that could not be joined, are moved without being
+    cached and reported as failed."""
+    with split_lock:
+        if job not in finished_jobs or not all(split.done for split in split_titles.get(job, {}).values()):
+            return
+        (stats, handbrake_version) = finished_jobs.pop(job)
+        splits = split_titles.pop(job, {})
+    forget_scanned_titles(job)
+
+    failed = any(split.failed for split in splits.values())
+    # Joined titles are recorded like titles encoded in one piece
+    stats = stats + [{'title': split.title.index, 'chapters': None, 'path': split.out_name} for split in splits.values() if split.joined]
+    image = image_hash(job.disc.local_path) if result_cache is not None and not failed else None
+    shutil.move(job.disc.local_path, out_path)
+    if failed:
+        notify_disc_done(job, None)
+        return
+    if result_cache is not None:
+        result_cache.store(job, image, stats, out_path, handbrake_version)
+    notify_disc_done(job, [entry['path'] for entry in stats])
+
+
+def cancel_segments(job):
+    """Cancels the segments of the titles split off the quarantined job and
+    forgets its split titles."""
+    with split_lock:
+        splits = split_titles.pop(job, {})
+        finished_jobs.pop(job, None)
+        job_segments = [s for split in splits.values() for s in split.segments]
+        for split in splits.values():
+            split.failed = True
+            split.files.clear()
+        for segment in job_segments:
+            segments.pop(segment, None)
+    for segment in job_store.cancel(job_segments):
+        logger.info('Cancelled segment %s of %s', segment.segment[1], job.disc.local_path)
+        tracer.end('queued', segment)
+        tracer.end('leased', segment, result='cancelled')
+    for segment in job_segments:
+        segment.remove_temp_path()
+
+
+def quarantine_job(job):
+    """Reports the image of job as failed, once job is quarantined."""
+    if job.segment is not None:
+        split = segments[job]
+        logger.error('Title %d of %s can not be joined, segment %s was quarantined', split.title.index, split.job.disc.local_path, job.segment[1])
+        fail_split(split, job)
+    else:
+        release_titles(job)
+        cancel_segments(job)
+        forget_scanned_titles(job)
+        notify_disc_done(job, None)
+
+
+def fail_job(job, host_address, reason, message):
+    outcome = job_store.fail(job, host_address, reason, message)
+    if outcome is None:
+        logger.warning('Ignoring failure of job %s on %s, the job is not leased to it (%s: %s)', job, host_address, reason, message)
+        return
+    metric_failures.inc(slave=host_address, reason=reason)
+    logger.error('Job %s failed on %s (%s: %s)', job, host_address, reason, message)
+    job.remove_temp_path()
+    trace_requeued(job, reason)
+    if outcome == 'quarantined':
+        quarantine_job(job)
+
+
 @flask_app.route('/jobs/', methods=['GET'])
+def get_scanned_titles(job):
+    """Returns the titles of job scanned before it was queued or None."""
+    with published_lock:
+        return scanned_titles.get(job)
+
+
+def forget_scanned_titles(job):
+    with published_lock:
+        scanned_titles.pop(job, None)
+
+
 def get_job():
     host_address = request.headers.get('X-Forwarded-For', request.remote_addr)
-    timestamp = datetime.datetime.now()
 
-    try:
-        job = job_queue.pop()
-        job_desc = json.dumps({'name': job.name, 'rip_config': job.rip_config.dump_data(), 'hb_config': job.hb_config.dump_data(), 'fixes': [fix.dump_data() for fix in job.fixes]})
-        working_queue[job] = (host_address, timestamp)
-        logger.info('Job %s assigned to %s', job, host_address)
-    except IndexError:
+    backoff = job_store.get_backoff(host_address)
+    if backoff > 0:
+        # Slave failed too often recently
+        return Response(json.dumps({'retry': backoff}), mimetype='application/json')
+
+    job = lease_job(host_address)
+    if job is not None:
+        segment = None
+        if job.segment is not None:
+            segment = {'title': job.segment[0].dump_data(), 'chapters': job.segment[1]}
+        recording = job.recording.dump_data() if job.recording is not None else None
+        titles = get_scanned_titles(job)
+        titles = [t.dump_data() for t in titles] if titles is not None else None
+        job_desc = json.dumps({'name': job.name, 'rip_config': job.rip_config.dump_data(), 'hb_config': job.hb_config.dump_data(), 'fixes': [fix.dump_data() for fix in job.fixes],
+                               'segment': segment, 'recording': recording, 'titles': titles})
+    elif not is_finished():
+        # Working jobs might still fail and be requeued, or new images be
+        # published
+        job_desc = json.dumps({'retry': RETRY_PERIOD})
+    else:
         # No more jobs available
         job_desc = json.dumps(None)
 
     return Response(job_desc, mimetype='application/json')
 
 
+def add_image(path):
+    """Queues a job for the image at path with the settings of the master,
+    unless it was queued before. Returns the job or None."""
+    job = Job(Disc(os.path.abspath(path)), rip_config, hb_config, fixes)
+    return job if add_job(job) else None
+
+
+def add_job(job):
+    """Queues job, while the master is running. Returns False, if the image
+    was queued before or its outputs are in the result cache."""
+    path = os.path.abspath(job.disc.local_path)
+    with published_lock:
+        if path in published:
+            return False
+        published.add(path)
+        # Images scanned by the pipeline are not scanned again
+        if job.disc.titles:
+            scanned_titles[job] = list(job.disc.titles)
+
+    # The result cache is keyed by the image content, recordings aren't cached
+    if result_cache is not None and job.recording is None and skip_cached_job(job):
+        return False
+    job_store.add(job)
+    tracer.begin('queued', job)
+    logger.info('Queued %s %s as job %s', 'recording' if job.recording is not None else 'image', path, job)
+    return True
+
+
+@flask_app.route('/images/', methods=['POST'])
+def publish_image():
+    """Queues an image, that was ripped while the master is running. The
+    image has to be in the input dir, so it can be moved to out_path, once
+    it is encoded."""
+    path = request.form.get('path', '')
+    if in_path is None or os.path.dirname(os.path.abspath(path)) != os.path.abspath(in_path):
+        return Response('Image not in input dir\n', status=400)
+    if not os.path.isfile(path):
+        return Response('Image not found\n', status=404)
+    if is_finished():
+        return Response('Master is shutting down\n', status=409)
+
+    job = add_image(path)
+    return Response(json.dumps({'name': job.name if job is not None else None}), mimetype='application/json')
+
+
+def add_recording(path):
+    """Queues a job for the DVR recording in the dir path, unless it was
+    queued before. Returns the job or None."""
+    path = os.path.abspath(path)
+    cfg = dvr.EncodeConfig(os.path.join(path, dvr.cfg_file_name))
+    # The size is used by the dispatch policies like the size of an image
+    size = sum(os.path.getsize(os.path.join(path, name)) for name in dvr.recording_files(cfg))
+    job = Job(Disc(path, size), rip_config, hb_config, fixes, recording=cfg)
+    return job if add_job(job) else None
+
+
+@flask_app.route('/recordings/', methods=['POST'])
+def publish_recording():
+    """Queues a DVR recording, that was initialized and cut with
+    drm_dvr.py. Slaves encode it with ffmpeg and out.mkv is written to the
+    recording dir."""
+    path = request.form.get('path', '')
+    if not os.path.isfile(os.path.join(path, dvr.cfg_file_name)):
+        return Response('Recording not found\n', status=404)
+    if os.path.exists(os.path.join(path, dvr.output_file_name)):
+        return Response('Recording already encoded\n', status=409)
+    if is_finished():
+        return Response('Master is shutting down\n', status=409)
+
+    try:
+        job = add_recording(path)
+    except (OSError, KeyError, ValueError) as e:
+        return Response('Recording is invalid ({})\n'.format(e), status=400)
+    return Response(json.dumps({'name': job.name if job is not None else None}), mimetype='application/json')
+
+
+def save_file(storage, path):
+    """Saves an uploaded file and syncs it to disk, so it is not lost, once
+    the slave got the response. Returns the size of the file."""
+    with open(path, 'wb') as fd:
+        storage.save(fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+        return fd.tell()
+
+
 @flask_app.route('/jobs/<uuid:job_id>', methods=['GET', 'POST'])
 def handle_job(job_id):
-    job = get_working_job_by_id(job_id)
+    job = job_store.get_working(job_id)
 
     if job is None:
         logger.warning('Job %s not found!', str(job_id))
         return ''
 
     host_address = request.headers.get('X-Forwarded-For', request.remote_addr)
-    timestamp = datetime.datetime.now()
 
     if request.method == 'POST':
         # Copy files
+        received = 0
         for f in request.files:
             logger.info('Copying %s from %s [%s]', f, host_address, job_id)
-            request.files[f].save(os.path.join(job.temp_path, f))
+            received += save_file(request.files[f], os.path.join(job.temp_path, f))
             job.files.append(os.path.join(job.temp_path, f))
+        if received:
+            duration = time.perf_counter() - g.request_started
+            record_transfer(host_address, 'upload', received, duration)
+            tracer.add('upload', job, time.time() - duration, time.time(), slave=host_address, bytes=received)
 
         # read status
         if (request.form['state'] == 'DONE'):
-            for f in job.files:
-                try:
-                    shutil.move(f, out_path)
-                except shutil.Error:
-                    logger.error('Output file {filename} already exists. Skipping file...'.format(filename=f))
-            shutil.rmtree(job.temp_path)
-            shutil.move(job.disc.local_path, out_path)
-
-            del working_queue[job]
-            done_queue.append(job)
+            tracer.add_data(json.loads(request.form.get('trace', '[]')))
+            finish_job(job, host_address, json.loads(request.form.get('stats', '[]')), request.form.get('handbrake') or None)
+        elif (request.form['state'] == 'FAILED'):
+            tracer.add_data(json.loads(request.form.get('trace', '[]')))
+            fail_job(job, host_address, request.form.get('reason', 'unknown'), request.form.get('message', ''))
         elif (request.form['state'] == 'WORKING'):
-            if working_queue[job][0] != host_address:
+            # Slaves may request longer leases, e.g. while uploading big files
+            try:
+                lease_period = min(float(request.form.get('lease', HEARTBEAT_TIMEOUT_PERIOD)), MAX_LEASE_PERIOD)
+            except ValueError:
+                lease_period = HEARTBEAT_TIMEOUT_PERIOD
+
+            if not job_store.renew(job, host_address, lease_period):
                 logger.error('Job response from unknown host')
-                del working_queue[job]
-                job_queue.append(job)
+                if job_store.requeue(job):
+                    trace_requeued(job, 'unknown_host')
                 return ''
 
-            working_queue[job] = (working_queue[job][0], timestamp)
+            model.seen(host_address)
+
+            # Slaves report the titles they are going to encode after
+            # scanning and skip duplicates and split titles
+            if 'titles' in request.form:
+                titles = [Title.parse_data(t) for t in json.loads(request.form['titles'])]
+                skip = accept_titles(job, titles)
+                return Response(json.dumps({'skip': skip}), mimetype='application/json')
 
         return ''
     else:
-        (dir_path, file_name) = os.path.split(os.path.abspath(job.disc.local_path))
-        return send_from_directory(dir_path, file_name, as_attachment=True)
+        return send_input_file(job, host_address, job.disc.local_path)
 
 
-def heartbeat_thread(ip, port):
-    while True:
-        time.sleep(HEARTBEAT_CHECK_PERIOD)
+@flask_app.route('/jobs/<uuid:job_id>/<file_name>', methods=['GET'])
+def get_recording_file(job_id, file_name):
+    """Sends a stream file of a recording. Only files with cuts are
+    sent."""
+    job = job_store.get_working(job_id)
+    if job is None or job.recording is None or file_name not in dvr.recording_files(job.recording):
+        logger.warning('File %s of job %s not found!', file_name, str(job_id))
+        return Response('File not found\n', status=404)
+
+    host_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+    return send_input_file(job, host_address, os.path.join(job.disc.local_path, file_name))
 
-        timestamp = datetime.datetime.now() - datetime.timedelta(seconds=HEARTBEAT_TIMEOUT_PERIOD)
 
-        job_timeout_list = []
+def send_input_file(job, host_address, path):
+    (dir_path, file_name) = os.path.split(os.path.abspath(path))
+    response = send_from_directory(dir_path, file_name, as_attachment=True)
 
-        for job in working_queue:
-            if working_queue[job][1] < timestamp:
-                logger.error('Job %s timed out', job)
-                job_timeout_list.append(job)
+    # The file is streamed after returning, so measure until the response is closed
+    size = os.path.getsize(path)
+    started = g.request_started
+    started_time = time.time()
 
-        for job in job_timeout_list:
-            del working_queue[job]
-            job_queue.append(job)
+    def download_done():
+        record_transfer(host_address, 'download', size, time.perf_counter() - started)
+        tracer.add('download', job, started_time, time.time(), slave=host_address, bytes=size)
 
-        if len(working_queue) == 0 and len(job_queue) == 0:
+    # File responses are passed through to the server, which only closes
+    # the body iterator, so the callback has to be attached there
+    response.response = ClosingIterator(response.response, [download_done])
+    return response
+
+
+def heartbeat_thread(ip, port):
+    while True:
+        # Sleep until the next lease deadline, but check at least every
+        # HEARTBEAT_CHECK_PERIOD for new leases and for shutdown
+        next_deadline = job_store.next_deadline()
+        if next_deadline is None or next_deadline > HEARTBEAT_CHECK_PERIOD:
+            next_deadline = HEARTBEAT_CHECK_PERIOD
+        time.sleep(next_deadline)
+
+        for (job, outcome) in job_store.expire():
+            logger.error('Job %s timed out', job)
+            trace_requeued(job, 'lease_expired')
+            if outcome == 'quarantined':
+                quarantine_job(job)
+
+        if is_finished():
+            (_, _, _, quarantined) = job_store.snapshot()
+            for job in quarantined:
+                logger.error('Job %s (%s) quarantined after failures: %s', job, job.disc.local_path, ', '.join(str(f) for f in job.failures))
+            skipped = get_deduplicated()
+            if skipped:
+                seconds = sum(seconds for (_, _, seconds) in skipped.values())
+                logger.info('Skipped %d duplicate titles (%s of video)', len(skipped), datetime.timedelta(seconds=int(seconds)))
+            if trace_path is not None:
+                logger.info('Writing trace to %s', trace_path)
+                tracer.write_chrome(trace_path)
             logger.info('No jobs left. Shutting down server...')
             url = 'http://{ip}:{port}/shutdown'.format(ip=ip, port=port)
             r = requests.post(url)
             return
 
 
-def master_start_server(ip, port, _job_queue, _out_path):
-    global job_queue
-    job_queue = _job_queue
+class LocalLease(object):
+    """Renews the lease of a job of a local worker, until the with block is
+    left."""
+    def __init__(self, job, host):
+        self.job = job
+        self.host = host
+        self.stopped = threading.Event()
+
+    def __renew_thread(self):
+        while not self.stopped.wait(LOCAL_RENEW_PERIOD):
+            if not job_store.renew(self.job, self.host, HEARTBEAT_TIMEOUT_PERIOD):
+                return
+
+    def __enter__(self):
+        self.t = threading.Thread(target=self.__renew_thread, daemon=True)
+        self.t.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.t.join()
+
+
+def process_local_job(job, host):
+    """Encodes job directly from the input dir. The output files are written
+    to the temp dir of the job, like files received from slaves."""
+    worker_tracer = Tracer(host)
+    try:
+        with LocalLease(job, host):
+            if job.recording is not None:
+                # Recordings are encoded straight from their dir
+                (out_list, stats) = slave.encode_recording(job.name, job.recording, job.disc.local_path, job.temp_path, worker_tracer)
+            else:
+                if job.segment is None:
+                    titles = get_scanned_titles(job)
+                    if titles is None:
+                        titles = slave.scan_titles(job.name, job.disc.local_path, job.rip_config, job.fixes, worker_tracer)
+                    skip = accept_titles(job, titles)
+                    titles = [t for t in titles if t.index not in skip]
+                    chapters = None
+                else:
+                    titles = [job.segment[0]]
+                    chapters = job.segment[1]
+                (out_list, stats) = slave.encode(job.name, job.disc.local_path, titles, job.rip_config, job.hb_config,
+                                                 job.fixes, job.temp_path, worker_tracer, chapters)
+    except slave.JobFailedError as e:
+        tracer.add_data(worker_tracer.dump_data())
+        fail_job(job, host, e.reason, str(e))
+        return
+    except Exception as e:
+        logger.exception('Local worker %s failed', host)
+        tracer.add_data(worker_tracer.dump_data())
+        fail_job(job, host, 'unknown', str(e))
+        return
+
+    tracer.add_data(worker_tracer.dump_data())
+    job.files = [os.path.join(job.temp_path, f) for f in out_list]
+    finish_job(job, host, stats, handbrake.get_version())
+
+
+def local_worker_thread(host):
+    while not is_finished():
+        backoff = job_store.get_backoff(host)
+        if backoff > 0:
+            time.sleep(backoff)
+            continue
+
+        job = lease_job(host)
+        if job is None:
+            # Working jobs might still fail and be requeued
+            time.sleep(LOCAL_RETRY_PERIOD)
+            continue
+
+        process_local_job(job, host)
+        logger.info('Job %s finished on %s', job, host)
+
+
+def skip_cached_job(job):
+    """Returns True, if the outputs of job are in the result cache. The
+    image is then moved to out_path, like that of a finished job."""
+    outputs = result_cache.lookup(job, out_path)
+    if outputs is None:
+        return False
+
+    logger.info('Skipping %s, %d outputs already encoded', job.disc.local_path, len(outputs))
+    try:
+        shutil.move(job.disc.local_path, out_path)
+    except shutil.Error:
+        logger.error('Image {filename} already exists. Skipping file...'.format(filename=job.disc.local_path))
+    notify_disc_done(job, [output['file'] for output in outputs])
+    return True
+
+
+def skip_cached_jobs(job_queue):
+    """Returns the jobs, whose outputs are not in the result cache."""
+    return [job for job in job_queue if not skip_cached_job(job)]
+
+
+def master_start_server(ip, port, _job_queue, _out_path, _trace_path=None, policy='lifo', _deadline=None, local_workers=0,
+                        cache_path=None, split_minutes=None, _in_path=None, _follow=False, configs=None):
     global out_path
     out_path = _out_path
-
-    if len(_job_queue) > 0:
-        global rip_config
+    global in_path
+    in_path = _in_path
+    global follow
+    follow = _follow
+    global result_cache
+    if cache_path is not None:
+        # Outputs of deadline runs are reused whatever preset was picked
+        result_cache = ResultCache(cache_path, any_preset=_deadline is not None)
+        _job_queue = skip_cached_jobs(_job_queue)
+
+    global job_store
+    if policy in ['longest_first', 'match_speed']:
+        job_store = JobStore(_job_queue, policy=dispatch_policies[policy](model=model))
+    else:
+        job_store = JobStore(_job_queue, policy=dispatch_policies[policy]())
+    global trace_path
+    trace_path = _trace_path
+    global deadline
+    deadline = _deadline
+    global segment_seconds
+    segment_seconds = split_minutes * 60 if split_minutes else None
+
+    for job in _job_queue:
+        tracer.begin('queued', job)
+        published.add(os.path.abspath(job.disc.local_path))
+
+    # Published images are queued with the configs given explicitly, as the
+    # queue might be empty at start
+    global rip_config
+    global hb_config
+    global fixes
+    if configs is not None:
+        (hb_config, rip_config, fixes) = configs
+    elif len(_job_queue) > 0:
         rip_config = _job_queue[0].rip_config
-        global hb_config
         hb_config = _job_queue[0].hb_config
-        global fixes
         fixes = _job_queue[0].fixes
 
     # add heartbeat thread
-    t = threading.Thread(target=heartbeat_thread, args=(ip, port))
+    t = threading.Thread(target=heartbeat_thread, args=(ip, port), daemon=True)
     t.start()
 
+    for i in range(FINALIZE_WORKERS):
+        t = threading.Thread(target=finalize_thread, daemon=True)
+        t.start()
+
+    # Local workers take jobs straight from the job store and encode from
+    # the input dir, so no image has to be transferred
+    for i in range(local_workers):
+        t = threading.Thread(target=local_worker_thread, args=('local-{}'.format(i + 1),), daemon=True)
+        t.start()
+
     flask_app.run(host=ip, port=port, threaded=True)
+
+    # A following master only ends on Ctrl-C, so the trace is written here
+    if follow and trace_path is not None:
+        logger.info('Writing trace to %s', trace_path)
+        tracer.write_chrome(trace_path)
@@ -0,0 +1,140 @@
+import threading
+import bisect
+
+
+class Metric(object):
+    """Base class of all metrics. Values are stored per tuple of label values
+    and rendered in the Prometheus text exposition format."""
+    metric_type = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('Labels {} expected'.format(self.labels))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in escaped) + '}'
+
+    def get_values(self):
+        """Returns a copy of all values as {(label value, ...): value}. For
+        histograms the value is [bucket counts..., sum, count]."""
+        with self._lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self._values.items()}
+
+    def _render_samples(self):
+        with self._lock:
+            return ['{}{} {}'.format(self.name, self._format_labels(key), _format_value(value))
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.metric_type)]
+        lines.extend(self._render_samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, value, **labels):
+        """Sets the counter to a total, that is counted somewhere else."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, doc, labels=(), buckets=None):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets or Histogram.default_buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # Format: [bucket counts..., sum, count]
+                self._values[key] = [0] * len(self.buckets) + [0, 0]
+            values = self._values[key]
+            for i in range(bisect.bisect_left(self.buckets, value), len(self.buckets)):
+                values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def _render_samples(self):
+        lines = []
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                for bucket, count in zip(self.buckets, values):
+                    lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(key, ('le', _format_value(bucket))), count))
+                lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(key, ('le', '+Inf')), values[-1]))
+                lines.append('{}_sum{} {}'.format(self.name, self._format_labels(key), _format_value(values[-2])))
+                lines.append('{}_count{} {}'.format(self.name, self._format_labels(key), values[-1]))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=None):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def add_collector(self, func):
+        """Adds a function, that is called before rendering, e.g. to update
+        gauges from the current state."""
+        self._collectors.append(func)
+
+    def render(self):
+        for func in self._collectors:
+            func()
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
@@ -0,0 +1,390 @@
+import concurrent.futures
+import collections
+import functools
+import logging
+import struct
+import zlib
+import io
+import os
+
+from drm.util import mkvpropedit, mkvpropedit_check
+
+
+logger = logging.getLogger('drm')
+
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEKHEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ID_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+INFO_ID = 0x1549A966
+TRACKS_ID = 0x1654AE6B
+CLUSTER_ID = 0x1F43B675
+TITLE_ID = 0x7BA9
+TIMECODE_SCALE_ID = 0x2AD7B1
+DURATION_ID = 0x4489
+TRACK_ENTRY_ID = 0xAE
+TRACK_TYPE_ID = 0x83
+VOID_ID = 0xEC
+CRC32_ID = 0xBF
+
+TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'subtitle'}
+
+TAG_WORKERS = 8
+
+
+class MkvError(Exception):
+    pass
+
+
+class NoSpaceError(MkvError):
+    """Raised, if the new title does not fit into the segment info and the
+    void space after it."""
+    pass
+
+
+def _read_vint(fd, keep_marker=False):
+    """Reads an EBML variable length integer. Returns (value, length,
+    unknown), unknown is True for sizes with all bits set."""
+    first = fd.read(1)
+    if not first:
+        raise MkvError('Unexpected end of file')
+    length = 1
+    mask = 0x80
+    while not first[0] & mask:
+        mask >>= 1
+        length += 1
+        if length > 8:
+            raise MkvError('Invalid variable length integer')
+    rest = fd.read(length - 1)
+    if len(rest) < length - 1:
+        raise MkvError('Unexpected end of file')
+
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for c in rest:
+        value = (value << 8) | c
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return (value, length, unknown)
+
+
+def _read_header(fd):
+    """Returns (id, size, header length, unknown size) of the element at the
+    current position."""
+    (element_id, id_length, _) = _read_vint(fd, keep_marker=True)
+    (size, size_length, unknown) = _read_vint(fd)
+    return (element_id, size, id_length + size_length, unknown)
+
+
+def _encode_id(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+
+def _encode_size(size, length):
+    if size >= (1 << (7 * length)) - 1:
+        raise ValueError('Size {} does not fit into {} bytes'.format(size, length))
+    return (size | (1 << (7 * length))).to_bytes(length, 'big')
+
+
+def _element(element_id, data):
+    length = 1
+    while (1 << (7 * length)) - 1 <= len(data):
+        length += 1
+    return _encode_id(element_id) + _encode_size(len(data), length) + data
+
+
+def _void(size):
+    """Returns a Void element of exactly size bytes (at least 2)."""
+    for length in range(1, 9):
+        data_size = size - 1 - length
+        if 0 <= data_size < (1 << (7 * length)) - 1:
+            return _encode_id(VOID_ID) + _encode_size(data_size, length) + bytes(data_size)
+    raise ValueError('No void element of {} bytes possible'.format(size))
+
+
+def _children(data):
+    """Returns [(id, raw element), ...] of the elements in data."""
+    ret = []
+    fd = io.BytesIO(data)
+    while fd.tell() < len(data):
+        start = fd.tell()
+        (element_id, size, header_length, unknown) = _read_header(fd)
+        if unknown or start + header_length + size > len(data):
+            raise MkvError('Invalid element of size {}'.format(size))
+        ret.append((element_id, data[start:start + header_length + size]))
+        fd.seek(start + header_length + size)
+    return ret
+
+
+def _open_segment(fd):
+    """Returns (position of the segment data, end of the segment). Raises
+    MkvError, if the file is shorter than the segment, e.g. because the
+    encoder was interrupted."""
+    fd.seek(0, os.SEEK_END)
+    file_size = fd.tell()
+    fd.seek(0)
+
+    (element_id, size, _, _) = _read_header(fd)
+    if element_id != EBML_ID:
+        raise MkvError('Not a Matroska file')
+    fd.seek(size, os.SEEK_CUR)
+    (element_id, size, _, unknown) = _read_header(fd)
+    if element_id != SEGMENT_ID:
+        raise MkvError('No segment found')
+    if not unknown and fd.tell() + size > file_size:
+        raise MkvError('File is truncated')
+    end = file_size if unknown else fd.tell() + size
+    return (fd.tell(), end)
+
+
+def _segment_elements(fd):
+    """Yields (id, position, header length, size) of the top level elements
+    of the segment before the first cluster."""
+    (pos, end) = _open_segment(fd)
+    # Segment info and tracks are placed before the first cluster
+    while pos < end:
+        fd.seek(pos)
+        (element_id, size, header_length, unknown) = _read_header(fd)
+        if element_id == CLUSTER_ID or unknown:
+            return
+        yield (element_id, pos, header_length, size)
+        pos += header_length + size
+
+
+def _find_info(fd):
+    """Returns (position, header length, size) of the segment info and the
+    sizes of Void elements directly before and after it or 0."""
+    elements = list(_segment_elements(fd))
+    for (i, (element_id, pos, header_length, size)) in enumerate(elements):
+        if element_id != INFO_ID:
+            continue
+        before = 0
+        if i > 0 and elements[i - 1][0] == VOID_ID:
+            before = elements[i - 1][2] + elements[i - 1][3]
+        after = 0
+        if i + 1 < len(elements) and elements[i + 1][0] == VOID_ID:
+            after = elements[i + 1][2] + elements[i + 1][3]
+        return (pos, header_length, size, before, after)
+    raise MkvError('No segment info found')
+
+
+def _payload(raw):
+    (_, _, header_length, _) = _read_header(io.BytesIO(raw))
+    return raw[header_length:]
+
+
+def _uint(data):
+    return int.from_bytes(data, 'big')
+
+
+def _float(data):
+    if len(data) == 4:
+        return struct.unpack('>f', data)[0]
+    if len(data) == 8:
+        return struct.unpack('>d', data)[0]
+    raise MkvError('Invalid float of {} bytes'.format(len(data)))
+
+
+def probe(path):
+    """Parses the segment info and the tracks of the mkv file at path.
+    Returns (duration in seconds or None, {'video': count, 'audio': count,
+    'subtitle': count}). Raises MkvError, if the file is not a valid or a
+    truncated mkv file."""
+    duration = None
+    tracks = {name: 0 for name in TRACK_TYPES.values()}
+    found_tracks = False
+    with open(path, 'rb') as fd:
+        for (element_id, pos, header_length, size) in list(_segment_elements(fd)):
+            if element_id not in (INFO_ID, TRACKS_ID):
+                continue
+            fd.seek(pos + header_length)
+            data = fd.read(size)
+            if len(data) < size:
+                raise MkvError('File is truncated')
+
+            if element_id == INFO_ID:
+                children = {child_id: _payload(raw) for (child_id, raw) in _children(data)}
+                scale = _uint(children.get(TIMECODE_SCALE_ID, b'')) or 1000000
+                if DURATION_ID in children:
+                    duration = _float(children[DURATION_ID]) * scale / 1e9
+            else:
+                found_tracks = True
+                for (child_id, raw) in _children(data):
+                    if child_id != TRACK_ENTRY_ID:
+                        continue
+                    entry = {entry_id: _payload(entry_raw) for (entry_id, entry_raw) in _children(_payload(raw))}
+                    track_type = TRACK_TYPES.get(_uint(entry.get(TRACK_TYPE_ID, b'')))
+                    if track_type is not None:
+                        tracks[track_type] += 1
+    if not found_tracks:
+        raise MkvError('No tracks found')
+    return (duration, tracks)
+
+
+def _read_info(fd):
+    (pos, header_length, size, before, after) = _find_info(fd)
+    fd.seek(pos + header_length)
+    data = fd.read(size)
+    if len(data) < size:
+        raise MkvError('Unexpected end of file')
+    return ((pos, header_length, size, before, after), _children(data))
+
+
+def _with_crc(children):
+    """Returns the joined raw children with a CRC-32 element first, if there
+    was one. Its value covers all following children of the parent."""
+    has_crc = any(element_id == CRC32_ID for (element_id, _) in children)
+    payload = b''.join(raw for (element_id, raw) in children if element_id != CRC32_ID)
+    if has_crc:
+        payload = _element(CRC32_ID, zlib.crc32(payload).to_bytes(4, 'little')) + payload
+    return payload
+
+
+def _fit(element_id, payload, available):
+    """Returns the element with payload followed by a Void element, that
+    exactly fills available bytes, or None."""
+    id_length = len(_encode_id(element_id))
+    # Use the shortest size field, but grow it by one byte, if exactly one
+    # byte would be left, which is too small for a Void element
+    for size_length in range(1, 9):
+        left = available - id_length - size_length - len(payload)
+        if left < 0:
+            return None
+        if left != 1 and len(payload) < (1 << (7 * size_length)) - 1:
+            data = _encode_id(element_id) + _encode_size(len(payload), size_length) + payload
+            return data + (_void(left) if left > 0 else b'')
+    return None
+
+
+def _moved_seek_head(fd, element_id, position):
+    """Returns (position, raw element) of the SeekHead with the entry of
+    element_id changed to position, relative to the segment data. Returns
+    None, if there is no such entry. Raises NoSpaceError, if the new position
+    doesn't fit into the size of the old one."""
+    (data_start, _) = _open_segment(fd)
+    for (seek_head_id, pos, header_length, size) in list(_segment_elements(fd)):
+        if seek_head_id != SEEKHEAD_ID:
+            continue
+        fd.seek(pos)
+        raw = fd.read(header_length + size)
+        children = _children(raw[header_length:])
+        found = False
+        for (i, (child_id, child_raw)) in enumerate(children):
+            if child_id != SEEK_ID:
+                continue
+            entries = _children(_payload(child_raw))
+            if not any(entry_id == SEEK_ID_ID and _payload(entry_raw) == _encode_id(element_id) for (entry_id, entry_raw) in entries):
+                continue
+            for (j, (entry_id, entry_raw)) in enumerate(entries):
+                if entry_id == SEEK_POSITION_ID:
+                    # Keep the length of the value, so no other element moves
+                    value_length = len(_payload(entry_raw))
+                    if position - data_start >= 1 << (8 * value_length):
+                        raise NoSpaceError('Seek position does not fit')
+                    value = (position - data_start).to_bytes(value_length, 'big')
+                    entries[j] = (entry_id, entry_raw[:len(entry_raw) - value_length] + value)
+            payload = b''.join(entry_raw for (_, entry_raw) in entries)
+            children[i] = (child_id, child_raw[:len(child_raw) - len(payload)] + payload)
+            found = True
+        if not found:
+            return None
+        return (pos, raw[:header_length] + _with_crc(children))
+    return None
+
+
+def get_title(path):
+    """Returns the title of the segment info or None."""
+    with open(path, 'rb') as fd:
+        (_, children) = _read_info(fd)
+    for (element_id, raw) in children:
+        if element_id == TITLE_ID:
+            (_, _, header_length, _) = _read_header(io.BytesIO(raw))
+            return raw[header_length:].decode('utf-8', 'replace')
+    return None
+
+
+def set_title(path, title):
+    """Sets the title of the segment info in place. The segment info is
+    rewritten within its own space and a Void element directly after it, so
+    no other element moves. If that is too small, the segment info is moved
+    into a Void element directly before it, as libavformat leaves after the
+    space reserved for the SeekHead, and its SeekHead entry is updated.
+    CRC-32 elements are recalculated. Returns False, if the title was
+    already set. Raises NoSpaceError, if the title doesn't fit."""
+    with open(path, 'r+b') as fd:
+        ((pos, header_length, size, before, after), children) = _read_info(fd)
+        for (element_id, raw) in children:
+            if element_id == TITLE_ID:
+                (_, _, title_header_length, _) = _read_header(io.BytesIO(raw))
+                if raw[title_header_length:].decode('utf-8', 'replace') == title:
+                    return False
+
+        children = [(element_id, raw) for (element_id, raw) in children if element_id not in (TITLE_ID, VOID_ID)]
+        payload = _with_crc(children + [(TITLE_ID, _element(TITLE_ID, title.encode('utf-8')))])
+
+        data = _fit(INFO_ID, payload, header_length + size + after)
+        if data is not None:
+            fd.seek(pos)
+            fd.write(data)
+            return True
+
+        data = _fit(INFO_ID, payload, before + header_length + size + after) if before else None
+        if data is None:
+            raise NoSpaceError('Not enough space for the title in {}'.format(path))
+        seek_head = _moved_seek_head(fd, INFO_ID, pos - before)
+        fd.seek(pos - before)
+        fd.write(data)
+        if seek_head is not None:
+            fd.seek(seek_head[0])
+            fd.write(seek_head[1])
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _mkvpropedit_available():
+    return mkvpropedit_check()
+
+
+def _tag_file(path, title):
+    """Returns (changed, method), method is 'in_place', 'mkvpropedit' or
+    'failed'."""
+    try:
+        return (set_title(path, title), 'in_place')
+    except MkvError as e:
+        if not _mkvpropedit_available():
+            logger.error('Setting title of %s failed (%s)', path, e)
+            return (False, 'failed')
+        logger.debug('Setting title of %s in place failed (%s), using mkvpropedit', path, e)
+        return (mkvpropedit(path, title), 'mkvpropedit')
+    except OSError as e:
+        logger.error('Setting title of %s failed (%s)', path, e)
+        return (False, 'failed')
+
+
+def tag_file(path, title):
+    """Sets the title of the mkv file at path, with mkvpropedit as fallback,
+    if it can't be set in place. Returns True, if the title was changed."""
+    (changed, _) = _tag_file(path, title)
+    if changed:
+        logger.debug('Set title of %s to %s', path, title)
+    return changed
+
+
+def tag_files(files, workers=TAG_WORKERS):
+    """Sets the titles of the files given as [(path, title), ...] in
+    parallel. Returns the number of changed files. Logs how many files
+    needed the mkvpropedit fallback, e.g. because the muxer left no Void
+    element after the segment info."""
+    def tag(entry):
+        (changed, method) = _tag_file(*entry)
+        if changed:
+            logger.debug('Set title of %s to %s', *entry)
+        return (changed, method)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(tag, files))
+    methods = collections.Counter(method for (_, method) in results)
+    if methods['mkvpropedit']:
+        logger.info('Set title of %d of %d files with mkvpropedit, they had no space in place', methods['mkvpropedit'], len(files))
+    return sum(changed for (changed, _) in results)
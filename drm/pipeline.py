@@ -0,0 +1,294 @@
+import threading
+import logging
+import queue
+import json
+import os
+
+import drm.master as master
+import drm.slave as slave
+import drm.mkv as mkv
+from drm.data import Disc, Job
+from drm.trace import Tracer
+
+
+logger = logging.getLogger('drm')
+
+
+STAGES = ['scan', 'encode', 'tag']
+DEFAULT_WORKERS = {'scan': 1, 'encode': 4, 'tag': 2}
+PROGRESS_PERIOD = 30                # in seconds
+
+
+class Progress(object):
+    """Persists the last finished stage of every image in a JSON file, so a
+    restarted pipeline continues where it stopped."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}              # Format: {image name: {'stage': ..., 'outputs': [...]}, ...}
+        try:
+            with open(path, 'r') as fd:
+                self._entries = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except json.decoder.JSONDecodeError:
+            logger.error('Pipeline state %s is invalid, starting from scratch', path)
+
+    def get(self, name):
+        with self._lock:
+            return dict(self._entries.get(name, {}))
+
+    def items(self):
+        with self._lock:
+            return [(name, dict(entry)) for name, entry in self._entries.items()]
+
+    def set(self, name, stage, outputs=None):
+        with self._lock:
+            entry = self._entries.setdefault(name, {})
+            entry['stage'] = stage
+            if outputs is not None:
+                entry['outputs'] = outputs
+            # Write to a temp file first, so a crash never leaves a broken file
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as fd:
+                json.dump(self._entries, fd, indent=2)
+            os.replace(temp_path, self.path)
+
+
+class Item(object):
+    """An image passing through the pipeline."""
+
+    def __init__(self, path, outputs=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.job = None
+        self.outputs = outputs or []
+
+    def __str__(self):
+        return self.name
+
+
+class Stage(object):
+    """Runs func on the items of a bounded queue with a number of worker
+    threads. func returns True to pass an item on to the next stage. put()
+    blocks, while the queue is full, so a slow stage holds back the stages
+    before it, instead of letting items pile up."""
+
+    def __init__(self, name, func, workers=1, queue_size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(queue_size if queue_size is not None else workers)
+        self.next = None
+        self.pipeline = None
+        self.busy = 0
+        self.done = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.worker_thread, daemon=True)
+            t.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def worker_thread(self):
+        while True:
+            item = self.queue.get()
+            with self.pipeline.lock:
+                self.busy += 1
+            try:
+                passed = self.func(item)
+            except Exception:
+                logger.exception('Stage %s failed for %s', self.name, item)
+                passed = False
+            with self.pipeline.lock:
+                self.busy -= 1
+                if passed:
+                    self.done += 1
+                else:
+                    self.failed += 1
+
+            self.pipeline.progress.set(item.name, self.name if passed else 'failed', item.outputs)
+            if passed and self.next is not None:
+                self.next.put(item)
+            else:
+                self.pipeline.item_done(item)
+
+
+class Pipeline(object):
+    """Chains stages. Every item enters at the first stage or, if it was
+    processed before, after the last stage it finished."""
+
+    def __init__(self, stages, progress):
+        self.stages = stages
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.in_flight = 0
+        for (stage, next_stage) in zip(stages, stages[1:] + [None]):
+            stage.pipeline = self
+            stage.next = next_stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item, after=None):
+        """Puts item into the stage after the stage named after, or into the
+        first stage. Blocks, while that stage is full."""
+        names = [stage.name for stage in self.stages]
+        index = names.index(after) + 1 if after in names else 0
+        if index >= len(self.stages):
+            return
+        with self.lock:
+            self.in_flight += 1
+        self.stages[index].put(item)
+
+    def item_done(self, item):
+        with self.lock:
+            self.in_flight -= 1
+            self.idle.notify_all()
+
+    def wait(self):
+        """Waits until all items left the pipeline."""
+        with self.lock:
+            while self.in_flight > 0:
+                self.idle.wait()
+
+    def status(self):
+        with self.lock:
+            return ', '.join('{}: {} busy, {} queued, {} done, {} failed'.format(
+                stage.name, stage.busy, stage.queue.qsize(), stage.done, stage.failed) for stage in self.stages)
+
+
+def scan_image(item):
+    """Scans the image and checks, that it contains titles to encode. The
+    titles are kept for the encode time prediction of the master and sent to
+    the slave, so the image is not scanned again."""
+    job = Job(Disc(item.path), master.rip_config, master.hb_config, master.fixes)
+    try:
+        titles = slave.scan_titles(job.name, item.path, job.rip_config, job.fixes, Tracer('pipeline'))
+    except slave.JobFailedError as e:
+        logger.error('Scanning %s failed (%s)', item, e)
+        return False
+    if not titles:
+        logger.error('No matching titles in %s', item)
+        return False
+    job.disc.titles = titles
+    item.job = job
+    logger.info('Scanned %s, %d titles', item, len(titles))
+    return True
+
+
+def pass_image(item):
+    item.job = Job(Disc(item.path), master.rip_config, master.hb_config, master.fixes)
+    return True
+
+
+class EncodeStage(object):
+    """Queues images with the master and waits until they are encoded and
+    moved to the output dir. The number of workers bounds the number of
+    images queued with the master at the same time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = {}              # Format: {job: (event, [outputs]), ...}
+        master.on_disc_done = self.disc_done
+
+    def disc_done(self, job, outputs):
+        with self._lock:
+            entry = self._waiting.get(job)
+        if entry is not None:
+            entry[1].append(outputs)
+            entry[0].set()
+
+    def __call__(self, item):
+        if item.job is None:
+            pass_image(item)
+        event = threading.Event()
+        result = []
+        # Cached images are done right away, so wait before queueing
+        with self._lock:
+            self._waiting[item.job] = (event, result)
+        try:
+            if not master.add_job(item.job) and not event.is_set():
+                logger.warning('%s was queued before', item)
+                return False
+            event.wait()
+        finally:
+            with self._lock:
+                del self._waiting[item.job]
+
+        if result[0] is None:
+            return False
+        item.outputs = result[0]
+        return True
+
+
+def tag_outputs(item):
+    """Sets the title of every output file to its file name."""
+    tag_list = []
+    for f in item.outputs:
+        path = os.path.join(master.out_path, f)
+        if not os.path.isfile(path):
+            logger.warning('Output %s of %s not found', f, item)
+            continue
+        tag_list.append((path, os.path.splitext(f)[0]))
+    mkv.tag_files(tag_list)
+    return True
+
+
+def progress_thread(pipeline, stopped):
+    while not stopped.wait(PROGRESS_PERIOD):
+        logger.info('Pipeline: %s', pipeline.status())
+
+
+def create_pipeline(workers, progress, scan=True, tag=True):
+    """Creates the scan, encode and tag stages. workers maps stage names to
+    worker counts. The scan stage is left out without HandBrake."""
+    stages = []
+    if scan:
+        stages.append(Stage('scan', scan_image, workers['scan']))
+    stages.append(Stage('encode', EncodeStage(), workers['encode']))
+    if tag:
+        stages.append(Stage('tag', tag_outputs, workers['tag']))
+    return Pipeline(stages, progress)
+
+
+def resume(pipeline, in_path):
+    """Puts the images of in_path and the encoded, but not tagged images of
+    an earlier run into the pipeline. Failed images are skipped, until they
+    are removed from the state file.
+
+    in_path is listed right away, so it must be called before ripping
+    starts. Images ripped later are put into the pipeline, when they are
+    published, and are not picked up twice. The images are put by a
+    background thread, because put() blocks while the first stage is
+    full."""
+    items = []
+    names = set()
+    for f in sorted(os.listdir(in_path)):
+        path = os.path.join(in_path, f)
+        if not os.path.isfile(path) or f.endswith('.part'):
+            continue
+        names.add(f)
+        entry = pipeline.progress.get(f)
+        if entry.get('stage') == 'failed':
+            logger.warning('Skipping %s, it failed before', f)
+            continue
+        # Images are moved to the output dir once they are encoded, so
+        # everything left in the input dir is encoded (again)
+        after = 'scan' if entry.get('stage') == 'scan' else None
+        items.append((Item(path), after))
+
+    for (name, entry) in pipeline.progress.items():
+        if name not in names and entry.get('stage') == 'encode':
+            items.append((Item(os.path.join(in_path, name), entry.get('outputs')), 'encode'))
+
+    def put_items():
+        for (item, after) in items:
+            pipeline.put(item, after)
+    threading.Thread(target=put_items, daemon=True).start()
@@ -0,0 +1,197 @@
+import threading
+import time
+
+import drm.dvr as dvr
+
+
+# Approximate speed of the x264 presets relative to 'medium'. Used to derive
+# the speed of presets, that were not measured yet.
+PRESET_SPEED = {
+    'ultrafast': 6.0, 'superfast': 4.5, 'veryfast': 3.2, 'faster': 1.9, 'fast': 1.4,
+    'medium': 1.0, 'slow': 0.6, 'slower': 0.3, 'veryslow': 0.13, 'placebo': 0.04
+}
+
+# Presets considered for a deadline, from the best quality to the fastest
+DEADLINE_PRESETS = ['veryslow', 'slower', 'slow', 'medium', 'fast', 'faster', 'veryfast', 'superfast', 'ultrafast']
+
+SMOOTHING = 0.3                     # weight of a new measurement
+ACTIVE_PERIOD = 600                 # in seconds; slaves seen within this period count for the fleet throughput
+DEFAULT_SECONDS_PER_BYTE = 3600 / (4 * 1024 ** 3)  # one hour of video per 4 GiB image
+
+
+def resolution_class(height):
+    if height is None:
+        return 'unknown'
+    if height <= 576:
+        return 'sd'
+    if height <= 1080:
+        return 'hd'
+    return 'uhd'
+
+
+class ThroughputModel(object):
+    """Learns, how many seconds of video every slave encodes per wall clock
+    second, depending on the x264 preset, the quality and the resolution.
+
+    Measurements are smoothed exponentially. Missing combinations are
+    derived from the closest measurement: other presets of the same slave
+    are scaled by PRESET_SPEED, unknown slaves get the fleet average."""
+
+    def __init__(self, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._rates = {}                # Format: {(host, preset, quality, res): rate, ...}
+        self._last_seen = {}            # Format: {host: timestamp, ...}
+        self._seconds_per_byte = None
+
+    def observe(self, host, hb_config, height, video_seconds, wall_seconds):
+        if video_seconds <= 0 or wall_seconds <= 0:
+            return
+        rate = video_seconds / wall_seconds
+        key = (host, hb_config.h264_preset, hb_config.quality, resolution_class(height))
+        with self._lock:
+            old = self._rates.get(key)
+            self._rates[key] = rate if old is None else (1 - SMOOTHING) * old + SMOOTHING * rate
+            self._last_seen[host] = self._clock()
+
+    def observe_disc(self, size, video_seconds):
+        """Learns the ratio of video duration to image size, which is used
+        for images that were not scanned yet."""
+        if size <= 0 or video_seconds <= 0:
+            return
+        ratio = video_seconds / size
+        with self._lock:
+            old = self._seconds_per_byte
+            self._seconds_per_byte = ratio if old is None else (1 - SMOOTHING) * old + SMOOTHING * ratio
+
+    def seen(self, host):
+        with self._lock:
+            self._last_seen[host] = self._clock()
+
+    def _rate(self, host, preset, quality, res):
+        def scaled(candidates):
+            # Average over measurements, scaled to the requested preset
+            values = [rate * PRESET_SPEED[preset] / PRESET_SPEED[k[1]] for k, rate in candidates]
+            return sum(values) / len(values) if values else None
+
+        items = list(self._rates.items())
+        for match in [lambda k: k == (host, preset, quality, res),
+                      lambda k: k[0] == host and k[2] == quality and k[3] == res,
+                      lambda k: k[0] == host and k[3] == res,
+                      lambda k: k[0] == host,
+                      lambda k: k[2] == quality and k[3] == res,
+                      lambda k: k[3] == res,
+                      lambda k: True]:
+            rate = scaled([(k, r) for k, r in items if match(k)])
+            if rate is not None:
+                return rate
+        return None
+
+    def rate(self, host, hb_config, height=None):
+        """Returns the predicted seconds of video per second or None, if
+        nothing was measured yet. For host None the fleet average is used."""
+        with self._lock:
+            return self._rate(host, hb_config.h264_preset, hb_config.quality, resolution_class(height))
+
+    def active_hosts(self):
+        with self._lock:
+            now = self._clock()
+            return [host for host, seen in self._last_seen.items() if now - seen < ACTIVE_PERIOD]
+
+    def fleet_rate(self, hb_config, height=None):
+        """Returns the combined rate of all active slaves or None."""
+        rates = [self.rate(host, hb_config, height) for host in self.active_hosts()]
+        rates = [r for r in rates if r is not None]
+        return sum(rates) if rates else None
+
+    def video_seconds(self, job):
+        """Returns the seconds of video of a job, from its scanned titles or
+        estimated from the image size. Recordings have the length of
+        their cuts."""
+        if job.segment is not None:
+            (title, (first, last)) = job.segment
+            return sum(c.length for c in title.chapters if first <= c.no <= last)
+        if job.recording is not None:
+            return dvr.cut_seconds(job.recording)
+        if job.disc.titles:
+            return sum(t.duration.total_seconds() for t in job.disc.titles)
+        with self._lock:
+            seconds_per_byte = self._seconds_per_byte or DEFAULT_SECONDS_PER_BYTE
+        try:
+            return job.disc.size * seconds_per_byte
+        except OSError:
+            return 0.0
+
+    def _height(self, job):
+        if job.segment is not None:
+            return job.segment[0].height
+        heights = [t.height for t in job.disc.titles if t.height]
+        return max(heights) if heights else None
+
+    def predict_job(self, job, host=None):
+        """Returns the predicted encoding time of job on host in seconds or
+        None. For host None the average slave is used."""
+        if host is None:
+            hosts = self.active_hosts()
+            rates = [self.rate(h, job.hb_config, self._height(job)) for h in hosts]
+            rates = [r for r in rates if r is not None]
+            rate = sum(rates) / len(rates) if rates else self.rate(None, job.hb_config, self._height(job))
+        else:
+            rate = self.rate(host, job.hb_config, self._height(job))
+        if not rate:
+            return None
+        return self.video_seconds(job) / rate
+
+    def predict_queue(self, pending, working, elapsed):
+        """Returns the predicted seconds until all jobs are done or None.
+        working maps jobs to their host, elapsed maps jobs to the seconds
+        since they were leased."""
+        remaining = 0.0
+        hb_config = None
+        for job in pending:
+            remaining += self.video_seconds(job)
+            hb_config = job.hb_config
+        for job, host in working.items():
+            predicted = self.predict_job(job, host)
+            rate = self.rate(host, job.hb_config, self._height(job))
+            if predicted is not None and rate:
+                remaining += max(predicted - elapsed.get(job, 0.0), 0.0) * rate
+            hb_config = job.hb_config
+        if hb_config is None:
+            return 0.0
+        fleet_rate = self.fleet_rate(hb_config)
+        if not fleet_rate:
+            return None
+        return remaining / fleet_rate
+
+    def select_preset(self, hb_config, pending, busy, time_left):
+        """Returns the slowest x264 preset, with which the active slaves are
+        predicted to encode all pending jobs within time_left seconds. busy
+        maps hosts to the seconds until their current job is done.
+
+        Returns the preset of hb_config, if nothing was measured yet, and the
+        fastest preset, if the deadline can not be met anyway."""
+        hosts = self.active_hosts()
+        # Rates are measured per resolution class, so the video is summed
+        # per class of the pending titles
+        video_seconds = {}
+        for job in pending:
+            res = resolution_class(self._height(job))
+            video_seconds[res] = video_seconds.get(res, 0.0) + self.video_seconds(job)
+        total = sum(video_seconds.values())
+        with self._lock:
+            if not self._rates:
+                return hb_config.h264_preset
+            for preset in DEADLINE_PRESETS:
+                capacity = 0.0
+                for host in hosts:
+                    rates = {res: self._rate(host, preset, hb_config.quality, res) for res in video_seconds}
+                    if not all(rates.values()):
+                        continue
+                    # Rate of the host for the mix of resolutions
+                    wall_seconds = sum(seconds / rates[res] for res, seconds in video_seconds.items())
+                    rate = total / wall_seconds if wall_seconds > 0 else 0.0
+                    capacity += rate * max(time_left - busy.get(host, 0.0), 0.0)
+                if capacity >= total:
+                    return preset
+        return DEADLINE_PRESETS[-1]
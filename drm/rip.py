@@ -0,0 +1,320 @@
+import threading
+import tempfile
+import logging
+import struct
+import shutil
+import fcntl
+import queue
+import glob
+import time
+import os
+
+import requests
+
+from drm.util import dvdbackup, genisoimage, eject
+
+
+logger = logging.getLogger('drm')
+
+
+CDROM_DRIVE_STATUS = 0x5326         # ioctl of linux/cdrom.h
+CDS_DISC_OK = 4
+CDSL_CURRENT = 0x7fffffff
+SECTOR_SIZE = 2048                  # in bytes
+READ_SIZE = 512 * SECTOR_SIZE       # in bytes
+
+POLL_PERIOD = 2                     # in seconds; checks for disc changes
+PROGRESS_PERIOD = 30                # in seconds
+MIN_DISK_SPACE_LEFT = 15            # in gb
+PUBLISH_TIMEOUT = 10                # in seconds
+PART_SUFFIX = '.part'               # images are renamed, once they are complete
+
+
+def find_drives():
+    """Returns all optical drives or the default drive /dev/dvd."""
+    drives = sorted(glob.glob('/dev/sr[0-9]*'))
+    return drives if drives else ['/dev/dvd']
+
+
+def disc_present(device):
+    try:
+        fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        return fcntl.ioctl(fd, CDROM_DRIVE_STATUS, CDSL_CURRENT) == CDS_DISC_OK
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def read_volume_descriptor(device):
+    """Returns (volume label, size in bytes) from the ISO 9660 volume
+    descriptor of the disc, or (None, None)."""
+    try:
+        with open(device, 'rb') as fd:
+            fd.seek(16 * SECTOR_SIZE)
+            pvd = fd.read(SECTOR_SIZE)
+    except OSError:
+        return (None, None)
+    if pvd[1:6] != b'CD001':
+        return (None, None)
+    label = pvd[40:72].decode('ascii', 'replace').strip()
+    (sectors,) = struct.unpack_from('<I', pvd, 80)
+    return (label or None, sectors * SECTOR_SIZE)
+
+
+class ReadError(Exception):
+    pass
+
+
+def copy_disc(device, out_path, progress=None):
+    """Copies the disc sector by sector to out_path in one pass. progress
+    is called with the bytes copied so far. Raises ReadError, if the disc
+    can't be read, e.g. because the drive refuses to read scrambled sectors.
+    The partial image is removed on errors."""
+    copied = 0
+    try:
+        in_fd = open(device, 'rb', buffering=0)
+    except OSError as e:
+        raise ReadError('Opening {} failed ({})'.format(device, e)) from e
+
+    try:
+        with in_fd, open(out_path, 'wb') as out_fd:
+            while True:
+                try:
+                    data = in_fd.read(READ_SIZE)
+                except OSError as e:
+                    raise ReadError('Reading {} failed after {} bytes ({})'.format(device, copied, e)) from e
+                if not data:
+                    break
+                out_fd.write(data)
+                copied += len(data)
+                if progress is not None:
+                    progress(copied)
+    except BaseException:
+        try:
+            os.remove(out_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return copied
+
+
+def publish_image(ip, port, path):
+    """Registers a finished image with a running master, which queues it
+    right away. Returns True, if the master accepted the image."""
+    url = 'http://{ip}:{port}/images/'.format(ip=ip, port=port)
+    try:
+        r = requests.post(url, data={'path': os.path.abspath(path)}, timeout=PUBLISH_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logger.warning('Publishing %s to master at %s:%s failed (%s)', path, ip, port, e)
+        return False
+    if r.status_code != 200:
+        logger.warning('Master at %s:%s rejected %s (%s)', ip, port, path, r.text.strip())
+        return False
+    logger.info('Published %s to master at %s:%s', path, ip, port)
+    return True
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+class DriveWorker(object):
+    """Rips every disc inserted into one drive. Discs are copied directly to
+    the image, with dvdbackup and genisoimage as fallback for discs, that
+    can't be read directly. Names are taken from the volume label or
+    requested through the name queue, which is served by the main thread, so
+    prompts of different drives don't mix.
+
+    Images are written with PART_SUFFIX and renamed, once they are
+    complete, so a master never queues a partial image. publish is called
+    with the path of every finished image."""
+
+    def __init__(self, device, out_dir, name_requests, use_label=False, fallback=True, publish=None):
+        self.device = device
+        self.out_dir = out_dir
+        self.name_requests = name_requests
+        self.use_label = use_label
+        self.fallback = fallback
+        self.publish = publish
+        self.stopped = threading.Event()
+        self.state = 'waiting for disc'
+        self.name = None
+        self.disc_size = None
+        self.copied = 0
+        self.temp_dir = None
+        self.time_started = None
+
+    def start(self):
+        self.t = threading.Thread(target=self.run, daemon=True)
+        self.t.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def progress(self):
+        """Returns a one line description of the state of the drive."""
+        ret = '{}: {}'.format(self.device, self.state)
+        if self.state == 'ripping' and self.disc_size:
+            ripped = dir_size(self.temp_dir) if self.temp_dir is not None else self.copied
+            ret += ' {} {:.0f}% ({:.1f} of {:.1f} GB)'.format(self.name, 100 * ripped / self.disc_size,
+                                                               ripped / 1024 ** 3, self.disc_size / 1024 ** 3)
+        elif self.name is not None:
+            ret += ' {}'.format(self.name)
+        return ret
+
+    def wait_for_disc(self, present):
+        while not self.stopped.is_set():
+            if disc_present(self.device) == present:
+                return True
+            self.stopped.wait(POLL_PERIOD)
+        return False
+
+    def request_name(self, label):
+        reply = queue.Queue()
+        self.name_requests.put((self, label, reply))
+        return reply.get()
+
+    def run(self):
+        while self.wait_for_disc(True):
+            (label, self.disc_size) = read_volume_descriptor(self.device)
+            if self.use_label and label:
+                name = label
+            else:
+                self.state = 'waiting for name'
+                name = self.request_name(label)
+
+            if name:
+                self.rip(name.upper())
+
+            self.state = 'ejecting'
+            self.name = None
+            if not eject(self.device):
+                logger.error('%s: eject failed!', self.device)
+
+            # Wait for the tray to be opened, so the same disc isn't ripped again
+            self.state = 'waiting for disc change'
+            if not self.wait_for_disc(False):
+                break
+            self.state = 'waiting for disc'
+
+    def copy(self, out_path):
+        """Copies the disc directly to the image."""
+        def progress(copied):
+            self.copied = copied
+        self.copied = 0
+        copy_disc(self.device, out_path, progress)
+
+    def backup(self, name, out_path):
+        """Mirrors the disc with dvdbackup and creates the image from the
+        mirror. Needs temp space and writes the disc twice, but decrypts
+        discs, that can't be read directly."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.temp_dir = temp_dir
+            dvdbackup(temp_dir, name, self.device)
+            self.state = 'creating image'
+            genisoimage(out_path, os.path.join(temp_dir, name))
+            self.temp_dir = None
+
+    def remove_part(self, part_path):
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+    def rip(self, name):
+        self.name = name
+        out_path = os.path.join(self.out_dir, name + '.iso')
+        if os.path.isfile(out_path):
+            logger.warning('%s: file %s already exists', self.device, out_path)
+            return False
+
+        (_, _, free_mem) = shutil.disk_usage(self.out_dir)
+        if free_mem / 1024 / 1024 / 1024 < MIN_DISK_SPACE_LEFT:
+            logger.warning('Free space in out dir might not be enough')
+
+        logger.info('%s: ripping %s', self.device, name)
+        self.time_started = time.time()
+        self.state = 'ripping'
+        part_path = out_path + PART_SUFFIX
+        try:
+            try:
+                self.copy(part_path)
+            except ReadError as e:
+                if not self.fallback:
+                    logger.warning('%s: %s', self.device, e)
+                    self.remove_part(part_path)
+                    return False
+                logger.warning('%s: %s, falling back to dvdbackup', self.device, e)
+                self.backup(name, part_path)
+        except OSError as e:
+            # e.g. disk full or dvdbackup/genisoimage not installed
+            logger.error('%s: ripping %s failed (%s)', self.device, name, e)
+            self.temp_dir = None
+            self.remove_part(part_path)
+            return False
+
+        try:
+            image_size = os.path.getsize(part_path)
+        except FileNotFoundError:
+            image_size = 0
+
+        # If image is 0 byte, ripping failed, and there won't be a real image
+        duration = time.time() - self.time_started
+        if image_size == 0:
+            logger.warning('%s: failed %s [%.0f s]', self.device, name, duration)
+            self.remove_part(part_path)
+            return False
+        os.rename(part_path, out_path)
+        logger.info('%s: done %s [%.2f GB, %.0f s]', self.device, name, image_size / 1024 ** 3, duration)
+
+        if self.publish is not None:
+            self.publish(out_path)
+        return True
+
+
+def progress_thread(workers, stopped):
+    while not stopped.wait(PROGRESS_PERIOD):
+        if any(worker.state in ('ripping', 'creating image') for worker in workers):
+            for worker in workers:
+                logger.info('%s', worker.progress())
+
+
+def rip_drives(out_dir, drives, use_label=False, fallback=True, publish=None):
+    """Rips discs from all drives concurrently, until interrupted. publish
+    is called with the path of every finished image."""
+    name_requests = queue.Queue()
+    workers = [DriveWorker(device, out_dir, name_requests, use_label, fallback, publish) for device in drives]
+    for worker in workers:
+        worker.start()
+    logger.info('Ripping from %s (Ctrl-C to end)', ', '.join(drives))
+
+    stopped = threading.Event()
+    threading.Thread(target=progress_thread, args=(workers, stopped), daemon=True).start()
+
+    try:
+        # Names are prompted one after another
+        while True:
+            try:
+                (worker, label, reply) = name_requests.get(timeout=1)
+            except queue.Empty:
+                continue
+            prompt = 'Disc in {}{}: please enter disc name (empty to skip): '.format(
+                worker.device, ' [{}]'.format(label) if label else '')
+            reply.put(input(prompt).strip())
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        stopped.set()
+        for worker in workers:
+            worker.stop()
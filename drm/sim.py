@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import random
+import json
+
+from drm.data import HandbrakeConfig, RipConfig, Disc, Job
+from drm.store import JobStore
+
+
+# Defaults match the periods used by master and slave
+HEARTBEAT_PERIOD = 5                # in seconds
+LEASE_PERIOD = 30                   # in seconds
+EXPIRY_CHECK_PERIOD = 1             # in seconds
+RETRY_PERIOD = 30                   # in seconds
+RESTART_PERIOD = 300                # in seconds; time until a crashed slave asks for jobs again
+
+
+class SimJob(object):
+    """Recorded job: image size, video seconds per title and output size."""
+    def __init__(self, name, size, titles, out_size=0, scan=10.0):
+        self.name = name
+        self.size = size
+        self.titles = titles
+        self.out_size = out_size
+        self.scan = scan
+
+    @classmethod
+    def parse_data(cls, data):
+        return cls(data['name'], data['size'], data['titles'], data.get('out_size', 0), data.get('scan', 10.0))
+
+
+class SimSlave(object):
+    """Recorded slave: encoding speed in seconds of video per second,
+    bandwidth in bytes per second and probabilities of a crash (no further
+    heartbeats) or a reported failure per job."""
+    def __init__(self, name, speed, bandwidth, crash_rate=0.0, fail_rate=0.0):
+        self.name = name
+        self.speed = speed
+        self.bandwidth = bandwidth
+        self.crash_rate = crash_rate
+        self.fail_rate = fail_rate
+
+    @classmethod
+    def parse_data(cls, data):
+        return cls(data['name'], data['speed'], data['bandwidth'], data.get('crash_rate', 0.0), data.get('fail_rate', 0.0))
+
+
+def load_trace(path):
+    """Loads jobs and slaves from a JSON file. The file either contains
+    {'jobs': [...], 'slaves': [...]} or is a Chrome trace written by the
+    master, from which sizes, title durations, speeds and bandwidths are
+    derived."""
+    with open(path, 'r') as fd:
+        data = json.load(fd)
+
+    if 'traceEvents' not in data:
+        return ([SimJob.parse_data(j) for j in data['jobs']], [SimSlave.parse_data(s) for s in data['slaves']])
+
+    hosts = {}
+    spans = []
+    for event in data['traceEvents']:
+        if event['ph'] == 'M' and event['name'] == 'process_name':
+            hosts[event['pid']] = event['args']['name']
+        elif event['ph'] == 'X':
+            spans.append(event)
+
+    jobs = {}
+    slaves = {}
+    for span in spans:
+        host = hosts[span['pid']]
+        job = jobs.setdefault(span['args']['job'], {'size': 0, 'titles': {}, 'out_size': 0, 'scan': []})
+        seconds = span['dur'] / 1000000
+        if span['name'] == 'download' and host == 'master':
+            job['size'] = span['args'].get('bytes', 0)
+        elif span['name'] == 'download':
+            slave = slaves.setdefault(host, {'bytes': 0, 'seconds': 0.0, 'video': 0.0, 'encode': 0.0})
+            slave['bytes'] += span['args'].get('bytes', 0)
+            slave['seconds'] += seconds
+        elif span['name'] == 'scan':
+            job['scan'].append(seconds)
+        elif span['name'] == 'encode':
+            slave = slaves.setdefault(host, {'bytes': 0, 'seconds': 0.0, 'video': 0.0, 'encode': 0.0})
+            slave['video'] += span['args'].get('duration', 0)
+            slave['encode'] += seconds
+            key = (span['args'].get('title'), str(span['args'].get('chapters')))
+            job['titles'][key] = span['args'].get('duration', 0)
+            job['out_size'] += span['args'].get('bytes', 0)
+
+    sim_jobs = [SimJob(name, j['size'], list(j['titles'].values()), j['out_size'],
+                       sum(j['scan']) / len(j['scan']) if j['scan'] else 10.0)
+                for name, j in sorted(jobs.items()) if j['size']]
+    sim_slaves = [SimSlave(name, s['video'] / s['encode'] if s['encode'] else 1.0,
+                           s['bytes'] / s['seconds'] if s['seconds'] else 10 * 1024 * 1024)
+                  for name, s in sorted(slaves.items())]
+    return (sim_jobs, sim_slaves)
+
+
+class Simulator(object):
+    """Discrete event simulation of master and slaves. The master side is the
+    real JobStore (dispatch policy, leases, failures and backoff), driven by
+    a simulated clock, so the results reflect the scheduling code of the
+    master."""
+
+    def __init__(self, sim_jobs, sim_slaves, policy=None, lease_period=LEASE_PERIOD,
+                 heartbeat_period=HEARTBEAT_PERIOD, seed=0):
+        self.now = 0.0
+        self._events = []
+        self._seq = itertools.count()
+        self.rng = random.Random(seed)
+        self.lease_period = lease_period
+        self.heartbeat_period = heartbeat_period
+
+        rip_config = RipConfig()
+        hb_config = HandbrakeConfig()
+        self.jobs = []
+        self.sim_jobs = {}
+        for sim_job in sim_jobs:
+            job = Job(Disc(sim_job.name, sim_job.size), rip_config, hb_config, [])
+            self.jobs.append(job)
+            self.sim_jobs[job] = sim_job
+        self.slaves = sim_slaves
+
+        self.store = JobStore(self.jobs, clock=lambda: self.now, policy=policy)
+
+        self.attempt_seq = itertools.count()
+        self.attempts = {}              # Format: {slave name: (attempt, job, start), ...}
+        self.useful = 0.0
+        self.wasted = 0.0
+        self.makespan = 0.0
+
+    def schedule(self, delay, func, *args):
+        heapq.heappush(self._events, (self.now + delay, next(self._seq), func, args))
+
+    def run(self):
+        for slave in self.slaves:
+            self.schedule(0.0, self.request_job, slave)
+        self.schedule(EXPIRY_CHECK_PERIOD, self.check_expiry)
+
+        while self._events and not self.store.is_finished():
+            (self.now, _, func, args) = heapq.heappop(self._events)
+            func(*args)
+        self.makespan = self.now
+
+        return self.report()
+
+    def check_expiry(self):
+        self.store.expire()
+        next_deadline = self.store.next_deadline()
+        if next_deadline is None or next_deadline > EXPIRY_CHECK_PERIOD:
+            next_deadline = EXPIRY_CHECK_PERIOD
+        self.schedule(max(next_deadline, 0.001), self.check_expiry)
+
+    def request_job(self, slave):
+        backoff = self.store.get_backoff(slave.name)
+        if backoff > 0:
+            self.schedule(backoff, self.request_job, slave)
+            return
+
+        job = self.store.lease(slave.name, self.lease_period)
+        if job is None:
+            if not self.store.is_finished():
+                self.schedule(RETRY_PERIOD, self.request_job, slave)
+            return
+
+        sim_job = self.sim_jobs[job]
+        duration = (sim_job.size / slave.bandwidth + sim_job.scan + sum(sim_job.titles) / slave.speed +
+                    sim_job.out_size / slave.bandwidth)
+
+        attempt = next(self.attempt_seq)
+        self.attempts[slave.name] = (attempt, job, self.now)
+
+        roll = self.rng.random()
+        if roll < slave.crash_rate:
+            self.schedule(self.rng.uniform(0, duration), self.crash, slave, attempt)
+        elif roll < slave.crash_rate + slave.fail_rate:
+            self.schedule(self.rng.uniform(0, duration), self.fail, slave, attempt)
+        else:
+            self.schedule(duration, self.finish, slave, attempt)
+        self.schedule(self.heartbeat_period, self.heartbeat, slave, attempt)
+
+    def _end_attempt(self, slave, attempt):
+        """Returns (job, start) of the attempt, if it is still running."""
+        current = self.attempts.get(slave.name)
+        if current is None or current[0] != attempt:
+            return (None, None)
+        del self.attempts[slave.name]
+        return current[1:]
+
+    def heartbeat(self, slave, attempt):
+        # Same handling as a WORKING post in master.handle_job. The slave
+        # keeps encoding, even if the master does not know the job anymore.
+        current = self.attempts.get(slave.name)
+        if current is None or current[0] != attempt:
+            return
+        job = current[1]
+        if self.store.get_working(job.name) is not None:
+            if not self.store.renew(job, slave.name, self.lease_period):
+                self.store.requeue(job)
+        self.schedule(self.heartbeat_period, self.heartbeat, slave, attempt)
+
+    def finish(self, slave, attempt):
+        # Same handling as a DONE post in master.handle_job
+        (job, start) = self._end_attempt(slave, attempt)
+        if job is None:
+            return
+        if self.store.get_working(job.name) is not None and self.store.complete(job):
+            self.store.finalized(job)
+            self.useful += self.now - start
+        else:
+            self.wasted += self.now - start
+        self.schedule(0.0, self.request_job, slave)
+
+    def fail(self, slave, attempt):
+        (job, start) = self._end_attempt(slave, attempt)
+        if job is None:
+            return
+        if self.store.get_working(job.name) is not None:
+            self.store.fail(job, slave.name, 'encode_failed')
+        self.wasted += self.now - start
+        self.schedule(0.0, self.request_job, slave)
+
+    def crash(self, slave, attempt):
+        # The lease expires in the store, the slave comes back later
+        (job, start) = self._end_attempt(slave, attempt)
+        if job is None:
+            return
+        self.wasted += self.now - start
+        self.schedule(RESTART_PERIOD, self.request_job, slave)
+
+    def report(self):
+        (pending, working, done, quarantined) = self.store.snapshot()
+        capacity = self.makespan * len(self.slaves)
+        return {'makespan': self.makespan,
+                'utilisation': self.useful / capacity if capacity else 0.0,
+                'wasted': self.wasted,
+                'done': len(done),
+                'quarantined': len(quarantined),
+                'expired': self.store.get_stats().get('expired', 0)}
+
+
+def simulate(sim_jobs, sim_slaves, policy=None, lease_period=LEASE_PERIOD, heartbeat_period=HEARTBEAT_PERIOD, seed=0):
+    return Simulator(sim_jobs, sim_slaves, policy, lease_period, heartbeat_period, seed).run()
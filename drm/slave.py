@@ -7,11 +7,17 @@ import time
 import requests
 from requests_toolbelt import MultipartEncoder
 import logging
+import errno
+import socket
 import cgi
 
 import drm
-from drm.data import HandbrakeConfig, RipConfig, Fix
+from drm.data import HandbrakeConfig, RipConfig, Fix, Title
 import drm.handbrake as handbrake
+import drm.fingerprint as fingerprint
+import drm.mkv as mkv
+import drm.dvr as dvr
+from drm.trace import Tracer
 
 
 logger = logging.getLogger('drm')
@@ -19,16 +25,30 @@ logger = logging.getLogger('drm')
 
 MIN_DISK_SPACE_LEFT = 15                # in gb
 HEARTBEAT_CHECK_PERIOD = 5             # in seconds
+LEASE_PERIOD = 30                      # in seconds
+UPLOAD_LEASE_PERIOD = 600              # in seconds; requested while uploading, so slow uploads do not time out
+DURATION_TOLERANCE = 0.02              # allowed deviation of the output duration from the scanned duration
+MIN_DURATION_TOLERANCE = 5             # in seconds
 
 
 class JobFailedError(Exception):
-    pass
+    """Raised if a job fails. reason is one of Failure.allowed_reasons and is
+    reported to the master."""
+    def __init__(self, msg, reason='unknown'):
+        super().__init__(msg)
+        self.reason = reason
 
 
 class AllJobsDoneError(Exception):
     pass
 
 
+class NoJobAvailableError(Exception):
+    def __init__(self, msg, retry):
+        super().__init__(msg)
+        self.retry = retry
+
+
 class ServerNotAvailableError(Exception):
     pass
 
@@ -70,27 +90,49 @@ def get_job(ip, port):
     if data is None:
         raise AllJobsDoneError('No more jobs available')
 
+    if 'retry' in data:
+        raise NoJobAvailableError('No job available right now', data['retry'])
+
     job_id = data['name']
     rip_config = RipConfig.parse_data(data['rip_config'])
     hb_config = HandbrakeConfig.parse_data(data['hb_config'])
     fixes = [Fix.parse_data(fix) for fix in data['fixes']]
 
-    return (job_id, rip_config, hb_config, fixes)
+    # Segment jobs only encode a chapter range of one title
+    segment = None
+    if data.get('segment') is not None:
+        segment = (Title.parse_data(data['segment']['title']), tuple(data['segment']['chapters']))
+
+    # DVR recordings are encoded with ffmpeg
+    recording = None
+    if data.get('recording') is not None:
+        recording = dvr.EncodeConfig.parse_data(data['recording'])
+
+    # Titles of images scanned before they were queued
+    titles = None
+    if data.get('titles') is not None:
+        titles = [Title.parse_data(t) for t in data['titles']]
+
+    return (job_id, rip_config, hb_config, fixes, segment, recording, titles)
 
 
-def get_input_file(ip, port, job_id, path):
+def get_input_file(ip, port, job_id, path, file_name=None):
+    """Downloads the image of the job or, for recordings, the stream file
+    file_name to path. Returns the name of the file."""
     url = 'http://{ip}:{port}/jobs/{job_id}'.format(ip=ip, port=port, job_id=job_id)
+    if file_name is not None:
+        url += '/' + file_name
 
     try:
         r = requests.get(url, stream=True)
     except requests.exceptions.ConnectionError as e:
-        raise JobFailedError('Could not fetch input file') from e
+        raise JobFailedError('Could not fetch input file', 'connection_failed') from e
 
     try:
         value, params = cgi.parse_header(r.headers['content-disposition'])
         filename = params['filename']
     except KeyError as e:
-        raise JobFailedError('Could not fetch input file') from e
+        raise JobFailedError('Could not fetch input file', 'connection_failed') from e
 
     exp_file_size = int(r.headers['content-length'])
     logger.info('Fetching job %s (%.1f GiB)', job_id, exp_file_size / 1024 / 1024 / 1024)
@@ -105,16 +147,17 @@ def get_input_file(ip, port, job_id, path):
     real_file_size = os.stat(filepath).st_size
 
     if exp_file_size != real_file_size:
-        raise JobFailedError('Fetching input file failed')
+        raise JobFailedError('Fetching input file failed', 'size_mismatch')
 
     return filename
 
 
-def send_files(ip, port, job_id, files, temp_dir):
+def send_files(ip, port, job_id, files, temp_dir, stats=None, tracer=None):
     logger.info('Sending %d files to master', len(files))
 
     url = 'http://{ip}:{port}/jobs/{job_id}'.format(ip=ip, port=port, job_id=job_id)
-    fields = {'state': 'DONE'}
+    fields = {'state': 'DONE', 'stats': json.dumps(stats or []), 'handbrake': handbrake.get_version() or '',
+              'trace': json.dumps(tracer.dump_data() if tracer else [])}
     for f in files:
         fields[os.path.basename(f)] = (os.path.basename(f), open(os.path.join(temp_dir, f), 'rb'))
 
@@ -122,7 +165,35 @@ def send_files(ip, port, job_id, files, temp_dir):
     try:
         r = requests.post(url, data=m, headers={'Content-Type': m.content_type})
     except requests.exceptions.ConnectionError:
-        raise JobFailedError('Could not send files to server')
+        raise JobFailedError('Could not send files to server', 'connection_failed')
+
+
+def report_titles(ip, port, job_id, titles, lease_period):
+    """Reports the titles to the master and returns the indices of titles,
+    that are duplicates of titles encoded by other jobs."""
+    url = 'http://{ip}:{port}/jobs/{job_id}'.format(ip=ip, port=port, job_id=job_id)
+    fields = {'state': 'WORKING', 'lease': lease_period, 'titles': json.dumps([t.dump_data() for t in titles])}
+
+    try:
+        r = requests.post(url, files={}, data=fields)
+    except requests.exceptions.ConnectionError:
+        raise JobFailedError('Could not report titles to master', 'connection_failed')
+
+    try:
+        return r.json()['skip']
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def report_failure(ip, port, job_id, error, tracer=None):
+    url = 'http://{ip}:{port}/jobs/{job_id}'.format(ip=ip, port=port, job_id=job_id)
+    fields = {'state': 'FAILED', 'reason': error.reason, 'message': str(error),
+              'trace': json.dumps(tracer.dump_data() if tracer else [])}
+
+    try:
+        requests.post(url, files={}, data=fields)
+    except requests.exceptions.ConnectionError:
+        logger.error('Could not report failure to master')
 
 
 class HeartbeatContextManager:
@@ -132,9 +203,10 @@ class HeartbeatContextManager:
         self.job_id = job_id
         self.keep_running = True
         self.connection_failed = False
+        self.lease_period = LEASE_PERIOD
 
     def __do_hearbeat(self):
-        status = {'state': 'WORKING'}
+        status = {'state': 'WORKING', 'lease': self.lease_period}
         url = 'http://{ip}:{port}/jobs/{job_id}'.format(ip=self.ip, port=self.port, job_id=self.job_id)
         try:
             r = requests.post(url, files={}, data=status)
@@ -158,7 +230,7 @@ class HeartbeatContextManager:
         self.t.join()
 
 
-def slave_encode(ip, port):
+def slave_encode(ip, port, dvr_workers):
     temp_dir = tempfile.TemporaryDirectory()
 
     # Check if there is still some disk space left
@@ -167,54 +239,221 @@ def slave_encode(ip, port):
     if free_mem_gb < MIN_DISK_SPACE_LEFT:
         logger.warning('Free space in temp dir might not be enough')
 
-    (job_id, rip_config, hb_config, fixes) = get_job(ip, port)
+    (job_id, rip_config, hb_config, fixes, segment, recording, titles) = get_job(ip, port)
+
+    tracer = Tracer(socket.gethostname())
+    try:
+        if recording is not None:
+            process_recording(ip, port, job_id, recording, temp_dir.name, tracer, dvr_workers)
+        else:
+            process_job(ip, port, job_id, rip_config, hb_config, fixes, temp_dir.name, tracer, segment, titles)
+    except JobFailedError as e:
+        report_failure(ip, port, job_id, e, tracer)
+        raise
+
+    return job_id
 
+
+def scan_titles(job_id, in_path, rip_config, fixes, tracer):
+    """Scans the image and returns the titles matching rip_config."""
+    try:
+        with tracer.span('scan', job_id) as span:
+            titles = handbrake.scan_disc(in_path, 'use_libdvdread' in fixes)
+            span['titles'] = len(titles)
+    except handbrake.HandbrakeError as e:
+        raise JobFailedError(str(e), e.reason) from e
+
+    titles = handbrake.filter_titles(titles,
+                                     rip_config.len_range[0], rip_config.len_range[1],
+                                     rip_config.a_lang, rip_config.s_lang)
+
+    if 'remove_duplicate_tracks' in fixes:
+        titles = handbrake.remove_duplicate_tracks(titles)
+
+    fingerprint.fingerprint_titles(in_path, titles)
+    return titles
+
+
+def validate_output(path, title, duration):
+    """Checks, that the output file is a complete mkv file with the
+    expected duration in seconds and the tracks selected from title. For
+    title None, only the video track is checked. Raises JobFailedError
+    otherwise."""
+    name = os.path.basename(path)
+    try:
+        (out_duration, tracks) = mkv.probe(path)
+    except (mkv.MkvError, OSError) as e:
+        raise JobFailedError('Output {} is invalid ({})'.format(name, e), 'invalid_output') from e
+
+    if out_duration is None:
+        raise JobFailedError('Output {} has no duration'.format(name), 'invalid_output')
+    if abs(out_duration - duration) > max(duration * DURATION_TOLERANCE, MIN_DURATION_TOLERANCE):
+        raise JobFailedError('Output {} is {:.0f} s long, expected {:.0f} s'.format(name, out_duration, duration), 'invalid_output')
+
+    if title is None:
+        if tracks['video'] != 1:
+            raise JobFailedError('Output {} has {} video tracks'.format(name, tracks['video']), 'invalid_output')
+        return
+
+    expected = {'video': 1, 'audio': len(title.a_tracks), 'subtitle': len(title.s_tracks)}
+    if tracks != expected:
+        raise JobFailedError('Output {} has {} video, {} audio and {} subtitle tracks, expected {}, {} and {}'.format(
+            name, tracks['video'], tracks['audio'], tracks['subtitle'], expected['video'], expected['audio'], expected['subtitle']),
+            'invalid_output')
+
+
+def encode(job_id, in_path, titles, rip_config, hb_config, fixes, out_dir, tracer, chapters=None):
+    """Encodes the titles to out_dir and returns (output file names, encode
+    stats). If chapters is given, only that chapter range of the only title
+    is encoded."""
+    stats = []
+    try:
+        if chapters is not None:
+            out_list = [handbrake.encode_segment(hb_config, rip_config, fixes, titles[0], chapters, in_path, out_dir, stats)]
+        else:
+            out_list = handbrake.encode_titles(hb_config, rip_config, fixes, titles, in_path, out_dir, stats)
+    except handbrake.HandbrakeError as e:
+        # HandBrake only reports a non-zero exit code, so check if the
+        # disk ran full
+        (_, _, free_mem) = shutil.disk_usage(out_dir)
+        if free_mem == 0:
+            raise JobFailedError('No space left for output files', 'disk_full') from e
+        raise JobFailedError(str(e), e.reason) from e
+    finally:
+        for entry in stats:
+            tracer.add('encode', job_id, entry['start'], entry['end'], title=entry['title'],
+                       chapters=entry['chapters'], duration=entry['duration'], fps=entry['fps'],
+                       bytes=os.path.getsize(os.path.join(out_dir, entry['path'])))
+
+    # Broken outputs are not worth uploading
+    with tracer.span('validate', job_id, files=len(stats)):
+        titles_by_index = {t.index: t for t in titles}
+        for entry in stats:
+            validate_output(os.path.join(out_dir, entry['path']), titles_by_index[entry['title']], entry['duration'])
+    return (out_list, stats)
+
+
+def encode_recording(job_id, cfg, in_path, out_dir, tracer, workers=dvr.DEFAULT_WORKERS):
+    """Encodes the DVR recording with the stream files in in_path to
+    out_dir in workers parallel chunks and returns (output file names,
+    encode stats) like encode()."""
+    out_path = os.path.join(out_dir, dvr.output_file_name)
+    duration = dvr.cut_seconds(cfg)
+    start = time.time()
+    try:
+        with tracer.span('encode', job_id, duration=duration):
+            dvr.encode_recording(cfg, in_path, out_path, workers)
+    except dvr.DvrError as e:
+        (_, _, free_mem) = shutil.disk_usage(out_dir)
+        if free_mem == 0:
+            raise JobFailedError('No space left for output files', 'disk_full') from e
+        raise JobFailedError(str(e), 'encode_failed') from e
+    stats = [{'title': None, 'chapters': None, 'path': dvr.output_file_name, 'duration': duration, 'fps': None,
+              'start': start, 'end': time.time()}]
+
+    with tracer.span('validate', job_id, files=1):
+        validate_output(out_path, None, duration)
+    return ([dvr.output_file_name], stats)
+
+
+def process_recording(ip, port, job_id, cfg, temp_dir, tracer, workers=dvr.DEFAULT_WORKERS):
+    """Downloads the stream files with cuts of a DVR recording, encodes
+    them with ffmpeg and sends out.mkv to the master."""
     with HeartbeatContextManager(ip, port, job_id) as hb_ctx:
+        try:
+            with tracer.span('download', job_id) as span:
+                for name in dvr.recording_files(cfg):
+                    if hb_ctx.connection_failed:
+                        raise JobFailedError('Heartbeat failed', 'connection_failed')
+                    get_input_file(ip, port, job_id, temp_dir, name)
+                span['bytes'] = sum(os.path.getsize(os.path.join(temp_dir, name)) for name in dvr.recording_files(cfg))
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise JobFailedError('No space left for input file', 'disk_full') from e
+            raise
+
         if hb_ctx.connection_failed:
-            raise JobFailedError('Heartbeat failed')
+            raise JobFailedError('Heartbeat failed', 'connection_failed')
 
-        input_file_name = get_input_file(ip, port, job_id, temp_dir.name)
+        # Recordings are not scanned, the cutlist defines the output
+        (out_list, stats) = encode_recording(job_id, cfg, temp_dir, temp_dir, tracer, workers)
 
         if hb_ctx.connection_failed:
-            raise JobFailedError('Heartbeat failed')
-
-        in_path = os.path.join(temp_dir.name, input_file_name)
+            raise JobFailedError('Heartbeat failed', 'connection_failed')
 
-        titles = handbrake.scan_disc(in_path, 'use_libdvdread' in fixes)
-        titles = handbrake.filter_titles(titles,
-                                         rip_config.len_range[0], rip_config.len_range[1],
-                                         rip_config.a_lang, rip_config.s_lang)
+        hb_ctx.lease_period = UPLOAD_LEASE_PERIOD
+        send_files(ip, port, job_id, out_list, temp_dir, stats, tracer)
 
-        if 'remove_duplicate_tracks' in fixes:
-            titles = handbrake.remove_duplicate_tracks(titles)
 
+def process_job(ip, port, job_id, rip_config, hb_config, fixes, temp_dir, tracer, segment=None, titles=None):
+    with HeartbeatContextManager(ip, port, job_id) as hb_ctx:
         if hb_ctx.connection_failed:
-            raise JobFailedError('Heartbeat failed')
+            raise JobFailedError('Heartbeat failed', 'connection_failed')
 
-        logger.info('Found %d titles to encode', len(titles))
+        try:
+            with tracer.span('download', job_id) as span:
+                input_file_name = get_input_file(ip, port, job_id, temp_dir)
+                span['bytes'] = os.path.getsize(os.path.join(temp_dir, input_file_name))
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise JobFailedError('No space left for input file', 'disk_full') from e
+            raise
+
+        if hb_ctx.connection_failed:
+            raise JobFailedError('Heartbeat failed', 'connection_failed')
+
+        in_path = os.path.join(temp_dir, input_file_name)
+
+        if segment is None:
+            if titles is None:
+                titles = scan_titles(job_id, in_path, rip_config, fixes, tracer)
+            else:
+                logger.info('Using %d titles scanned before the image was queued', len(titles))
+
+            if hb_ctx.connection_failed:
+                raise JobFailedError('Heartbeat failed', 'connection_failed')
+
+            skip = report_titles(ip, port, job_id, titles, hb_ctx.lease_period)
+            if skip:
+                logger.info('Skipping titles %s (duplicates or split into segments)', ', '.join(str(i) for i in skip))
+                titles = [t for t in titles if t.index not in skip]
+            logger.info('Found %d titles to encode', len(titles))
+            chapters = None
+        else:
+            # The title was scanned by the job, that split it off
+            (title, chapters) = segment
+            titles = [title]
 
         # TODO: cancel encoding, if heartbeat failed
-        out_list = handbrake.encode_titles(hb_config, rip_config, fixes, titles, in_path, temp_dir.name)
+        (out_list, stats) = encode(job_id, in_path, titles, rip_config, hb_config, fixes, temp_dir, tracer, chapters)
 
         if hb_ctx.connection_failed:
-            raise JobFailedError('Heartbeat failed')
+            raise JobFailedError('Heartbeat failed', 'connection_failed')
 
-        send_files(ip, port, job_id, out_list, temp_dir.name)
-
-    return job_id
+        hb_ctx.lease_period = UPLOAD_LEASE_PERIOD
+        send_files(ip, port, job_id, out_list, temp_dir, stats, tracer)
 
 
-def slave_start(ip, port):
+def slave_start(ip, port, dvr_workers=None):
+    """Encodes jobs of the master until all are done. dvr_workers is the
+    number of chunks of DVR recordings encoded in parallel, by default
+    derived from the number of cores."""
     if not check_master(ip, port):
         logger.error('Server not running or drm version on master/slave do not match')
         return
 
+    if dvr_workers is None:
+        dvr_workers = dvr.default_workers()
+
     while True:
         try:
-            job_id = slave_encode(ip, port)
+            job_id = slave_encode(ip, port, dvr_workers)
             logger.info('Job %s finished', job_id)
         except JobFailedError as e:
             logger.error('Job failed (%s)', e)
+        except NoJobAvailableError as e:
+            logger.info('No job available, retrying in %d s', e.retry)
+            time.sleep(e.retry)
         except AllJobsDoneError as e:
             logger.info('All jobs finished')
             break
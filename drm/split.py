@@ -0,0 +1,76 @@
+import logging
+import os
+
+from drm.data import Job
+from drm.util import mkvmerge_append
+
+
+logger = logging.getLogger('drm')
+
+
+def split_chapters(title, segment_seconds):
+    """Returns chapter ranges [(first, last), ...] of about segment_seconds
+    video each. Returns an empty list, if the title would not be split in
+    at least two segments."""
+    total = sum(c.length for c in title.chapters)
+    count = int(round(total / segment_seconds)) if segment_seconds > 0 else 0
+    if count < 2 or len(title.chapters) < 2:
+        return []
+
+    # Cut at the chapter closest to every multiple of total / count
+    ranges = []
+    first = title.chapters[0].no
+    elapsed = 0
+    for i, chapter in enumerate(title.chapters[:-1]):
+        target = total * (len(ranges) + 1) / count
+        elapsed += chapter.length
+        if abs(elapsed - target) <= abs(elapsed + title.chapters[i + 1].length - target):
+            ranges.append((first, chapter.no))
+            first = title.chapters[i + 1].no
+            if len(ranges) == count - 1:
+                break
+    ranges.append((first, title.chapters[-1].no))
+    return ranges if len(ranges) > 1 else []
+
+
+class SplitTitle(object):
+    """A title, that is encoded in chapter aligned segments by different
+    slaves. Every segment is a job of its own, the encoded segments are
+    joined losslessly to the same output file, that an unsplit title would
+    have."""
+
+    def __init__(self, job, title, ranges):
+        self.job = job
+        self.title = title
+        self.segments = [Job(job.disc, job.rip_config, job.hb_config, job.fixes, segment=(title, r)) for r in ranges]
+        self.files = {}                 # Format: {segment job: path of encoded segment, ...}
+        self.joined = False
+        self.failed = False             # a segment was quarantined, the title can't be joined
+        self.settled = set()            # segments, that were encoded or quarantined
+
+    @property
+    def done(self):
+        """True, if the title was joined or can't be joined and no segment
+        is left, that still needs the image."""
+        return self.joined or (self.failed and len(self.settled) == len(self.segments))
+
+    @property
+    def out_name(self):
+        return os.path.basename(self.job.disc.local_path) + '.' + str(self.title.index) + '.mkv'
+
+    def add_file(self, segment, path):
+        """Records the encoded file of a segment and returns True, if all
+        segments are encoded."""
+        self.files[segment] = path
+        self.settled.add(segment)
+        return len(self.files) == len(self.segments)
+
+    def join(self, out_dir):
+        """Joins the segments in chapter order to out_dir and returns the
+        path of the joined file. mkvmerge shifts the timestamps and chapters
+        of every appended segment, so the chapters match the unsplit title."""
+        out_file = os.path.join(out_dir, self.out_name)
+        if not mkvmerge_append(out_file, [self.files[s] for s in self.segments]):
+            raise OSError('Joining segments of title {} of {} failed'.format(self.title.index, self.job.disc.local_path))
+        self.joined = True
+        return out_file
@@ -0,0 +1,341 @@
+import threading
+import datetime
+import logging
+import heapq
+import itertools
+import time
+import collections
+
+from drm.data import Failure
+
+
+logger = logging.getLogger('drm')
+
+
+MAX_JOB_FAILURES = 3                # failed attempts until a job is quarantined
+MAX_SLAVE_FAILURES = 3              # failures in a row until a slave is backed off
+SLAVE_BACKOFF_PERIOD = 60           # in seconds; doubled for every further failure
+MAX_SLAVE_BACKOFF_PERIOD = 3600     # in seconds
+
+
+class DispatchPolicy(object):
+    """Decides which pending job is leased next. The default takes the most
+    recently added job."""
+    name = 'lifo'
+
+    def select(self, pending, host):
+        """Returns the index of the job in pending, that is leased to host."""
+        return len(pending) - 1
+
+
+class FifoPolicy(DispatchPolicy):
+    """Takes the job, that is pending the longest."""
+    name = 'fifo'
+
+    def select(self, pending, host):
+        return 0
+
+
+class LargestFirstPolicy(DispatchPolicy):
+    """Takes the largest image first, so the long jobs don't end up at the
+    end of the run."""
+    name = 'largest_first'
+
+    def select(self, pending, host):
+        return max(range(len(pending)), key=lambda i: pending[i].disc.size)
+
+
+class SmallestFirstPolicy(DispatchPolicy):
+    name = 'smallest_first'
+
+    def select(self, pending, host):
+        return min(range(len(pending)), key=lambda i: pending[i].disc.size)
+
+
+class LongestFirstPolicy(DispatchPolicy):
+    """Takes the job with the most video first, as predicted by a
+    ThroughputModel, or the largest image without a model."""
+    name = 'longest_first'
+
+    def __init__(self, model=None):
+        self.model = model
+
+    def select(self, pending, host):
+        if self.model is None:
+            return max(range(len(pending)), key=lambda i: pending[i].disc.size)
+        return max(range(len(pending)), key=lambda i: self.model.video_seconds(pending[i]))
+
+
+class MatchSpeedPolicy(DispatchPolicy):
+    """Gives the largest images to the fastest slaves and the smallest
+    images to the slowest slaves. slave_speeds maps hosts to their relative
+    speed; unknown hosts are treated as average. With a ThroughputModel, the
+    measured speeds of the active slaves are used instead."""
+    name = 'match_speed'
+
+    def __init__(self, slave_speeds=None, model=None):
+        self.slave_speeds = slave_speeds if slave_speeds is not None else {}
+        self.model = model
+
+    def select(self, pending, host):
+        slave_speeds = self.slave_speeds
+        if self.model is not None:
+            slave_speeds = {h: self.model.rate(h, pending[-1].hb_config) for h in self.model.active_hosts()}
+            slave_speeds = {h: rate for h, rate in slave_speeds.items() if rate is not None}
+        if not slave_speeds:
+            return len(pending) - 1
+        speeds = sorted(slave_speeds.values())
+        median = speeds[len(speeds) // 2]
+        if slave_speeds.get(host, median) >= median:
+            return max(range(len(pending)), key=lambda i: pending[i].disc.size)
+        return min(range(len(pending)), key=lambda i: pending[i].disc.size)
+
+
+dispatch_policies = {policy.name: policy for policy in [DispatchPolicy, FifoPolicy, LargestFirstPolicy, SmallestFirstPolicy,
+                                                       LongestFirstPolicy, MatchSpeedPolicy]}
+
+
+class JobStore(object):
+    """Keeps track of pending, working and done jobs of the master.
+
+    All methods are atomic and may be called concurrently from the flask
+    request threads and the heartbeat thread.
+
+    Leases expire at a deadline. Deadlines are kept in a heap, so expired
+    leases are found in O(log n) instead of scanning all working jobs. Renewed
+    leases leave a stale heap entry behind, which is skipped when it is
+    popped.
+
+    Failed attempts (reported by the slave or expired leases) are recorded
+    per job and per slave. Jobs that failed max_job_failures times are
+    quarantined instead of being retried forever, slaves that failed
+    max_slave_failures times in a row get no new jobs for a while."""
+
+    def __init__(self, jobs=None, clock=time.monotonic, max_job_failures=MAX_JOB_FAILURES,
+                 max_slave_failures=MAX_SLAVE_FAILURES, policy=None):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self.policy = policy if policy is not None else DispatchPolicy()
+        self.max_job_failures = max_job_failures
+        self.max_slave_failures = max_slave_failures
+        self._pending = collections.deque()
+        self._working = {}              # Format: {job: (host, lease start), ...}
+        self._deadlines = {}            # Format: {job: deadline, ...}
+        self._deadline_heap = []        # Format: [(deadline, seq, job), ...]
+        self._seq = itertools.count()
+        self._finalizing = []
+        self._done = []
+        self._quarantined = []
+        self._index = {}                # Format: {job_id: job, ...}
+        self._slave_failures = {}       # Format: {host: [failure, ...], ...}
+        self._slave_streak = {}         # Format: {host: failures in a row, ...}
+        self._slave_backoff = {}        # Format: {host: deadline, ...}
+        self._stats = collections.Counter()
+
+        for job in jobs or []:
+            self.add(job)
+
+    def add(self, job):
+        with self._lock:
+            self._index[job.name] = job
+            self._pending.append(job)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._index.get(str(job_id))
+
+    def get_working(self, job_id):
+        with self._lock:
+            job = self._index.get(str(job_id))
+            if job not in self._working:
+                return None
+            return job
+
+    def get_lease(self, job):
+        """Returns (host, lease start) of the current lease of job or None."""
+        with self._lock:
+            return self._working.get(job)
+
+    def _set_deadline(self, job, lease_period):
+        deadline = self._clock() + lease_period
+        self._deadlines[job] = deadline
+        heapq.heappush(self._deadline_heap, (deadline, next(self._seq), job))
+
+    def _remove_working(self, job):
+        del self._working[job]
+        del self._deadlines[job]
+
+    def _record_failure(self, job, host, reason, message):
+        """Returns 'requeued' or 'quarantined'."""
+        failure = Failure(reason, host, message)
+        job.failures.append(failure)
+        self._slave_failures.setdefault(host, []).append(failure)
+
+        if len(job.failures) >= self.max_job_failures:
+            logger.error('Job %s failed %d times, quarantining it', job, len(job.failures))
+            self._quarantined.append(job)
+            self._stats['quarantined'] += 1
+            outcome = 'quarantined'
+        else:
+            # Retry the job after all other pending jobs
+            self._pending.appendleft(job)
+            self._stats['requeued'] += 1
+            outcome = 'requeued'
+        self._stats['failed'] += 1
+
+        streak = self._slave_streak.get(host, 0) + 1
+        self._slave_streak[host] = streak
+        if streak >= self.max_slave_failures:
+            backoff = min(SLAVE_BACKOFF_PERIOD * 2 ** (streak - self.max_slave_failures), MAX_SLAVE_BACKOFF_PERIOD)
+            logger.warning('Slave %s failed %d times in a row, backing off for %d s', host, streak, backoff)
+            self._slave_backoff[host] = self._clock() + backoff
+        return outcome
+
+    def lease(self, host, lease_period):
+        """Takes the next pending job and assigns it to host for lease_period
+        seconds. Returns None if no job is pending."""
+        with self._lock:
+            if not self._pending:
+                return None
+            index = self.policy.select(self._pending, host)
+            job = self._pending[index]
+            del self._pending[index]
+            self._working[job] = (host, datetime.datetime.now())
+            self._set_deadline(job, lease_period)
+            self._stats['leased'] += 1
+            return job
+
+    def renew(self, job, host, lease_period):
+        """Extends the lease of job to lease_period seconds from now. Returns
+        False if job is not leased to host."""
+        with self._lock:
+            lease = self._working.get(job)
+            if lease is None or lease[0] != host:
+                return False
+            self._set_deadline(job, lease_period)
+            return True
+
+    def complete(self, job):
+        """Marks job as completed by a slave. The job stays unfinished until
+        finalized() is called, so the master does not shut down while the
+        output files are moved. Returns False if it was already completed."""
+        with self._lock:
+            if job in self._working:
+                host = self._working[job][0]
+                self._slave_streak[host] = 0
+                self._remove_working(job)
+            elif job in self._pending:
+                self._pending.remove(job)
+            else:
+                return False
+            self._finalizing.append(job)
+            self._stats['completed'] += 1
+            return True
+
+    def fail(self, job, host, reason, message=''):
+        """Records a failed attempt of job on host and requeues or
+        quarantines the job. Returns 'requeued' or 'quarantined', or None if
+        job is not leased to host, e.g. because the lease of host expired
+        and the job was leased to another slave."""
+        with self._lock:
+            lease = self._working.get(job)
+            if lease is None or lease[0] != host:
+                return None
+            self._remove_working(job)
+            return self._record_failure(job, host, reason, message)
+
+    def get_backoff(self, host):
+        """Returns the seconds host has to wait for a new job."""
+        with self._lock:
+            deadline = self._slave_backoff.get(host)
+            if deadline is None:
+                return 0.0
+            return max(0.0, deadline - self._clock())
+
+    def get_slave_failures(self, host):
+        with self._lock:
+            return list(self._slave_failures.get(host, []))
+
+    def finalized(self, job):
+        with self._lock:
+            self._finalizing.remove(job)
+            self._done.append(job)
+
+    def requeue(self, job):
+        """Moves a working job back to the pending jobs. Returns False if job
+        was not working."""
+        with self._lock:
+            if job not in self._working:
+                return False
+            self._remove_working(job)
+            self._pending.append(job)
+            self._stats['requeued'] += 1
+            return True
+
+    def cancel(self, jobs):
+        """Removes the pending and working jobs among jobs, e.g. the segments
+        of a quarantined job. Returns the removed jobs."""
+        cancelled = []
+        with self._lock:
+            for job in jobs:
+                if job in self._working:
+                    self._remove_working(job)
+                elif job in self._pending:
+                    self._pending.remove(job)
+                else:
+                    continue
+                self._stats['cancelled'] += 1
+                cancelled.append(job)
+        return cancelled
+
+    def expire(self):
+        """Fails all jobs, whose lease deadline has passed. Returns a list of
+        (job, 'requeued' or 'quarantined') tuples."""
+        expired = []
+        with self._lock:
+            now = self._clock()
+            while self._deadline_heap and self._deadline_heap[0][0] <= now:
+                (deadline, _, job) = heapq.heappop(self._deadline_heap)
+                if self._deadlines.get(job) != deadline:
+                    # Stale entry of a renewed or finished lease
+                    continue
+                host = self._working[job][0]
+                self._remove_working(job)
+                outcome = self._record_failure(job, host, 'lease_expired', '')
+                self._stats['expired'] += 1
+                expired.append((job, outcome))
+        return expired
+
+    def next_deadline(self):
+        """Returns the seconds until the next lease may expire or None if no
+        job is working."""
+        with self._lock:
+            while self._deadline_heap:
+                (deadline, _, job) = self._deadline_heap[0]
+                if self._deadlines.get(job) == deadline:
+                    return max(0.0, deadline - self._clock())
+                heapq.heappop(self._deadline_heap)
+            return None
+
+    def is_finished(self):
+        with self._lock:
+            return len(self._pending) == 0 and len(self._working) == 0 and len(self._finalizing) == 0
+
+    def counts(self):
+        """Returns the number of jobs per state."""
+        with self._lock:
+            return {'pending': len(self._pending), 'working': len(self._working),
+                    'finalizing': len(self._finalizing), 'done': len(self._done),
+                    'quarantined': len(self._quarantined)}
+
+    def get_stats(self):
+        """Returns the number of leased, completed, requeued, failed, expired,
+        quarantined and cancelled jobs since the start."""
+        with self._lock:
+            return dict(self._stats)
+
+    def snapshot(self):
+        """Returns copies of the (pending, working, done, quarantined)
+        collections. Jobs that are still being finalized are part of done."""
+        with self._lock:
+            return (list(self._pending), dict(self._working), self._done + self._finalizing, list(self._quarantined))
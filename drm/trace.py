@@ -0,0 +1,95 @@
+import threading
+import contextlib
+import json
+import time
+
+
+class Tracer(object):
+    """Collects timed spans of jobs (e.g. queued, download, scan, encode) on
+    one or more hosts and exports them in the Chrome trace event format,
+    which can be loaded by chrome://tracing or https://ui.perfetto.dev.
+
+    Every host is shown as a process and every job as a thread, so all spans
+    of a job line up below each other. Timestamps are wall clock times, so
+    spans of different hosts are only as accurate as their clocks."""
+
+    def __init__(self, host='master'):
+        self.host = host
+        self._lock = threading.Lock()
+        self._spans = []
+        self._open = {}                 # Format: {(job_id, name): (start, args), ...}
+
+    def add(self, name, job_id, start, end, host=None, **args):
+        span = {'name': name, 'job': str(job_id), 'host': host or self.host,
+                'start': start, 'end': end, 'args': args}
+        with self._lock:
+            self._spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, job_id, **args):
+        """Records the time spent in the with block. The yielded dict can be
+        used to add arguments, e.g. byte counts, that are only known at the
+        end."""
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.add(name, job_id, start, time.time(), **args)
+
+    def begin(self, name, job_id, **args):
+        """Starts a span, that is ended by end() from somewhere else."""
+        with self._lock:
+            self._open[(str(job_id), name)] = (time.time(), args)
+
+    def end(self, name, job_id, **args):
+        with self._lock:
+            entry = self._open.pop((str(job_id), name), None)
+        if entry is None:
+            return
+        (start, begin_args) = entry
+        begin_args.update(args)
+        self.add(name, job_id, start, time.time(), **begin_args)
+
+    def dump_data(self):
+        with self._lock:
+            return list(self._spans)
+
+    def add_data(self, data):
+        """Merges spans recorded by another tracer, e.g. of a slave."""
+        with self._lock:
+            self._spans.extend(data)
+
+    def export_chrome(self):
+        with self._lock:
+            spans = list(self._spans)
+            now = time.time()
+            # Spans that are still open are exported up to now
+            spans.extend({'name': name, 'job': job_id, 'host': self.host, 'start': start, 'end': now, 'args': args}
+                         for (job_id, name), (start, args) in self._open.items())
+
+        hosts = {}
+        jobs = {}
+        events = []
+        for span in sorted(spans, key=lambda s: s['start']):
+            if span['host'] not in hosts:
+                hosts[span['host']] = len(hosts) + 1
+                events.append({'name': 'process_name', 'ph': 'M', 'pid': hosts[span['host']],
+                               'args': {'name': span['host']}})
+            if (span['host'], span['job']) not in jobs:
+                jobs[(span['host'], span['job'])] = len(jobs) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': hosts[span['host']],
+                               'tid': jobs[(span['host'], span['job'])], 'args': {'name': span['job']}})
+
+            args = dict(span['args'])
+            args['job'] = span['job']
+            events.append({'name': span['name'], 'cat': 'drm', 'ph': 'X',
+                           'ts': int(span['start'] * 1000000),
+                           'dur': int((span['end'] - span['start']) * 1000000),
+                           'pid': hosts[span['host']], 'tid': jobs[(span['host'], span['job'])],
+                           'args': args})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome(self, path):
+        with open(path, 'w') as fd:
+            json.dump(self.export_chrome(), fd)
@@ -6,6 +6,7 @@ DVDBACKUP_BIN = 'dvdbackup'
 GENISOIMAGE_BIN = 'genisoimage'
 EJECT_BIN = 'eject'
 MKVPROPEDIT = 'mkvpropedit'
+MKVMERGE = 'mkvmerge'
 
 
 def popen_wrapper(cmd, timeout=None):
@@ -19,7 +20,8 @@ def popen_wrapper(cmd, timeout=None):
         stdout, stderr = proc.communicate(timeout=timeout)
     except subprocess.TimeoutExpired:
         proc.kill()
-        stdout, stderr = proc.communicate()
+        proc.communicate()
+        raise
 
     retval = proc.returncode
 
@@ -29,10 +31,10 @@ def popen_wrapper(cmd, timeout=None):
     return (retval, stdout, stderr)
 
 
-def dvdbackup(output_dir, title_name):
+def dvdbackup(output_dir, title_name, device='/dev/dvd'):
     cmd = [DVDBACKUP_BIN,
            '-M',                    # 'mirror'; Backup whole DVD
-           '-i', '/dev/dvd',        # input device
+           '-i', device,            # input device
            '-o', output_dir,        # output directory
            '-n', title_name]        # Title name
     (retval, stdout, stderr) = popen_wrapper(cmd)
@@ -64,8 +66,11 @@ def genisoimage_check():
         return False
 
 
-def eject():
-    (retval, stdout, stderr) = popen_wrapper([EJECT_BIN])
+def eject(device=None):
+    cmd = [EJECT_BIN]
+    if device is not None:
+        cmd.append(device)
+    (retval, stdout, stderr) = popen_wrapper(cmd)
     return retval == 0
 
 
@@ -83,6 +88,7 @@ def mkvpropedit(path, title):
            '--edit', 'info',
            '--set', 'title={title}'.format(title=title)]
     (retval, stdout, stderr) = popen_wrapper(cmd)
+    return retval == 0
 
 
 def mkvpropedit_check():
@@ -91,3 +97,23 @@ def mkvpropedit_check():
         return retval == 0
     except FileNotFoundError:
         return False
+
+
+def mkvmerge_append(out_path, in_paths):
+    """Appends the files in in_paths to one file without reencoding."""
+    cmd = [MKVMERGE, '-o', out_path]
+    for i, path in enumerate(in_paths):
+        if i > 0:
+            cmd.append('+')
+        cmd.append(path)
+    (retval, stdout, stderr) = popen_wrapper(cmd)
+    # mkvmerge returns 1 for warnings
+    return retval in (0, 1)
+
+
+def mkvmerge_check():
+    try:
+        (retval, stdout, stderr) = popen_wrapper([MKVMERGE, '--version'])
+        return retval == 0
+    except FileNotFoundError:
+        return False
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import json
+import time
+import struct
+import zlib
+import random
+import socket
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import logging
+import textwrap
+
+import drm
+from drm.data import HandbrakeConfig, RipConfig, Disc, Job
+from drm.store import JobStore, dispatch_policies
+import drm.handbrake as handbrake
+import drm.sim as sim
+import drm.util as util
+import drm.mkv as mkv
+
+
+# Environment variables used to configure the fake HandBrakeCLI
+FAKE_HB_TITLES = 'DRM_BENCH_TITLES'
+FAKE_HB_TITLE_MINUTES = 'DRM_BENCH_TITLE_MINUTES'
+FAKE_HB_CHAPTERS = 'DRM_BENCH_CHAPTERS'
+FAKE_HB_SPEED = 'DRM_BENCH_SPEED'
+FAKE_HB_BITRATE = 'DRM_BENCH_BITRATE'
+FAKE_HB_FPS = 25
+
+
+logger = logging.getLogger('drm')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_store(slaves, jobs, renews, fail_rate, lease_timeout):
+    """Hammers a JobStore with simulated slaves, that lease, renew, complete
+    and fail jobs, while an expiry thread requeues stale leases. Checks, that
+    every job is completed exactly once."""
+    rip_config = RipConfig()
+    hb_config = HandbrakeConfig()
+    job_list = [Job(Disc('bench_{}.iso'.format(i)), rip_config, hb_config, []) for i in range(jobs)]
+    # Failures are simulated, so jobs must never be quarantined and slaves
+    # never backed off
+    store = JobStore(job_list, max_job_failures=float('inf'), max_slave_failures=float('inf'))
+
+    lock = threading.Lock()
+    completed = []
+    lease_latencies = []
+    stats = {'leases': 0, 'renews': 0, 'lost': 0, 'failed': 0}
+
+    def slave_thread(host):
+        rng = random.Random(host)
+        local_latencies = []
+        local_completed = []
+        local_stats = dict.fromkeys(stats, 0)
+
+        while True:
+            start = time.perf_counter()
+            job = store.lease(host, lease_timeout)
+            local_latencies.append(time.perf_counter() - start)
+
+            if job is None:
+                if store.is_finished():
+                    break
+                time.sleep(0)
+                continue
+            local_stats['leases'] += 1
+
+            lost = False
+            for _ in range(renews):
+                local_stats['renews'] += 1
+                if not store.renew(job, host, lease_timeout):
+                    lost = True
+                    break
+            if lost:
+                local_stats['lost'] += 1
+                continue
+
+            if rng.random() < fail_rate:
+                local_stats['failed'] += 1
+                store.fail(job, host, 'unknown')
+                continue
+
+            if store.complete(job):
+                store.finalized(job)
+                local_completed.append(job)
+
+        with lock:
+            completed.extend(local_completed)
+            lease_latencies.extend(local_latencies)
+            for key in stats:
+                stats[key] += local_stats[key]
+
+    keep_expiring = True
+
+    def expiry_thread():
+        while keep_expiring:
+            store.expire()
+            next_deadline = store.next_deadline()
+            time.sleep(min(next_deadline or 0.001, 0.001))
+
+    threads = [threading.Thread(target=slave_thread, args=('slave{}'.format(i),)) for i in range(slaves)]
+    t_expire = threading.Thread(target=expiry_thread)
+
+    time_started = time.perf_counter()
+    t_expire.start()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    keep_expiring = False
+    t_expire.join()
+    duration = time.perf_counter() - time_started
+
+    (pending, working, done, quarantined) = store.snapshot()
+    ok = (len(completed) == jobs and len(set(completed)) == jobs and
+          not pending and not working and len(done) == jobs)
+
+    ops = stats['leases'] + stats['renews'] + len(completed) + stats['failed']
+    logger.info('Store: %d slaves, %d jobs in %.3f s (%s)', slaves, jobs, duration, 'OK' if ok else 'INCONSISTENT')
+    logger.info('  %d leases, %d renews, %d lost leases, %d failures', stats['leases'], stats['renews'], stats['lost'], stats['failed'])
+    logger.info('  %.0f ops/s', ops / duration)
+    logger.info('  lease latency p50 %.1f us, p99 %.1f us', percentile(lease_latencies, 50) * 1e6, percentile(lease_latencies, 99) * 1e6)
+
+    return ok
+
+
+def fake_handbrake_title(index, minutes, chapters):
+    chapter_seconds = minutes * 60 // chapters
+    return {
+        'Index': index,
+        'Duration': {'Hours': minutes // 60, 'Minutes': minutes % 60, 'Seconds': 0},
+        'Geometry': {'Width': 720, 'Height': 576, 'PAR': {'Num': 64, 'Den': 45}},
+        'Crop': [0, 0, 0, 0],
+        'InterlaceDetected': False,
+        'FrameRate': {'Num': FAKE_HB_FPS, 'Den': 1},
+        'AudioList': [{'LanguageCode': 'deu'}, {'LanguageCode': 'eng'}],
+        'SubtitleList': [{'LanguageCode': 'deu'}],
+        'ChapterList': [{'Duration': {'Hours': chapter_seconds // 3600,
+                                      'Minutes': chapter_seconds // 60 % 60,
+                                      'Seconds': chapter_seconds % 60}} for _ in range(chapters)]
+    }
+
+
+FAKE_SEEKHEAD_SPACE = 160              # in bytes; space libavformat reserves for the SeekHead
+
+
+def fake_mkv_element(element_id, data=b'', size=None):
+    """Returns an EBML element with an 8 byte size field. If size is
+    given, only the header is returned and the data is written by the
+    caller."""
+    size = len(data) if size is None else size
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + (size | 1 << 56).to_bytes(8, 'big') + data
+
+
+def fake_mkv_master(element_id, children):
+    """Returns a master element with a CRC-32 element first and the
+    shortest size fields, like libavformat writes them."""
+    data = b''.join(children)
+    data = mkv._element(mkv.CRC32_ID, zlib.crc32(data).to_bytes(4, 'little')) + data
+    return mkv._element(element_id, data)
+
+
+def fake_mkv_header(duration, audio_tracks, subtitle_tracks, data_size):
+    """Returns the start of a minimal mkv file with the given duration in
+    seconds and tracks, followed by a Void element of data_size bytes,
+    which stands in for the clusters. The layout follows libavformat, which
+    HandBrake uses: a SeekHead and a Void element filling the rest of the
+    space reserved for it, followed by the segment info and the tracks."""
+    info = fake_mkv_master(mkv.INFO_ID, [mkv._element(mkv.TIMECODE_SCALE_ID, (1000000).to_bytes(4, 'big')),
+                                         mkv._element(mkv.DURATION_ID, struct.pack('>d', duration * 1000))])
+    track_types = [1] + [2] * audio_tracks + [17] * subtitle_tracks
+    tracks = fake_mkv_master(mkv.TRACKS_ID, [mkv._element(mkv.TRACK_ENTRY_ID, mkv._element(mkv.TRACK_TYPE_ID, bytes([t])))
+                                             for t in track_types])
+
+    # Seek positions are relative to the segment data
+    entries = [(mkv.INFO_ID, FAKE_SEEKHEAD_SPACE), (mkv.TRACKS_ID, FAKE_SEEKHEAD_SPACE + len(info))]
+    seek = fake_mkv_master(mkv.SEEKHEAD_ID, [mkv._element(mkv.SEEK_ID, mkv._element(mkv.SEEK_ID_ID, mkv._encode_id(element_id)) +
+                                                          mkv._element(mkv.SEEK_POSITION_ID, pos.to_bytes(8, 'big')))
+                                             for (element_id, pos) in entries])
+    seek += mkv._void(FAKE_SEEKHEAD_SPACE - len(seek))
+    void = fake_mkv_element(mkv.VOID_ID, size=data_size)
+    segment = fake_mkv_element(mkv.SEGMENT_ID, size=len(seek) + len(info) + len(tracks) + len(void) + data_size)
+    return fake_mkv_element(mkv.EBML_ID, fake_mkv_element(0x4282, b'matroska')) + segment + seek + info + tracks + void
+
+
+def fake_handbrake(argv):
+    """Stands in for HandBrakeCLI. Scans return a title set configured by
+    environment variables, encodes write an mkv file of the expected size,
+    duration and tracks at the configured speed (seconds of video per wall
+    clock second)."""
+    if '--version' in argv:
+        print('HandBrake 1.0.0-fake')
+        return 0
+
+    titles = int(os.environ.get(FAKE_HB_TITLES, 4))
+    minutes = int(os.environ.get(FAKE_HB_TITLE_MINUTES, 25))
+    chapters = int(os.environ.get(FAKE_HB_CHAPTERS, 6))
+    speed = float(os.environ.get(FAKE_HB_SPEED, 100))
+    bitrate = int(os.environ.get(FAKE_HB_BITRATE, 50 * 1024))
+
+    title_list = [fake_handbrake_title(i + 1, minutes, chapters) for i in range(titles)]
+
+    if '--json' in argv:
+        sys.stdout.write('Version: {"Name": "HandBrake"}\n')
+        sys.stdout.write('JSON Title Set: ' + json.dumps({'MainFeature': 1, 'TitleList': title_list}, indent=4) + '\n')
+        return 0
+
+    out_path = argv[argv.index('-o') + 1]
+    title = title_list[int(argv[argv.index('-t') + 1]) - 1]
+    chapter_seconds = [c['Duration']['Minutes'] * 60 + c['Duration']['Seconds'] for c in title['ChapterList']]
+    if '-c' in argv:
+        (first, last) = [int(c) for c in argv[argv.index('-c') + 1].split('-')]
+        duration = sum(chapter_seconds[first - 1:last])
+    else:
+        duration = sum(chapter_seconds)
+
+    audio_tracks = len([t for t in argv[argv.index('-a') + 1].split(',') if t])
+    subtitle_tracks = len([t for t in argv[argv.index('-s') + 1].split(',') if t])
+
+    # Write output in one second steps of video at the configured speed
+    chunk = b'\0' * bitrate
+    time_started = time.time()
+    with open(out_path, 'wb') as fd:
+        fd.write(fake_mkv_header(duration, audio_tracks, subtitle_tracks, duration * bitrate))
+        for second in range(duration):
+            fd.write(chunk)
+            if second % 60 == 0:
+                elapsed = time.time() - time_started
+                fps = second * FAKE_HB_FPS / elapsed if elapsed > 0 else 0.0
+                sys.stdout.write('Encoding: task 1 of 1, {:.2f} % ({:.2f} fps, avg {:.2f} fps, ETA 00h00m00s)\r'.format(100 * second / duration, fps, fps))
+            delay = time_started + (second + 1) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    fps = duration * FAKE_HB_FPS / max(time.time() - time_started, 1e-6)
+    sys.stdout.write('Encoding: task 1 of 1, 100.00 % ({:.2f} fps, avg {:.2f} fps, ETA 00h00m00s)\n'.format(fps, fps))
+    sys.stderr.write('work: average encoding speed for job is {:f} fps\n'.format(fps))
+    return 0
+
+
+def fake_mkvmerge(argv):
+    """Stands in for mkvmerge. Appending files ('-o out a + b + ...') writes
+    an mkv file with the summed duration and the data of all files."""
+    if '--version' in argv:
+        print('mkvmerge v1.0.0-fake')
+        return 0
+
+    out_path = argv[argv.index('-o') + 1]
+    in_paths = [a for a in argv[argv.index('-o') + 2:] if a != '+']
+    inputs = []
+    for path in in_paths:
+        (duration, tracks) = mkv.probe(path)
+        header_size = len(fake_mkv_header(duration, tracks['audio'], tracks['subtitle'], 0))
+        inputs.append((path, duration, tracks, header_size))
+
+    tracks = inputs[0][2]
+    data_size = sum(os.path.getsize(path) - header_size for (path, _, _, header_size) in inputs)
+    with open(out_path, 'wb') as out_fd:
+        out_fd.write(fake_mkv_header(sum(duration for (_, duration, _, _) in inputs), tracks['audio'], tracks['subtitle'], data_size))
+        for (path, _, _, header_size) in inputs:
+            with open(path, 'rb') as in_fd:
+                in_fd.seek(header_size)
+                shutil.copyfileobj(in_fd, out_fd)
+    return 0
+
+
+def create_fake_tool(path, option):
+    """Creates an executable, that calls this script with option, e.g.
+    --fake-handbrake."""
+    with open(path, 'w') as fd:
+        fd.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, os.path.abspath(__file__), option))
+    os.chmod(path, 0o755)
+
+
+def create_sparse_iso(path, size):
+    with open(path, 'wb') as fd:
+        fd.truncate(size)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def slave_process(port, hb_bin):
+    from drm.slave import slave_start
+    handbrake.HANDBRAKE_CLI_BIN = hb_bin
+    slave_start('127.0.0.1', port)
+
+
+def bench_pipeline(slaves, discs, iso_size, work_dir, trace_path=None, local_workers=0, split_minutes=None):
+    """Runs a master (optionally with local workers) and slave processes with
+    a fake HandBrakeCLI on localhost and reports makespan, dispatch latency,
+    transfer throughput and heartbeat overhead."""
+    import drm.master as master
+
+    in_path = os.path.join(work_dir, 'in')
+    out_path = os.path.join(work_dir, 'out')
+    hb_bin = os.path.join(work_dir, 'HandBrakeCLI')
+    mkvmerge_bin = os.path.join(work_dir, 'mkvmerge')
+    os.mkdir(in_path)
+    os.mkdir(out_path)
+    create_fake_tool(hb_bin, '--fake-handbrake')
+    create_fake_tool(mkvmerge_bin, '--fake-mkvmerge')
+    util.MKVMERGE = mkvmerge_bin
+
+    rip_config = RipConfig(len_range=(1, 600))
+    hb_config = HandbrakeConfig()
+    job_queue = []
+    for i in range(discs):
+        iso_path = os.path.join(in_path, 'BENCH_{:04}.iso'.format(i))
+        create_sparse_iso(iso_path, iso_size)
+        job_queue.append(Job(Disc(iso_path), rip_config, hb_config, []))
+
+    port = get_free_port()
+    time_started = time.perf_counter()
+
+    handbrake.HANDBRAKE_CLI_BIN = hb_bin
+    t_master = threading.Thread(target=master.master_start_server, args=('127.0.0.1', port, job_queue, out_path, trace_path),
+                                kwargs={'local_workers': local_workers, 'split_minutes': split_minutes})
+    t_master.start()
+
+    # Slaves give up, if the master is not running yet
+    from drm.slave import check_master
+    while not check_master('127.0.0.1', port) and t_master.is_alive():
+        time.sleep(0.05)
+
+    # Slaves are separate processes, so they don't compete with the master for the GIL
+    context = multiprocessing.get_context('fork')
+    procs = [context.Process(target=slave_process, args=(port, hb_bin)) for _ in range(slaves)]
+    for proc in procs:
+        proc.start()
+
+    t_master.join()
+    makespan = time.perf_counter() - time_started
+
+    for proc in procs:
+        proc.terminate()
+        proc.join()
+
+    # Dispatch latency and heartbeat overhead from the request latency histogram
+    requests = master.metric_request_duration.get_values()
+    (dispatch_sum, dispatch_count) = requests.get(('/jobs/', 'GET'), [0, 0])[-2:]
+    (post_sum, post_count) = requests.get(('/jobs/<uuid:job_id>', 'POST'), [0, 0])[-2:]
+
+    # Transfer throughput from the transfer counters
+    transferred = {}
+    for (host, direction), value in master.metric_bytes.get_values().items():
+        transferred.setdefault(direction, [0, 0.0])[0] += value
+    for (host, direction), value in master.metric_transfer_seconds.get_values().items():
+        transferred.setdefault(direction, [0, 0.0])[1] += value
+
+    # Uploads are POSTs too, so remove them from the heartbeat numbers
+    (upload_bytes, upload_seconds) = transferred.get('upload', [0, 0.0])
+    uploads = sum(1 for span in master.tracer.dump_data() if span['name'] == 'upload')
+    heartbeats = max(post_count - uploads, 0)
+    heartbeat_seconds = max(post_sum - upload_seconds, 0.0)
+
+    logger.info('Pipeline: %d slaves, %d local workers, %d discs of %.1f MiB', slaves, local_workers, discs, iso_size / 1024 / 1024)
+    logger.info('  makespan %.2f s', makespan)
+    logger.info('  dispatch latency %.2f ms (%d requests)', 1000 * dispatch_sum / max(dispatch_count, 1), dispatch_count)
+    for direction, (size, seconds) in sorted(transferred.items()):
+        logger.info('  %s %.1f MiB in %.2f s (%.1f MiB/s)', direction, size / 1024 / 1024, seconds, size / 1024 / 1024 / max(seconds, 1e-6))
+    logger.info('  heartbeats %d, %.2f ms each, %.3f s total', heartbeats, 1000 * heartbeat_seconds / max(heartbeats, 1), heartbeat_seconds)
+    if trace_path is not None:
+        logger.info('  trace written to %s', trace_path)
+
+    # Segments of split titles are jobs of their own
+    (pending, working, done, quarantined) = master.job_store.snapshot()
+    return len([job for job in done if job.segment is None]) == discs
+
+
+def bench_simulate(trace_path, policies, lease_periods, seed):
+    """Replays recorded jobs and slaves through the master's job store for
+    every combination of dispatch policy and lease period."""
+    (sim_jobs, sim_slaves) = sim.load_trace(trace_path)
+    logger.info('Simulating %d jobs on %d slaves', len(sim_jobs), len(sim_slaves))
+
+    results = []
+    for policy_name in policies:
+        for lease_period in lease_periods:
+            if policy_name == 'match_speed':
+                policy = dispatch_policies[policy_name]({s.name: s.speed for s in sim_slaves})
+            else:
+                policy = dispatch_policies[policy_name]()
+            report = sim.simulate(sim_jobs, sim_slaves, policy, lease_period, seed=seed)
+            results.append((policy_name, lease_period, report))
+
+    logger.info('  %-16s %6s %12s %12s %12s %8s', 'policy', 'lease', 'makespan', 'utilisation', 'wasted', 'expired')
+    for (policy_name, lease_period, report) in sorted(results, key=lambda r: r[2]['makespan']):
+        logger.info('  %-16s %5ds %11.0fs %11.1f%% %11.0fs %8d', policy_name, lease_period, report['makespan'],
+                    100 * report['utilisation'], report['wasted'], report['expired'])
+    return results
+
+
+def help_build_epilog():
+    help_text = """
+               Examples:
+                 $ drm_bench --store                         # Stress job store with default settings
+                 $ drm_bench --store --slaves 500 --jobs 100000
+                 $ drm_bench --pipeline --slaves 4 --discs 20  # Run master and slaves with a fake HandBrakeCLI
+                 $ drm_bench --pipeline --titles 1 --title-minutes 120 --split 30
+                 $ drm_bench --simulate trace.json             # Compare scheduling policies on a recorded trace
+                 $ drm_bench --simulate trace.json --policy fifo,largest_first --lease-periods 30,120
+               """
+    return textwrap.dedent(help_text)
+
+
+def drm_bench_main():
+    # The fake tools are this script called with their own arguments
+    if len(sys.argv) > 1 and sys.argv[1] == '--fake-handbrake':
+        sys.exit(fake_handbrake(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == '--fake-mkvmerge':
+        sys.exit(fake_mkvmerge(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the drm master/slave pipeline.',
+                                     epilog=help_build_epilog(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + drm.__version__)
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--store', action='store_true', help='stress the master job store with simulated slaves')
+    group.add_argument('--pipeline', action='store_true', help='run master and slaves on localhost with a fake HandBrakeCLI')
+    group.add_argument('--simulate', action='store', help='simulate scheduling policies with jobs and slaves from a trace or job file')
+
+    parser.add_argument('--slaves', action='store', type=int, help='number of simulated slaves (default: 200 for --store, 4 for --pipeline)')
+    parser.add_argument('--jobs', action='store', type=int, default=20000, help='number of jobs')
+    parser.add_argument('--renews', action='store', type=int, default=5, help='heartbeats per job (--store)')
+    parser.add_argument('--fail-rate', action='store', type=float, default=0.05, help='probability of a failed job (--store)')
+    parser.add_argument('--lease-timeout', action='store', type=float, default=0.05, help='lease timeout in seconds (--store)')
+    parser.add_argument('--discs', action='store', type=int, default=8, help='number of synthetic images (--pipeline)')
+    parser.add_argument('--iso-size', action='store', type=int, default=512, help='size of synthetic images in MiB (--pipeline)')
+    parser.add_argument('--titles', action='store', type=int, default=4, help='titles per image (--pipeline)')
+    parser.add_argument('--title-minutes', action='store', type=int, default=25, help='length of each title in minutes (--pipeline)')
+    parser.add_argument('--speed', action='store', type=float, default=100, help='encoded seconds of video per second (--pipeline)')
+    parser.add_argument('--bitrate', action='store', type=int, default=50, help='output bitrate in KiB/s of video (--pipeline)')
+    parser.add_argument('--local-workers', action='store', type=int, default=0, help='number of local workers of the master (--pipeline)')
+    parser.add_argument('--split', action='store', type=int, metavar='MINUTES', help='split titles into segments of about MINUTES (--pipeline)')
+    parser.add_argument('--trace', action='store', help='write a Chrome trace of all jobs to the given file (--pipeline)')
+    parser.add_argument('--policy', action='store', default='all', help='comma separated dispatch policies or "all" (--simulate)')
+    parser.add_argument('--lease-periods', action='store', default='30', help='comma separated lease periods in seconds (--simulate)')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='seed for simulated failures (--simulate)')
+
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt='[%(asctime)s][%(levelname)s] %(message)s', datefmt='%H:%M:%S'))
+    logger.addHandler(handler)
+
+    if args.store:
+        ok = bench_store(args.slaves or 200, args.jobs, args.renews, args.fail_rate, args.lease_timeout)
+        if not ok:
+            sys.exit(1)
+
+    elif args.pipeline:
+        os.environ[FAKE_HB_TITLES] = str(args.titles)
+        os.environ[FAKE_HB_TITLE_MINUTES] = str(args.title_minutes)
+        os.environ[FAKE_HB_SPEED] = str(args.speed)
+        os.environ[FAKE_HB_BITRATE] = str(args.bitrate * 1024)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            ok = bench_pipeline(args.slaves or 4, args.discs, args.iso_size * 1024 * 1024, work_dir, args.trace, args.local_workers, args.split)
+        if not ok:
+            sys.exit(1)
+
+    elif args.simulate:
+        policies = list(dispatch_policies) if args.policy == 'all' else args.policy.split(',')
+        for policy in policies:
+            if policy not in dispatch_policies:
+                parser.error('Unknown policy {} (available: {})'.format(policy, ', '.join(dispatch_policies)))
+        lease_periods = [int(p) for p in args.lease_periods.split(',')]
+        bench_simulate(args.simulate, policies, lease_periods, args.seed)
+
+
+if __name__ == '__main__':
+    drm_bench_main()
@@ -9,10 +9,12 @@ import codecs
 import logging
 import textwrap
 import json
-import tempfile
 
 import drm
 from drm.util import popen_wrapper
+from drm.dvr import (EncodeConfig, DvrError, FFMPEG_BIN, FFPROBE_BIN, concat_file_name, segment_list_file_name,
+                     cfg_file_name, output_file_name, DEFAULT_WORKERS, probe_duration, write_concat_list,
+                     build_ffmpeg_filter, encode_recording, publish_recording, SegmentServer)
 
 import schnipp.schnipp as schnipp
 
@@ -20,80 +22,85 @@ import schnipp.schnipp as schnipp
 logger = logging.getLogger('drm')
 
 
-FFMPEG_BIN = 'ffmpeg'
 FFPLAY_BIN = 'ffplay'
 
 input_file_pattern = r'''aufnahme[0-9]{2}.trp'''
-concat_file_name = 'concat.mp4'
-cutlist_file_name = 'cutlist.txt'
-cfg_file_name = 'drm_dvr.cfg'
-output_file_name = 'out.mkv'
-
-
-class EncodeConfig(object):
-    def __init__(self, path=None):
-        if path is None:
-            self.cutlist = []
-            self.crop = None
-            self.delogo = None
-        else:
-            with open(path, 'r') as fd:
-                data = json.load(fd)
-            self.cutlist = data['cutlist']
-            self.crop = data['crop']
-            self.delogo = data['delogo']
-
-    def dumps(self):
-        return json.dumps({'cutlist': self.cutlist, 'crop': self.crop, 'delogo': self.delogo}, indent=2)
 
 
 def ffmpeg_check():
     try:
         (retval_ffmpeg, _, _) = popen_wrapper([FFMPEG_BIN, '-version'])
         (retval_ffplay, _, _) = popen_wrapper([FFPLAY_BIN, '-version'])
-        return (retval_ffmpeg == 0) and (retval_ffplay == 0)
+        (retval_ffprobe, _, _) = popen_wrapper([FFPROBE_BIN, '-version'])
+        return (retval_ffmpeg == 0) and (retval_ffplay == 0) and (retval_ffprobe == 0)
     except FileNotFoundError:
         return False
 
 
-def build_ffmpeg_filter(cfg, verbose):
-    filter_cmd = []
-
-    if cfg.delogo:
-        if verbose:
-            filter_cmd.append('delogo=show=1:x={}:y={}:w={}:h={}'.format(cfg.delogo[0], cfg.delogo[1], cfg.delogo[2], cfg.delogo[3]))
-        else:
-            filter_cmd.append('delogo=show=0:x={}:y={}:w={}:h={}'.format(cfg.delogo[0], cfg.delogo[1], cfg.delogo[2], cfg.delogo[3]))
-
-    if cfg.crop:
-        filter_cmd.append('crop=in_w-{}:in_h-{}'.format(cfg.crop[0], cfg.crop[1]))
-
-    if filter_cmd:
-        return ['-vf', '{}'.format(', '.join(filter_cmd))]
-    else:
-        return []
-
-
 def init(path):
+    """Records the segment files of the recording and their durations. The
+    files are read directly when encoding, so nothing is copied."""
     rec_file_pattern = re.compile(input_file_pattern)
     files = os.listdir(path)
     files = sorted(filter(rec_file_pattern.match, files))
-    files = [os.path.join(path, f) for f in files]
 
     if not files:
         logger.error('no input files found')
         return
 
+    cfg_path = os.path.join(path, cfg_file_name)
+    if os.path.isfile(cfg_path):
+        logger.warning('Directory {} already initialized'.format(path))
+        return
+
+    cfg = EncodeConfig()
+    for f in files:
+        duration = probe_duration(os.path.join(path, f))
+        if duration is None:
+            logger.error('ffprobe failed for {}'.format(os.path.join(path, f)))
+            return
+        cfg.segments.append([f, duration])
+
+    write_concat_list(os.path.join(path, segment_list_file_name),
+                      [(name, None, None, duration) for (name, duration) in cfg.segments])
+    with open(cfg_path, 'w') as fd:
+        fd.write(cfg.dumps())
+
+
+def create_concat_file(path):
+    """Copies the segment files into concat.mp4 for the cutlist editor.
+    Only needed for recordings initialized before segments were recorded."""
+    concat_path = os.path.join(path, concat_file_name)
+    if os.path.isfile(concat_path):
+        return True
+
+    rec_file_pattern = re.compile(input_file_pattern)
+    files = sorted(filter(rec_file_pattern.match, os.listdir(path)))
+    files = [os.path.join(path, f) for f in files]
+
     #ffmpeg -i 'concat:aufnahme00.trp|aufnahme01.trp' -codec copy concat.mp4
-    cmd = [FFMPEG_BIN, '-nostdin', '-i', 'concat:{}'.format('|'.join(files)), '-codec', 'copy', os.path.join(path, concat_file_name)]
+    cmd = [FFMPEG_BIN, '-nostdin', '-i', 'concat:{}'.format('|'.join(files)), '-codec', 'copy', concat_path]
     (retval, stdout, stderr) = popen_wrapper(cmd)
     if retval:
-        logger.warning('ffmpeg failed. Directory {} already initialized?'.format(path))
+        logger.error('ffmpeg failed to create {}'.format(concat_path))
+        return False
+    return True
+
+
+def edit(path):
+    """Opens the recording in the cutlist editor. The editor plays the
+    stream files served as one file, so nothing is copied."""
+    rec_path = os.path.join(path, '~aufnahme')
+    url = 'file://' + os.path.abspath(rec_path)
+    cfg = EncodeConfig(os.path.join(rec_path, cfg_file_name))
+    if not cfg.segments:
+        if not create_concat_file(rec_path):
+            return
+        schnipp.run(url)
         return
 
-    cfg = EncodeConfig()
-    with open(os.path.join(path, cfg_file_name), 'w') as fd:
-        fd.write(cfg.dumps())
+    with SegmentServer(rec_path, cfg.segments) as server:
+        schnipp.run(url, video=server.url)
 
 
 def init_dir(path):
@@ -117,46 +124,56 @@ def preview(path):
     path = os.path.join(path, '~aufnahme')
     cfg = EncodeConfig(os.path.join(path, cfg_file_name))
 
-    # ffplay -vf "delogo=x=636:y=84:w=27:h=42, crop=in_w:in_h-152" concat.mp4
+    # ffplay -vf "delogo=x=636:y=84:w=27:h=42, crop=in_w:in_h-152" -f concat -i segments.txt
     cmd = [FFPLAY_BIN]
     cmd += build_ffmpeg_filter(cfg, True)
-    cmd.append(os.path.join(path, concat_file_name))
+    if cfg.segments:
+        cmd += ['-f', 'concat', '-safe', '0', '-i', os.path.join(path, segment_list_file_name)]
+    else:
+        cmd.append(os.path.join(path, concat_file_name))
     (retval, stdout, stderr) = popen_wrapper(cmd)
 
 
-def encode(path):
+def encode(path, workers=DEFAULT_WORKERS):
     print('Encoding {}'.format(path))
 
     cfg = EncodeConfig(os.path.join(path, cfg_file_name))
-    cutlist_path = os.path.join(path, cutlist_file_name)
-
-    with open(cutlist_path, 'w') as fd:
-        for cut in cfg.cutlist:
-            fd.write('file concat.mp4\n')
-            fd.write('inpoint {}\n'.format(cut[0]))
-            fd.write('outpoint {}\n'.format(cut[1]))
-
-    # ffmpeg -f concat -i list.txt -vf "delogo=x=636:y=84:w=27:h=42, crop=in_w:in_h-152" -c:v libx264 -preset slow -crf 22 -c:a copy out.mkv
-    cmd = [FFMPEG_BIN, '-nostdin', '-f', 'concat', '-i', cutlist_path]
-    cmd += build_ffmpeg_filter(cfg, False)
-    cmd += ['-c:v', 'libx264', '-preset', 'slow', '-crf', '22', '-c:a', 'copy', os.path.join(path, output_file_name)]
-    (retval, stdout, stderr) = popen_wrapper(cmd)
-
-    if retval:
-        logger.error('ffmpeg failed. Does output file ({}) already exist?'.format(os.path.join(path, output_file_name)))
+    out_path = os.path.join(path, output_file_name)
+    if os.path.exists(out_path):
+        logger.error('Output file ({}) already exists'.format(out_path))
         return
 
+    try:
+        encode_recording(cfg, path, out_path, workers)
+    except DvrError as e:
+        logger.error('{}'.format(e))
+
+
+def encode_or_publish(path, workers, master):
+    if master is None:
+        encode(path, workers)
+    else:
+        # The recording is encoded by a slave, which returns out.mkv
+        publish_recording(master[0], master[1], path)
+
 
-def encode_dir(path):
+def encode_dir(path, workers=DEFAULT_WORKERS, master=None):
     info_path = os.path.join(path, 'info.xml')
     if os.path.isfile(info_path):
-        encode(os.path.join(path, '~aufnahme'))
+        encode_or_publish(os.path.join(path, '~aufnahme'), workers, master)
     else:
         for d in sorted(os.listdir(path)):
             entry_path = os.path.join(path, d)
             info_path = os.path.join(entry_path, 'info.xml')
             if os.path.isfile(info_path):
-                encode(os.path.join(entry_path, '~aufnahme'))
+                encode_or_publish(os.path.join(entry_path, '~aufnahme'), workers, master)
+
+
+def parse_cfg_slave(cfg_path):
+    """Returns (ip, port) of the master from a slave config."""
+    with open(cfg_path, 'r') as fd:
+        data = json.load(fd)
+    return (data['ip'], data['port'])
 
 
 def help_build_epilog():
@@ -166,6 +183,8 @@ def help_build_epilog():
                  $ drm_dvr --edit /some/dir/
                  $ drm_dvr --preview /some/dir/ --delogo x=100:y=100:w=10:h=10 --crop in_w-20:in_h-152
                  $ drm_dvr --encode /some/dir/ --delogo x=100:y=100:w=10:h=10 --crop in_w-20:in_h-152
+                 $ drm_dvr --encode /some/dir/ --workers 4
+                 $ drm_dvr --encode /some/dir/ --publish slave.cfg  # Encode on the slaves of a running master
                """
     return textwrap.dedent(help_text)
 
@@ -180,6 +199,8 @@ def drm_dvr_main():
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
 
     parser.add_argument('--version', action='version', version='%(prog)s ' + drm.__version__)
+    parser.add_argument('--workers', action='store', type=int, default=DEFAULT_WORKERS, help='number of chunks encoded in parallel (--encode only)')
+    parser.add_argument('--publish', action='store', metavar='SLAVE_CFG', help='queue the recordings with the master given in the slave config instead of encoding them locally, the master has to run on this machine (--encode only)')
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--init', action='store', help='initialize DVR recording for encoding')
@@ -192,12 +213,17 @@ def drm_dvr_main():
     if args.init:
         init_dir(args.init)
     elif args.edit:
-        path = 'file://' + os.path.abspath(args.edit) + '/~aufnahme'
-        schnipp.run(path)
+        edit(args.edit)
     elif args.preview:
         preview(args.preview)
     elif args.encode:
-        encode_dir(args.encode)
+        master = None
+        if args.publish:
+            try:
+                master = parse_cfg_slave(args.publish)
+            except (OSError, KeyError, ValueError):
+                parser.error('Slave config {} is invalid'.format(args.publish))
+        encode_dir(args.encode, args.workers, master)
 
 
 if __name__ == '__main__':
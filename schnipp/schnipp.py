@@ -61,7 +61,7 @@ class ImageProcessing(QObject):
         self.processingReady.emit(*result)
 
 
-def run(path, style_argv=['--style', 'Fusion']):
+def run(path, style_argv=['--style', 'Fusion'], video=None):
     app = QGuiApplication(style_argv)
     app.setOrganizationName('Christian Wichmann')
     app.setApplicationName('Schnipp!')
@@ -73,6 +73,9 @@ def run(path, style_argv=['--style', 'Fusion']):
     engine.rootContext().setContextProperty('ImageProcessing', imageProcessing)
     if path:
         engine.rootContext().setContextProperty('args', path)
+    if video:
+        # video of the directory given in path, instead of concat.mp4
+        engine.rootContext().setContextProperty('videoUrl', video)
     engine.load('schnipp/schnipp.qml')
     if not engine.rootObjects():
         sys.exit(-1)
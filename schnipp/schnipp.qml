@@ -16,6 +16,8 @@ Window {
     visible: true
     //visibility: "FullScreen"
     visibility: "Maximized"
+    // keys of the loaded config, that are not edited here (e.g. segments)
+    property var loadedConfig: ({})
 
     Settings {
         id: settings
@@ -64,11 +66,16 @@ Window {
         // TODO: Extract file name defaults to settings. 
         console.log('You chose: ' + chosenDirectory + settings.defaultVideoFile)
         // set internal variables for data from chosen directory
-        video.source = chosenDirectory + settings.defaultVideoFile
+        if (typeof videoUrl !== 'undefined' && chosenDirectory == args) {
+            video.source = videoUrl
+        } else {
+            video.source = chosenDirectory + settings.defaultVideoFile
+        }
         var JsonString = FileIO.readFile(chosenDirectory + settings.defaultConfigFile)
         console.log('Loaded JSON data: ' + JsonString)
         try {
             var JsonObject= JSON.parse(JsonString);
+            loadedConfig = JsonObject
             if (JsonObject['crop'] !== null) {
                 var cropData = JsonObject['crop']
                 selectArea.bottomLetterboxBar = Math.floor(cropData[1] / 2)
@@ -175,11 +182,11 @@ Window {
         // create JSON object
         var cropValue = (selectArea.topLetterboxBar !== 0) ? [0, selectArea.topLetterboxBar + selectArea.bottomLetterboxBar] : null
         var delogoValue = (selectArea.xv1 !== 0) ? [selectArea.xv1, selectArea.yv1, selectArea.xv2-selectArea.xv1, selectArea.yv2-selectArea.yv1] : null
-        var jsonOutput = {
+        var jsonOutput = Object.assign({}, loadedConfig, {
             crop: cropValue,
             delogo: delogoValue,
             cutlist: []
-        };
+        });
         // add all entries from cut list
         var i;
         for (i=0; i < cutListModel.count; i++) {